@@ -0,0 +1,419 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import argparse
+import json
+import pickle
+import time
+from datetime import datetime
+from functools import partial
+
+import numpy as np
+import tensorflow as tf
+print("Tensorflow version", tf.__version__)
+
+from include import configuration
+from include import eval_utils
+from include import graph_manager
+from include import inference_utils
+from include import loss_utils
+from include import nets
+
+
+def parse_list(values, dtype=int):
+    """Parse a comma-separated list of values from the command line"""
+    return [dtype(x) for x in values.split(',')]
+
+
+########################################################################## Benchmark
+def benchmark_model(build_fn, log_dir, split, batch_sizes, num_warmup, num_runs, with_map=True):
+    """Measure the complexity, latency, throughput and accuracy of a trained model.
+
+    Args:
+        build_fn: Function building the inference graph, see `inference_utils.build_odgi_model`
+        log_dir: Log directory of the trained model
+        split: Split used for collecting input images and evaluating the mAP
+        batch_sizes: List of batch sizes to measure the throughput for
+        num_warmup: Number of warmup runs before each measurement
+        num_runs: Number of timed runs for each measurement
+        with_map: If True, evaluate the mAP on the whole split
+
+    Returns:
+        A dictionnary of results
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        model = build_fn(log_dir, max(batch_sizes))
+        config = model['config']
+        with tf.name_scope('inputs'):
+            inputs, initializer = graph_manager.get_inputs(mode=split, verbose=False, **config)
+            inputs = inputs[0]
+        saver = tf.train.Saver()
+
+    results = {'model': model['name'], 'log_dir': os.path.abspath(log_dir), 'complexity': model['complexity']}
+    # Unless the final stage skips the empty crops, its cost does not depend on the number of crops
+    if not model['complexity'].get('compact_crops', False):
+        results['flops_per_image'] = model['complexity']['max_flops_per_image']
+    with tf.Session(graph=graph, config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+        checkpoint_path = tf.train.latest_checkpoint(log_dir)
+        assert checkpoint_path is not None, 'No checkpoint found in %s' % log_dir
+        saver.restore(sess, checkpoint_path)
+        results['checkpoint'] = checkpoint_path
+
+        ### Collect a pool of real input images
+        pool = inference_utils.collect_images(sess, inputs['image'], initializer, max(max(batch_sizes), num_runs))
+
+        ### Per-image latency distribution
+        latencies = []
+        for i in range(num_warmup + num_runs):
+            start_time = time.time()
+            sess.run(model['outputs'], feed_dict={model['images']: pool[i % pool.shape[0]][None]})
+            if i >= num_warmup:
+                latencies.append(1000. * (time.time() - start_time))
+        results['latency_ms'] = {'mean': float(np.mean(latencies)),
+                                 'p50': float(np.percentile(latencies, 50)),
+                                 'p95': float(np.percentile(latencies, 95)),
+                                 'p99': float(np.percentile(latencies, 99))}
+        print('   latency: %.2fms (p50 %.2fms, p95 %.2fms, p99 %.2fms)' % (
+            results['latency_ms']['mean'], results['latency_ms']['p50'],
+            results['latency_ms']['p95'], results['latency_ms']['p99']))
+        if model['latency_budget_ms'] is not None:
+            results['latency_budget_ms'] = model['latency_budget_ms']
+            results['within_latency_budget'] = float(np.mean(np.array(latencies) <= model['latency_budget_ms']))
+            print('   %.1f%% of the images processed within the %.2fms budget' % (
+                100. * results['within_latency_budget'], model['latency_budget_ms']))
+
+        ### Throughput
+        results['images_per_second'] = {}
+        for batch_size in batch_sizes:
+            batch = np.take(pool, np.arange(batch_size) % pool.shape[0], axis=0)
+            for _ in range(num_warmup):
+                sess.run(model['outputs'], feed_dict={model['images']: batch})
+            start_time = time.time()
+            for _ in range(num_runs):
+                sess.run(model['outputs'], feed_dict={model['images']: batch})
+            results['images_per_second'][str(batch_size)] = batch_size * num_runs / (time.time() - start_time)
+            print('   batch size %d: %.2f images/s' % (batch_size, results['images_per_second'][str(batch_size)]))
+
+        ### Accuracy and average number of crops
+        if with_map:
+            results_path = os.path.join(log_dir, 'benchmark_%s_output.txt' % split)
+            with open(results_path, 'w') as f:
+                f.write('%s results for benchmark\n' % split)
+            total_crops = 0
+            total_crops_before_coalescing = 0
+            total_crops_before_budget = 0
+            sess.run(initializer)
+            try:
+                while 1:
+                    inputs_ = sess.run(inputs)
+                    fetches = model['outputs'] + ([] if model['num_valid_crops'] is None else model['num_valid_crops'])
+                    out_ = sess.run(fetches, feed_dict={model['images']: inputs_['image']})
+                    if model['num_valid_crops'] is not None:
+                        total_crops_before_coalescing += out_.pop()
+                        total_crops_before_budget += out_.pop()
+                        total_crops += out_.pop()
+                    eval_utils.append_detection_outputs(
+                        results_path, inputs_['im_id'], inputs_['num_boxes'], inputs_['bounding_boxes'],
+                        *out_, **config)
+            except tf.errors.OutOfRangeError:
+                pass
+            eval_aps, eval_aps_thresholds, num_images = eval_utils.detect_eval(results_path, **config)
+            mean_aps = np.sum([x for x in eval_aps.values()], axis=0) / len(eval_aps)
+            results['map'] = {'%.2f' % thresh: float(mean_aps[t]) for t, thresh in enumerate(eval_aps_thresholds)}
+            results['num_images'] = int(num_images)
+            if model['num_valid_crops'] is not None:
+                results['crops_per_image'] = float(total_crops) / num_images
+                results['crops_per_image_before_coalescing'] = float(total_crops_before_coalescing) / num_images
+                results['stage2_passes_saved'] = int(total_crops_before_coalescing - total_crops_before_budget)
+                results['stage2_passes_skipped_by_budget'] = int(total_crops_before_budget - total_crops)
+                print('   %.2f stage 2 passes per image, %d passes saved by coalescing (%.2f per image)' % (
+                    results['crops_per_image'], results['stage2_passes_saved'], 
+                    results['stage2_passes_saved'] / float(num_images)))
+                if model['latency_budget_ms'] is not None:
+                    print('   %d passes skipped to meet the latency budget (%.2f per image)' % (
+                        results['stage2_passes_skipped_by_budget'], 
+                        results['stage2_passes_skipped_by_budget'] / float(num_images)))
+                if model['complexity']['compact_crops']:
+                    # Final stage cost for the measured number of crops per image
+                    final_stage = model['complexity'][model['complexity']['final_stage']]
+                    results['flops_per_image'] = (
+                        model['complexity']['max_flops_per_image'] + final_stage['flops'] * (
+                            results['crops_per_image'] - final_stage['max_inputs_per_image']))
+            if 'flops_per_image' in results:
+                print('   %.2f GFLOPs per image (at most %.2f)' % (
+                    results['flops_per_image'] / 1e9, model['complexity']['max_flops_per_image'] / 1e9))
+            print('   %s' % ' - '.join('map@%s = %.5f' % x for x in sorted(results['map'].items())))
+    return results
+
+
+def calibrate_latency_model(log_dir, max_num_crops, num_warmup, num_runs):
+    """Fit the linear cost model of the ODGI cascade used for latency-budgeted inference: the median latency of 
+    stage 1 on one image, up to the extraction of the stage 2 inputs, and of one stage 2 run on 1 to 
+    `max_num_crops` crops, fitted as `fixed + num_crops * per_crop`. The model is saved as `latency_model.pkl` 
+    in the log directory.
+
+    Args:
+        log_dir: Log directory of a trained ODGI model
+        max_num_crops: Maximum number of crops to time stage 2 on
+        num_warmup: Number of warmup runs before each measurement
+        num_runs: Number of timed runs for each measurement
+
+    Returns:
+        The latency model dictionnary
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        model = inference_utils.build_odgi_model(log_dir, 1)
+        # Stage 1 outputs the crops, and the stage 2 inputs extracted from them
+        stage1_outputs = [model['stages_outputs'][0]['crop_boxes'], inference_utils.get_inference_backbones()[1][0]]
+        _, network_name, forward_pass, stage2_config, _ = model['stages'][1]
+        crops_shape = (stage2_config['image_size'], stage2_config['image_size'], 3)
+        if network_name == 'roi_head':
+            crops_shape = inference_utils.get_roi_head_input_shape(stage2_config, model['stages_outputs'][0])
+        crops = tf.placeholder(tf.float32, (None,) + crops_shape, name='crops')
+        with tf.name_scope('calibration'):
+            stage2_outputs = forward_pass(crops, stage2_config, is_training=False)
+            stage2_outputs = [stage2_outputs['bounding_boxes'], stage2_outputs['detection_scores']]
+        saver = tf.train.Saver()
+
+    def median_latency(fetches, feed_dict):
+        latencies = []
+        for i in range(num_warmup + num_runs):
+            start_time = time.time()
+            sess.run(fetches, feed_dict=feed_dict)
+            if i >= num_warmup:
+                latencies.append(1000. * (time.time() - start_time))
+        return float(np.median(latencies))
+
+    with tf.Session(graph=graph, config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+        checkpoint_path = tf.train.latest_checkpoint(log_dir)
+        assert checkpoint_path is not None, 'No checkpoint found in %s' % log_dir
+        saver.restore(sess, checkpoint_path)
+        image_size = model['config']['image_size']
+        # Stage 1 (up to the crops extraction)
+        stage1_ms = median_latency(stage1_outputs, {
+            model['images']: np.random.uniform(size=(1, image_size, image_size, 3))})
+        # Stage 2, for an increasing number of crops in one run
+        num_crops = np.arange(1, max_num_crops + 1)
+        stage2_ms = [median_latency(stage2_outputs, {crops: np.random.uniform(size=(n,) + crops_shape)}) 
+                     for n in num_crops]
+    per_crop_ms, fixed_ms = np.polyfit(num_crops, stage2_ms, 1)
+    latency_model = {'stage1_ms': stage1_ms, 
+                     'stage2_fixed_ms': max(0., float(fixed_ms)), 
+                     'stage2_per_crop_ms': max(0., float(per_crop_ms)),
+                     'stage2_measured_ms': {str(n): t for n, t in zip(num_crops, stage2_ms)}}
+    print('   stage 1: %.2fms - stage 2: %.2fms + %.2fms per crop' % (
+        latency_model['stage1_ms'], latency_model['stage2_fixed_ms'], latency_model['stage2_per_crop_ms']))
+    with open(os.path.join(log_dir, 'latency_model.pkl'), 'wb') as f:
+        pickle.dump(latency_model, f)
+    return latency_model
+
+
+def backbones_complexity(networks, image_sizes):
+    """Count the floating point operations and parameters of detectors built on the given backbones.
+
+    Args:
+        networks: List of backbone names
+        image_sizes: List of input image sizes
+
+    Returns:
+        A list of dictionnaries, one for each backbone and image size
+    """
+    results = []
+    for network in networks:
+        for image_size in image_sizes:
+            config = {'network': network, 'image_size': image_size}
+            configuration.finalize_grid_offsets(config, verbose=0)
+            flops, num_parameters = nets.get_model_complexity(config, nets.get_detection_outputs)
+            results.append({'network': network, 'image_size': image_size, 'num_cells': int(config['num_cells'][0]),
+                            'flops': int(flops), 'num_parameters': num_parameters})
+            print('   %s-%d: %.3f GFLOPs, %.3fM parameters, %dx%d cells' % (
+                network, image_size, flops / 1e9, num_parameters / 1e6, config['num_cells'][0], config['num_cells'][1]))
+    return results
+
+
+def benchmark_scaling(base_config, num_devices, gradient_reduction, num_warmup, num_runs):
+    """Measure the training throughput of the standard detector with synchronous data-parallel training.
+
+    Args:
+        base_config: Base configuration of the standard detector, as built by `build_base_config_from_args`
+        num_devices: Number of towers
+        gradient_reduction: Gradient reduction across towers, see `graph_manager.get_train_op`
+        num_warmup: Number of warmup training steps
+        num_runs: Number of timed training steps
+
+    Returns:
+        The number of training images per second
+    """
+    config = dict(base_config, num_gpus=num_devices, gradient_reduction=gradient_reduction,
+                  steps_per_run=1, gradient_accumulation_steps=1)
+    configuration.finalize_grid_offsets(config, verbose=0)
+    network = config['network']
+
+    graph = tf.Graph()
+    with graph.as_default():
+        forward_fn = tf.make_template(network, getattr(nets, network))
+        decode_fn = tf.make_template('decode', nets.get_detection_outputs)
+        forward_pass = partial(nets.forward, forward_fn=forward_fn, decode_fn=decode_fn)
+        with tf.name_scope('train'):
+            with tf.name_scope('inputs'):
+                inputs, _ = graph_manager.get_inputs(mode='train', verbose=False, **config)
+            for i in range(num_devices):
+                with tf.device('/%s:%d' % (config['device_type'], i)):
+                    with tf.name_scope('dev%d' % i):
+                        with tf.name_scope('feed_forward'):
+                            outputs = forward_pass(inputs[i]['image'], config, is_training=True)
+                        with tf.name_scope('losses'):
+                            graph_manager.add_losses_to_graph(
+                                loss_utils.get_standard_loss, inputs[i], outputs, config, is_chief=False)
+            with tf.name_scope('losses'):
+                losses = graph_manager.get_total_loss(with_summaries=False)
+            with tf.name_scope('train_op'):
+                tower_losses = None
+                if gradient_reduction != 'colocated':
+                    tower_losses = graph_manager.get_tower_losses(num_devices, scope='train/')
+                _, train_ops = graph_manager.get_train_op(losses, tower_losses=tower_losses, verbose=False, **config)
+        init_op = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
+
+    session_config = tf.ConfigProto(allow_soft_placement=True)
+    if config['device_type'] == 'cpu':
+        session_config.device_count['CPU'] = num_devices
+    with tf.Session(graph=graph, config=session_config) as sess:
+        sess.run(init_op)
+        for _ in range(num_warmup):
+            sess.run(train_ops)
+        start_time = time.time()
+        for _ in range(num_runs):
+            sess.run(train_ops)
+        return num_devices * config['batch_size'] * num_runs / (time.time() - start_time)
+
+
+if __name__ == '__main__':
+    ########################################################################## Configuration
+    parser = argparse.ArgumentParser(description='Speed and accuracy benchmarks.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    models_parser = subparsers.add_parser('models', help='Compare trained ODGI and standard models.')
+    models_parser.add_argument('--odgi_log_dir', type=str, action='append', default=[],
+                               help='Log directory of a trained ODGI model. Can be given several times.')
+    models_parser.add_argument('--standard_log_dir', type=str, action='append', default=[],
+                               help='Log directory of a trained standard model. Can be given several times.')
+    models_parser.add_argument('--split', type=str, default='test', choices=['val', 'test'],
+                               help='Split to collect images and evaluate the mAP on.')
+    models_parser.add_argument('--batch_sizes', type=str, default='1,4,8,16',
+                               help='Comma-separated batch sizes to measure throughput for.')
+    models_parser.add_argument('--num_warmup', type=int, default=5, help='Number of warmup runs.')
+    models_parser.add_argument('--num_runs', type=int, default=50, help='Number of timed runs.')
+    models_parser.add_argument('--skip_map', action='store_true', help='Do not evaluate the mAP.')
+    models_parser.add_argument('--coalesce_max_size', type=float,
+                               help='ODGI: merge the crops whose union fits in a square of this relative size.')
+    models_parser.add_argument('--compact_crops', action='store_true',
+                               help='ODGI: only run stage 2 on the non-empty crops.')
+    models_parser.add_argument('--latency_budget_ms', type=float,
+                               help='ODGI: only refine as many crops as this latency budget allows. '
+                               'Requires a latency model calibrated with the `calibrate` command.')
+    models_parser.add_argument('--latency_budget_per_batch', action='store_true',
+                               help='ODGI: the latency budget applies to the whole batch instead of to each image.')
+    models_parser.add_argument('--output', type=str, default='benchmark.json', help='Output JSON file.')
+
+    calibrate_parser = subparsers.add_parser('calibrate', help='Calibrate the latency model of trained ODGI models.')
+    calibrate_parser.add_argument('--odgi_log_dir', type=str, action='append', default=[],
+                                  help='Log directory of a trained ODGI model. Can be given several times.')
+    calibrate_parser.add_argument('--max_num_crops', type=int, 
+                                  help='Maximum number of crops to time stage 2 on. Defaults to twice `test_num_crops`.')
+    calibrate_parser.add_argument('--num_warmup', type=int, default=5, help='Number of warmup runs.')
+    calibrate_parser.add_argument('--num_runs', type=int, default=20, help='Number of timed runs.')
+    calibrate_parser.add_argument('--output', type=str, default='benchmark_latency_models.json', 
+                                  help='Output JSON file.')
+
+    backbones_parser = subparsers.add_parser('backbones', help='Complexity of the available backbones.')
+    backbones_parser.add_argument('--networks', type=str, 
+                                  help='Comma-separated backbones. Defaults to all the available ones.')
+    backbones_parser.add_argument('--image_sizes', type=str, default='256,512,1024',
+                                  help='Comma-separated input image sizes.')
+    backbones_parser.add_argument('--output', type=str, default='benchmark_backbones.json', help='Output JSON file.')
+
+    scaling_parser = subparsers.add_parser('scaling', help='Scaling efficiency of synchronous data-parallel training.')
+    configuration.build_base_parser(scaling_parser)
+    scaling_parser.add_argument('--num_devices', type=str, default='1,2,4',
+                                help='Comma-separated numbers of towers to measure the training throughput for.')
+    scaling_parser.add_argument('--reductions', type=str, default='colocated,ring,hierarchical',
+                                help='Comma-separated gradient reductions to compare.')
+    scaling_parser.add_argument('--num_warmup', type=int, default=5, help='Number of warmup steps.')
+    scaling_parser.add_argument('--num_runs', type=int, default=20, help='Number of timed steps.')
+    scaling_parser.add_argument('--output', type=str, default='benchmark_scaling.json', help='Output JSON file.')
+    args = parser.parse_args()
+
+    ########################################################################## Run
+    if args.command == 'models':
+        assert len(args.odgi_log_dir) + len(args.standard_log_dir) > 0, 'No model to benchmark'
+        batch_sizes = parse_list(args.batch_sizes)
+        benchmarks = {'date': datetime.now().strftime("%Y-%m-%d %H:%M"),
+                      'tensorflow_version': tf.__version__,
+                      'split': args.split,
+                      'models': []}
+        inference_options = {}
+        if args.coalesce_max_size is not None:
+            inference_options['test_patch_coalesce_max_size'] = args.coalesce_max_size
+        if args.compact_crops:
+            inference_options['test_compact_crops'] = True
+        if args.latency_budget_ms is not None:
+            inference_options['test_latency_budget_ms'] = args.latency_budget_ms
+            inference_options['test_latency_budget_per_batch'] = args.latency_budget_per_batch
+        for build_fn, log_dirs in [
+                (partial(inference_utils.build_odgi_model, inference_options=inference_options), args.odgi_log_dir),
+                (lambda log_dir, _: inference_utils.build_standard_model(log_dir), args.standard_log_dir)]:
+            for log_dir in log_dirs:
+                print('\nBenchmarking \033[36m%s\033[0m' % log_dir)
+                benchmarks['models'].append(benchmark_model(
+                    build_fn, log_dir, args.split, batch_sizes, args.num_warmup, args.num_runs,
+                    with_map=not args.skip_map))
+    elif args.command == 'calibrate':
+        assert len(args.odgi_log_dir) > 0, 'No model to calibrate'
+        benchmarks = {'date': datetime.now().strftime("%Y-%m-%d %H:%M"),
+                      'tensorflow_version': tf.__version__,
+                      'latency_models': {}}
+        for log_dir in args.odgi_log_dir:
+            print('\nCalibrating \033[36m%s\033[0m' % log_dir)
+            max_num_crops = args.max_num_crops
+            if max_num_crops is None:
+                max_num_crops = 2 * graph_manager.load_stages_configs(log_dir)[1]['test_num_crops']
+            benchmarks['latency_models'][os.path.abspath(log_dir)] = calibrate_latency_model(
+                log_dir, max_num_crops, args.num_warmup, args.num_runs)
+    elif args.command == 'backbones':
+        networks = args.networks.split(',') if args.networks is not None else [
+            x for x in configuration.NETWORKS if not x.startswith('mobilenet') or hasattr(nets, 'mobilenet_v2')]
+        benchmarks = {'date': datetime.now().strftime("%Y-%m-%d %H:%M"),
+                      'tensorflow_version': tf.__version__,
+                      'backbones': backbones_complexity(networks, parse_list(args.image_sizes))}
+    elif args.command == 'scaling':
+        base_config = configuration.build_base_config_from_args(args, verbose=0)
+        base_config['image_size'] = args.image_size
+        num_devices = sorted(set([1] + parse_list(args.num_devices)))
+        benchmarks = {'date': datetime.now().strftime("%Y-%m-%d %H:%M"),
+                      'tensorflow_version': tf.__version__,
+                      'network': '%s-%d' % (args.network, args.image_size),
+                      'device_type': args.device_type,
+                      'batch_size_per_device': args.batch_size,
+                      'scaling': []}
+        # One tower does not reduce gradients: shared baseline for all reductions
+        print('\nBenchmarking 1 %s device' % args.device_type)
+        baseline = benchmark_scaling(base_config, 1, 'colocated', args.num_warmup, args.num_runs)
+        print('   %.2f images/s' % baseline)
+        for reduction in args.reductions.split(','):
+            for n in num_devices:
+                throughput = baseline if n == 1 else benchmark_scaling(
+                    base_config, n, reduction, args.num_warmup, args.num_runs)
+                benchmarks['scaling'].append({'gradient_reduction': reduction,
+                                              'num_devices': n,
+                                              'images_per_second': throughput,
+                                              'scaling_efficiency': throughput / (n * baseline)})
+                print('   %s, %d %s devices: %.2f images/s - scaling efficiency %.1f%%' % (
+                    reduction, n, args.device_type, throughput, 100. * throughput / (n * baseline)))
+    else:
+        parser.print_help()
+        raise SystemExit
+
+    with open(args.output, 'w') as f:
+        json.dump(benchmarks, f, indent=2, sort_keys=True)
+    print('\nBenchmark results saved in \033[36m%s\033[0m' % args.output)
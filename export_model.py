@@ -0,0 +1,85 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import argparse
+import time
+
+import tensorflow as tf
+print("Tensorflow version", tf.__version__)
+
+from include import graph_manager
+from include import inference_utils
+
+
+if __name__ == '__main__':
+    ########################################################################## Configuration
+    parser = argparse.ArgumentParser(description='Export a trained model as a standalone SavedModel for inference.')
+    parser.add_argument('log_dir', type=str, help='Log directory of a trained ODGI or standard model.')
+    parser.add_argument('--output_dir', type=str, help='Export directory. Defaults to `log_dir/saved_model`.')
+    parser.add_argument('--batch_size', type=int, default=1, help='Maximum number of images per batch (ODGI).')
+    parser.add_argument('--coalesce_max_size', type=float,
+                        help='ODGI: merge overlapping crops whose union fits in a square of this relative size.')
+    parser.add_argument('--compact_crops', action='store_true', help='ODGI: only run stage 2 on the non-empty crops.')
+    parser.add_argument('--skip_optimization', action='store_true',
+                        help='Export the frozen graph without the `optimize_graph.py` optimizations.')
+    parser.add_argument('--split', type=str, default='val', choices=['val', 'test'],
+                        help='Split to collect the parity check images from.')
+    parser.add_argument('--num_images', type=int, default=16, help='Number of images for the parity check.')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='Maximum absolute difference between the original and exported outputs.')
+    args = parser.parse_args()
+    if args.output_dir is None:
+        args.output_dir = os.path.join(args.log_dir, 'saved_model')
+    assert not os.path.exists(args.output_dir), 'The export directory %s already exists' % args.output_dir
+    is_odgi = os.path.exists(os.path.join(args.log_dir, 'stage1_config.pkl'))
+
+    ########################################################################## Inference graph only
+    graph = tf.Graph()
+    with graph.as_default():
+        if is_odgi:
+            inference_options = {}
+            if args.coalesce_max_size is not None:
+                inference_options['test_patch_coalesce_max_size'] = args.coalesce_max_size
+            if args.compact_crops:
+                inference_options['test_compact_crops'] = True
+            model = inference_utils.build_odgi_model(args.log_dir, args.batch_size,
+                                                     inference_options=inference_options)
+        else:
+            model = inference_utils.build_standard_model(args.log_dir)
+        with tf.name_scope('inputs'):
+            inputs, initializer = graph_manager.get_inputs(
+                mode=args.split, verbose=False, **dict(model['config'], batch_size=args.batch_size))
+            inputs = inputs[0]
+        saver = tf.train.Saver()
+
+    print('\nExporting \033[36m%s\033[0m' % model['name'])
+    with tf.Session(graph=graph) as sess:
+        checkpoint_path = tf.train.latest_checkpoint(args.log_dir)
+        assert checkpoint_path is not None, 'No checkpoint found in %s' % args.log_dir
+        saver.restore(sess, checkpoint_path)
+        pool = inference_utils.collect_images(sess, inputs['image'], initializer, args.num_images)[:args.num_images]
+        original_outputs, _ = inference_utils.run_outputs(
+            sess, model['images'], model['outputs'], pool, args.batch_size)
+        graph_def, input_name, output_names = inference_utils.freeze_model(sess, model)
+    if not args.skip_optimization:
+        graph_def = inference_utils.optimize_inference_graph(graph_def, [input_name], output_names)
+
+    # The exported graph must give the same detections as the original one
+    with tf.Graph().as_default() as exported_graph:
+        images, outputs = inference_utils.import_inference_graph(graph_def, input_name=input_name)
+    with tf.Session(graph=exported_graph) as sess:
+        exported_outputs, _ = inference_utils.run_outputs(sess, images, outputs, pool, args.batch_size)
+    report = inference_utils.check_parity(original_outputs, exported_outputs, args.tolerance, 
+                                          names=model['outputs_keys'])
+    assert all(x[1] for x in report), 'The exported graph outputs differ from the original ones'
+    inference_utils.export_saved_model(graph_def, input_name, model['outputs_keys'], args.output_dir)
+
+    ########################################################################## Check the exported model
+    graph = tf.Graph()
+    with tf.Session(graph=graph) as sess:
+        start_time = time.time()
+        images, outputs = inference_utils.load_saved_model(sess, args.output_dir)
+        load_time = time.time() - start_time
+        outputs_ = sess.run(outputs, feed_dict={images: pool[:1]})
+    print('\n    %d nodes, loaded in %.2fs' % (len(graph.as_graph_def().node), load_time))
+    print('\n'.join('    \033[32m%s\033[0m: %s' % (k, v.shape) for k, v in sorted(outputs_.items())))
+    print('\nSavedModel exported in \033[36m%s\033[0m' % args.output_dir)
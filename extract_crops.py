@@ -0,0 +1,126 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import argparse
+import pickle
+import time
+
+import tensorflow as tf
+print("Tensorflow version", tf.__version__)
+
+from include import graph_manager
+from include import tfrecords_utils
+from include import viz
+
+
+if __name__ == '__main__':
+    ########################################################################## Configuration
+    parser = argparse.ArgumentParser(description='Extract the stage 2 training crops from a frozen stage 1.')
+    parser.add_argument('log_dir', type=str, help='Log directory of a trained ODGI model.')
+    parser.add_argument('--split', type=str, default='train', choices=['train', 'val', 'test'],
+                        help='Split to extract crops from.')
+    parser.add_argument('--output_dir', type=str, help='Output directory. Defaults to `log_dir/crops_split`.')
+    parser.add_argument('--num_shards', type=int, default=8, help='Number of TFRecords shards to write.')
+    parser.add_argument('--batch_size', type=int, help='Stage 1 batch size. Defaults to the training one.')
+    parser.add_argument('--verbose', type=int, default=1, help='Extra verbosity')
+    args = parser.parse_args()
+    if args.output_dir is None:
+        args.output_dir = os.path.join(args.log_dir, 'crops_%s' % args.split)
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    stages_configs = graph_manager.load_stages_configs(args.log_dir)
+    for config in stages_configs:
+        config['num_gpus'] = 1
+    if args.batch_size is not None:
+        graph_manager.set_inference_batch_size(stages_configs, args.batch_size)
+    stage1_config, stage2_config = stages_configs[:2]
+    assert stage2_config['network'] != 'roi_head', 'The RoI head runs on stage 1 features, not on image crops'
+    # Output every crop directly instead of batching them in a queue
+    stage2_config = dict(stage2_config, batch_size=None)
+
+    # Read the requested split in deterministic (inference) order
+    image_folder = stage1_config['image_folder']
+    try:
+        image_folder = image_folder % args.split
+    except TypeError:
+        pass
+    split_config = dict(stage1_config, image_folder=image_folder,
+                        test_tfrecords=stage1_config['%s_tfrecords' % args.split],
+                        test_max_num_bbs=stage1_config['%s_max_num_bbs' % args.split])
+
+    tee = viz.Tee(filename='extract_crops_log.txt')
+
+    ########################################################################## Build the graph
+    stages = graph_manager.get_odgi_stages(stages_configs, verbose=args.verbose)
+    name, network_name, forward_pass, _, _ = stages[0]
+
+    with tf.name_scope('extract'):
+        with tf.name_scope('inputs'):
+            inputs, initializer = graph_manager.get_inputs(mode='test', verbose=False, **split_config)
+            inputs = inputs[0]
+
+        with tf.name_scope(name):
+            stage_outputs = forward_pass(inputs['image'], stage1_config, is_training=False, verbose=args.verbose)
+
+        # Same crops as during training
+        with tf.name_scope('stage_transition'):
+            crops = graph_manager.stage_transition(inputs, stage_outputs, 'train', stage2_config, verbose=args.verbose)
+
+        with tf.name_scope('format_crops'):
+            crop_boxes = tf.reshape(stage_outputs['crop_boxes'], (-1, 4))
+            is_valid_crop = tf.logical_and(crop_boxes[:, 2] > crop_boxes[:, 0], crop_boxes[:, 3] > crop_boxes[:, 1])
+            images = tf.image.convert_image_dtype(crops['image'], tf.uint8, saturate=True)
+            crops['image'] = tf.map_fn(tf.image.encode_png, images, dtype=tf.string, back_prop=False)
+            if 'class_labels' in crops:
+                crops['classes'] = tf.argmax(crops.pop('class_labels'), axis=-1)
+            crops = {key: tf.boolean_mask(crops[key], is_valid_crop) for key in [
+                'im_id', 'image', 'num_boxes', 'bounding_boxes', 'obj_i_mask_bbs', 'classes'] if key in crops}
+
+    ########################################################################## Start Session
+    shard_paths = [os.path.abspath(os.path.join(args.output_dir, 'crops-%05d-of-%05d' % (i, args.num_shards)))
+                   for i in range(args.num_shards)]
+    writers = [tf.python_io.TFRecordWriter(path) for path in shard_paths]
+    saver = tf.train.Saver()
+    num_crops = 0
+    num_images = 0
+    with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+        checkpoint_path = tf.train.latest_checkpoint(args.log_dir)
+        assert checkpoint_path is not None, 'No checkpoint found in %s' % args.log_dir
+        print('\nRestoring weights from \033[36m%s\033[0m' % checkpoint_path)
+        saver.restore(sess, checkpoint_path)
+        sess.run(tf.local_variables_initializer())
+
+        print('Extracting crops from the %s split' % args.split)
+        start_time = time.time()
+        sess.run(initializer)
+        try:
+            while 1:
+                inputs_, crops_ = sess.run([inputs['im_id'], crops])
+                num_images += inputs_.shape[0]
+                for i in range(crops_['im_id'].shape[0]):
+                    example = tf.train.Example(features=tf.train.Features(feature=tfrecords_utils.write_tfrecords(
+                        [(key, value[i]) for key, value in crops_.items()])))
+                    writers[num_crops % args.num_shards].write(example.SerializeToString())
+                    num_crops += 1
+        except tf.errors.OutOfRangeError:
+            pass
+    for writer in writers:
+        writer.close()
+    print('   %d crops from %d images (%.2f crops/image) in %.2fs' % (
+        num_crops, num_images, num_crops / max(1, num_images), time.time() - start_time))
+
+    ########################################################################## Dataset description
+    crops_config = {'tfrecords': shard_paths,
+                    'num_samples': num_crops,
+                    'max_num_bbs': stage1_config['%s_max_num_bbs' % args.split],
+                    'image_size': stage2_config['image_size'],
+                    'num_cells': tuple(int(x) for x in stage2_config['grid_offsets'].shape[:2]),
+                    'with_classes': 'classes' in crops,
+                    'stage1_network': network_name,
+                    'stage1_image_size': stage1_config['image_size'],
+                    'stage1_checkpoint': os.path.abspath(checkpoint_path),
+                    'split': args.split}
+    with open(os.path.join(args.output_dir, 'crops_config.pkl'), 'wb') as f:
+        pickle.dump(crops_config, f)
+    print('\nCrops dataset saved in \033[36m%s\033[0m' % args.output_dir)
+    viz.save_tee(args.output_dir, tee)
@@ -13,9 +13,12 @@ _defaults_dict = {
     "with_offsets": False,                                 # If True, and with_groups is True, use learned offsets
     "offsets_margin": 0.025,                               # Additional margins to train the offsets
     "with_classification": False,                          # If True, output class scores
+    "with_roi_features": False,                            # If True, also output the backbone stride 16 features
+    "roi_sampling_ratio": 2,                               # Number of bilinear samples per RoI-aligned bin (along each axis)
     # Inputs
     "batch_size": 12,
     "image_size": 1024,                                    # Input Image Size
+    "train_crop_scale_size": None,                         # If set, train on random `image_size` windows of the images at this size
     "shuffle_buffer": 10000,                               # Shuffle buffer size
     "data_augmentation_threshold": 0.5,                    # Data augmentation (flip left/right) ratio
     "num_threads": 4,                                      # Number of parallel readers for the dataset map operationa
@@ -24,6 +27,12 @@ _defaults_dict = {
     "learning_rate": 1e-3,                                 # Initial learning rate
     "num_epochs": 100,                                     # Number of training epochs
     "num_gpus": 1,                                         # Number of gpus to use
+    "device_type": "gpu",                                  # Type of the towers devices, 'gpu' or (virtual) 'cpu'
+    "gradient_reduction": "colocated",                     # 'colocated', or reduction: 'ring' or 'hierarchical'
+    "all_reduce_group_size": 2,                            # Number of towers per group for 'hierarchical' reduction
+    "average_bn_updates": False,                           # If True, average the batch norm moving averages updates over towers
+    "worker_hosts": None,                                  # List of host:port of the worker processes (distributed)
+    "task_index": 0,                                       # Index of the current worker process. 0 is the chief
     "gpu_mem_frac": 1.0,                                   # Memory usage per gpu
     "optimizer": "ADAM",                                   # 'ADAM' or 'MOMENTUM'
     "beta1": 0.9,                                          # If using ADAM optimizer
@@ -43,11 +52,22 @@ _defaults_dict = {
     "train_patch_confidence_threshold": 0.0,               # Only keep boxes above this threshold for patch extraction
     "train_patch_nms_threshold": 1.0,                      # IoU threshold for non-maximum suppression during patch extraction
     "patch_intersection_ratio_threshold": 0.33,            # Only keep gt box in the pach if at least this ratio is visible
+    "train_crop_sampler": False,                           # If True, diversity-aware sampling of the stage 2 training crops
+    "train_crop_sampler_nms_threshold": 0.5,               # IoU threshold for suppressing near-duplicate training crops
+    "train_crop_sampler_positive_ratio": 0.75,             # Ratio of training crops containing ground-truth boxes
+    "train_crop_sampler_momentum": 0.9,                    # Momentum of the running stage 2 loss per number of boxes in a crop
+    "track_crop_difficulty": False,                        # Whether the stage updates the crops sampler difficulty estimates
     # Patch Extraction (inference)
     "test_num_crops": 5,                                   # Maximum number of crops per image to predict (eval)
     "test_patch_nms_threshold": 0.25,                      # IoU threshold for non-maximum suppression during patch extraction
     "test_patch_confidence_threshold": 0.25,               # Only keep boxes above this threshold for patch extraction
     "test_patch_strong_confidence_threshold": 0.75,        # boxes considered 'single' and above this threshold -> no patch
+    "test_patch_coalesce_max_size": None,                  # If set, merge crops whose union fits in a square of this (relative) size
+    "test_compact_crops": False,                           # If True, only run the next stage on the non-empty crops
+    "test_latency_budget_ms": None,                        # If set, only refine as many crops as this latency budget allows
+    "test_latency_budget_per_batch": False,                # If True, the latency budget is shared by the whole batch
+    "test_latency_model": None,                            # Calibrated cost model of the cascade (see `benchmark.py calibrate`)
+    "test_latency_group_priority": 1.0,                    # Weight of the group flag when ranking crops under a latency budget
     # Summary and Outputs
     "base_log_dir": "./run_logs",                          # Base log directory
     "max_to_keep": 1,                                      # maximum number of checkpoints to keep
@@ -58,6 +78,20 @@ _defaults_dict = {
     "retrieval_confidence_threshold": 0.,                  # Only keep boxes above this threshold for evaluation
     "retrieval_iou_threshold": [0.5, 0.75],                # Evaluate at these IoU retrieval threshold
     "retrieval_nms_threshold": 0.5,                        # IoU threshold for the Non-maximum suppression during evaluation
+    "eval_num_workers": 2,                                 # Number of workers for evaluation post-processing (0: sequential)
+    "eval_worker_type": "thread",                          # Post-processing workers: 'thread' or 'process'
+    "eval_queue_size": 8,                                  # Maximum number of evaluated batches waiting for post-processing
+    "recompute_blocks": None,                              # Backbone blocks recomputed in the backward pass, or 'all'
+    "gradient_accumulation_steps": 1,                      # Number of micro-batches to accumulate gradients over
+    "resolution_schedule": None,                           # List of (image_size, end_epoch) phases trained before `image_size`
+    "steps_per_run": 1,                                    # Number of training steps per `sess.run` (in-graph loop)
+    "importance_sampling_ratio": None,                     # If set, loss-aware sampling of the training images, with this uniform ratio
+    "importance_sampling_momentum": 0.9,                   # Momentum of the running per-image losses
+    "fast_validation_ratio": None,                         # If set, mid-training validation on this ratio of the val split
+    "fast_validation_num_strata": 4,                       # Strata (quantiles of the number of boxes) for subset sampling
+    "fast_validation_num_bootstraps": 1000,                # Number of bootstrap resamplings for the confidence interval
+    "fast_validation_confidence": 0.95,                    # Confidence level of the interval
+    "fast_validation_margin": 0.,                          # Full pass if the upper bound is above best_map - margin
 }
 
 
@@ -105,14 +139,41 @@ def get_defaults(kwargs, args, verbose=0):
     return output
 
 
+""" Compact backbones family (see `nets.compact`): width and depth multipliers of each variant"""
+COMPACT_NETWORKS = {'compact_w%d_d%d' % (100 * width, depth): (width, depth) 
+                    for width in [1.0, 0.75, 0.5, 0.35] for depth in [1, 2]}
+
+""" Available backbones"""
+NETWORKS = ['tiny_yolo_v2', 'yolo_v2', 'mobilenet_100', 'mobilenet_50', 'mobilenet_35'] + sorted(COMPACT_NETWORKS)
+
+
 def build_base_parser(parser):
     """Base parser for common line arguments"""
     parser.add_argument('data', type=str, help='Dataset.', choices=[
         'vedai_fold%02d' % i for i in range(1, 11)] + ['sdd'])
-    parser.add_argument('--network', type=str, default="tiny_yolo_v2", help='Architecture."',
-                        choices=['tiny_yolo_v2', 'yolo_v2', 'mobilenet_100', 'mobilenet_50', 'mobilenet_35'])
+    parser.add_argument('--network', type=str, default="tiny_yolo_v2", help='Architecture."', choices=NETWORKS)
     parser.add_argument('--image_size', default=1024, type=int, help='Size of input images')
+    parser.add_argument('--train_crop_scale_size', type=int, 
+                        help='If given, train on random `image_size` windows of the images resized to this size, '
+                             'instead of the whole images. Evaluation still uses the whole images')
+    parser.add_argument('--resolution_schedule', type=str, 
+                        help='Progressive resizing: comma-separated size:epoch phases (e.g. 256:2,384:4) trained '
+                             'at the given input size until the given epoch, before switching to `image_size`')
     parser.add_argument('--num_gpus', type=int, default=1, help='Number of GPUs workers to use')
+    parser.add_argument('--device_type', type=str, default='gpu', choices=['gpu', 'cpu'],
+                        help='Place the towers on GPUs, or on `num_gpus` virtual CPU devices')
+    parser.add_argument('--gradient_reduction', type=str, default='colocated', 
+                        choices=['colocated', 'ring', 'hierarchical'],
+                        help='Differentiate the loss averaged over towers, or reduce the per-tower gradients')
+    parser.add_argument('--all_reduce_group_size', type=int, default=2, 
+                        help='Number of towers per group for the hierarchical reduction')
+    parser.add_argument('--average_bn_updates', action='store_true', 
+                        help='Update the batch norm moving averages once per step from the moments averaged over '
+                        'towers. Each tower still normalizes its batch with its own moments')
+    parser.add_argument('--worker_hosts', type=str, 
+                        help='Comma-separated host:port of the worker processes, for multi-process training')
+    parser.add_argument('--task_index', type=int, default=0, 
+                        help='Index of this process in `worker_hosts`. The chief (0) builds and runs the graph')
     parser.add_argument('--gpu_mem_frac', type=float, default=1., help='Memory fraction to use for each GPU')
     parser.add_argument('--batch_size', type=int, default=12, help='Batch size')
     parser.add_argument('--learning_rate', type=float, default=1e-3, help='Learning rate')
@@ -120,6 +181,30 @@ def build_base_parser(parser):
     parser.add_argument('--display_loss_every_n_steps', type=int, default=250, help='Print the loss at every given step')
     parser.add_argument('--save_evaluation_steps', type=int, help='Evaluate validation set at every given step')
     parser.add_argument('--save_summaries_steps', type=int, help='Save summaries tensorboards at every given step')
+    parser.add_argument('--recompute_blocks', type=str, 
+                        help='Comma-separated backbone blocks (e.g. conv1,conv2) or `all`, whose activations are '
+                             'recomputed during the backward pass instead of being stored')
+    parser.add_argument('--gradient_accumulation_steps', type=int, default=1,
+                        help='Accumulate gradients over the given number of batches before each update')
+    parser.add_argument('--train_num_crops', type=int, 
+                        help='Number of crops per image to train the second stage on. Defaults depend on the network')
+    parser.add_argument('--train_crop_sampler', action='store_true', 
+                        help='Sample the stage 2 training crops without near-duplicates, with a fixed ratio of crops '
+                             'containing ground-truth, and favouring the crops on which stage 2 does badly')
+    parser.add_argument('--train_crop_sampler_positive_ratio', type=float, default=0.75,
+                        help='Ratio of the stage 2 training crops containing ground-truth boxes')
+    parser.add_argument('--steps_per_run', type=int, default=1,
+                        help='Number of training steps run in each session call, with an in-graph loop. '
+                             '`save_summaries_steps` is scaled accordingly')
+    parser.add_argument('--importance_sampling_ratio', type=float, 
+                        help='If given, draw the training images with a probability proportional to their running '
+                             'loss, mixed with a uniform distribution of this weight')
+    parser.add_argument('--fast_validation_ratio', type=float, 
+                        help='If given, mid-training validation on a stratified subset of this ratio of the val split')
+    parser.add_argument('--autotune_memory_budget', type=float, 
+                        help='If given, pre-flight search of the fastest batch settings fitting this memory (in GB)')
+    parser.add_argument('--autotune_batch_sizes', type=str, default='4,8,12,16,24,32',
+                        help='Comma-separated batch sizes tried by the autotuner')
     parser.add_argument('--verbose', type=int, default=2, help='Extra verbosity')
 
 
@@ -138,7 +223,10 @@ def load_metadata(filename):
             key, values = line.split('\t', 1)
             if key in ['data_classes', 'feature_keys']:
                 metadata[key] = values.split(',')
-            elif key.endswith('tfrecords') or key == 'image_folder':
+            elif key.endswith('tfrecords'):
+                # Comma-separated list of TFRecords shards
+                metadata[key] = values.split(',') if ',' in values else values
+            elif key == 'image_folder':
                 metadata[key] = values
             else:
                 metadata[key] = int(values)
@@ -153,6 +241,29 @@ def build_base_config_from_args(args, verbose=0):
     configuration['save_summaries_steps'] = args.save_summaries_steps
     configuration['save_evaluation_steps'] = 500 if args.save_evaluation_steps is None else args.save_evaluation_steps
     configuration['num_epochs'] = _defaults_dict['num_epochs'] if args.num_epochs is None else args.num_epochs
+    configuration['fast_validation_ratio'] = args.fast_validation_ratio
+    configuration['importance_sampling_ratio'] = args.importance_sampling_ratio
+    configuration['train_crop_scale_size'] = args.train_crop_scale_size
+    configuration['train_crop_sampler'] = args.train_crop_sampler
+    configuration['train_crop_sampler_positive_ratio'] = min(1., max(0., args.train_crop_sampler_positive_ratio))
+    configuration['steps_per_run'] = max(1, args.steps_per_run)
+    # The summaries interval counts session calls, so that they do not interrupt every in-graph loop
+    if configuration['save_summaries_steps'] is not None:
+        configuration['save_summaries_steps'] *= configuration['steps_per_run']
+    configuration['gradient_accumulation_steps'] = max(1, args.gradient_accumulation_steps)
+    configuration['recompute_blocks'] = (args.recompute_blocks if args.recompute_blocks in [None, 'all'] 
+                                         else args.recompute_blocks.split(','))
+    assert configuration['steps_per_run'] == 1 or configuration['gradient_accumulation_steps'] == 1, \
+        'The in-graph training loop does not support gradient accumulation'
+    configuration['resolution_schedule'] = None
+    if args.resolution_schedule is not None:
+        configuration['resolution_schedule'] = [tuple(int(x) for x in phase.split(':')) 
+                                                for phase in args.resolution_schedule.split(',')]
+        end_epochs = [x[1] for x in configuration['resolution_schedule']]
+        assert end_epochs == sorted(end_epochs) and end_epochs[-1] < configuration['num_epochs'], \
+            'The resolution schedule phases should end at increasing epochs, before the end of training'
+        assert configuration['gradient_accumulation_steps'] == 1, \
+            'The resolution schedule does not support gradient accumulation'
     configuration['setting'] = args.data
     configuration['exp_name'] = args.data
     configuration['image_format'] = 'vedai' if args.data.startswith('vedai') else args.data
@@ -185,6 +296,10 @@ def build_base_config_from_args(args, verbose=0):
         configuration['train_num_crops'] = 6
     elif args.network.startswith('mobilenet'):
         configuration['train_num_crops'] = 10
+    elif args.network.startswith('compact'):
+        configuration['train_num_crops'] = 10
+    if args.train_num_crops is not None:
+        configuration['train_num_crops'] = args.train_num_crops
 
     ## Metadata
     tfrecords_path = 'Data/metadata_%s.txt'
@@ -197,6 +312,15 @@ def build_base_config_from_args(args, verbose=0):
 
     ## GPUs
     configuration['num_gpus'] = args.num_gpus
+    configuration['worker_hosts'] = args.worker_hosts.split(',') if args.worker_hosts else None
+    configuration['task_index'] = args.task_index
+    if configuration['worker_hosts']:
+        # `num_gpus` devices per worker
+        configuration['num_gpus'] = args.num_gpus * len(configuration['worker_hosts'])
+    configuration['device_type'] = args.device_type
+    configuration['gradient_reduction'] = args.gradient_reduction
+    configuration['all_reduce_group_size'] = max(1, args.all_reduce_group_size)
+    configuration['average_bn_updates'] = args.average_bn_updates
     configuration['gpu_mem_frac'] = max(0., min(1., args.gpu_mem_frac))
 
     ## Training
@@ -204,13 +328,7 @@ def build_base_config_from_args(args, verbose=0):
     configuration['learning_rate'] = args.learning_rate
 
     ## Pre-compute number of steps per epoch for loss display
-    for split in ['train', 'val', 'test']:
-        configuration['%s_num_samples' % split] = configuration['%s_num_samples' % split]
-        configuration['%s_num_samples_per_iter' % split] = configuration['batch_size'] * configuration['num_gpus']
-        configuration['%s_num_iters_per_epoch' % split] = int(np.ceil(
-            configuration['%s_num_samples' % split] / configuration['%s_num_samples_per_iter' % split]))
-        print('%d %s samples (%d iters per epoch)' % (
-            configuration['%s_num_samples' % split], split, configuration['%s_num_iters_per_epoch' % split]))
+    set_batch_size(configuration, args.batch_size)
 
     ## Print final config (except for grid_offsets)
     if verbose == 2:
@@ -228,6 +346,51 @@ def build_base_config_from_args(args, verbose=0):
     return configuration
 
 
+def set_batch_size(configuration, batch_size, verbose=True):
+    """Set the batch size (per device) and the corresponding number of iterations per epoch for each split.
+
+    Args:
+        configuration dictionary
+        batch_size: Batch size per device
+        verbose: Whether to print the number of iterations per epoch
+    """
+    configuration['batch_size'] = batch_size
+    for split in ['train', 'val', 'test']:
+        configuration['%s_num_samples_per_iter' % split] = configuration['batch_size'] * configuration['num_gpus']
+        configuration['%s_num_iters_per_epoch' % split] = int(np.ceil(
+            configuration['%s_num_samples' % split] / configuration['%s_num_samples_per_iter' % split]))
+        if verbose:
+            print('%d %s samples (%d iters per epoch)' % (
+                configuration['%s_num_samples' % split], split, configuration['%s_num_iters_per_epoch' % split]))
+
+
+def get_resolution_phases_configs(configuration, schedule_image_size=None):
+    """Configurations of the phases of the progressive resolution schedule, trained before the target image size.
+    Each input pipeline covers its phase with one spare epoch, so that it is not exhausted before the switch.
+
+    Args:
+        configuration dictionary, with the target `image_size`
+        schedule_image_size: Target size the schedule sizes refer to. Defaults to the configuration `image_size`. 
+            Otherwise (e.g. for the second stage), the phase sizes are scaled by the same ratio
+
+    Returns:
+        A list of configuration dictionaries, one per phase, and the number of epochs of the target phase
+    """
+    image_size = configuration['image_size']
+    if schedule_image_size is None:
+        schedule_image_size = image_size
+    configs = []
+    start_epoch = 0
+    for phase_size, end_epoch in configuration['resolution_schedule']:
+        # Multiple of the backbones stride
+        phase_size = max(32, int(round(phase_size * image_size / schedule_image_size / 32.)) * 32)
+        config = dict(configuration, image_size=phase_size, num_epochs=end_epoch - start_epoch + 1)
+        finalize_grid_offsets(config, verbose=0)
+        configs.append(config)
+        start_epoch = end_epoch
+    return configs, configuration['num_epochs'] - start_epoch
+
+
 def finalize_grid_offsets(configuration, verbose=2):
     """Setthe current number of cells and grid offset, given the
        input image resolution.
@@ -242,6 +405,11 @@ def finalize_grid_offsets(configuration, verbose=2):
         configuration['num_cells'] = _get_num_cells(image_size, 5)
     elif network.startswith('mobilenet'):
         configuration['num_cells'] = _get_num_cells(image_size, 5)
+    elif network.startswith('compact'):
+        configuration['num_cells'] = _get_num_cells(image_size, 5)
+    elif network == 'roi_head':
+        # `image_size` is the equivalent input resolution of the crops
+        configuration['num_cells'] = _get_num_cells(image_size, 5)
     else:
         raise NotImplementedError('Unknown network architecture', network)
     configuration['grid_offsets'] = precompute_grid_offsets(configuration['num_cells'])
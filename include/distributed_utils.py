@@ -0,0 +1,173 @@
+from collections import OrderedDict
+
+import tensorflow as tf
+
+
+"""Utils for synchronous data-parallel training: gradients reduction across towers, aggregation
+   of the batch norm statistics updates and multi-process clusters."""
+
+
+#################################################### Cluster
+def start_server(worker_hosts, task_index=0, num_gpus=1, device_type='gpu', **kwargs):
+    """Start the in-process server of the current worker. The chief (task 0) is the only client: it builds the 
+    graph and places the towers and input pipelines on every worker (in-graph replication). The other workers 
+    only serve their devices: this function blocks on their server and exits the process once it stops, so 
+    that they never build the graph.
+
+    Args:
+        worker_hosts: List of host:port of all workers
+        task_index: Index of the current worker
+        num_gpus: Total number of towers, evenly split across workers
+        device_type: Type of the towers devices. If `cpu`, each worker creates one virtual CPU device per tower
+
+    Returns:
+        The tf.train.Server of the chief
+    """
+    del kwargs
+    cluster = tf.train.ClusterSpec({'worker': worker_hosts})
+    config = tf.ConfigProto(allow_soft_placement=True)
+    if device_type == 'cpu':
+        config.device_count['CPU'] = num_gpus // len(worker_hosts)
+    server = tf.train.Server(cluster, job_name='worker', task_index=task_index, config=config)
+    if task_index > 0:
+        print('Worker %d serving its devices to the chief' % task_index)
+        server.join()
+        raise SystemExit
+    return server
+
+
+#################################################### Gradients reduction
+def ring_reduce(tensors, device):
+    """Sum the given tensors, one per tower, with the reduce-scatter phase of a ring all-reduce: each tensor is
+    split in as many chunks as there are towers, which are summed along the ring of devices in
+    `num_towers - 1` steps, each step only transferring one chunk between consecutive devices. The summed
+    chunks are then gathered on `device`, rather than broadcast back to every tower, since the towers share
+    a single copy of the variables.
+
+    Args:
+        tensors: A list of Tensors with the same shape, each one placed on a different device
+        device: Device of the output, for instance the device of the corresponding variable
+
+    Returns:
+        The summed Tensor, placed on `device`
+    """
+    num_towers = len(tensors)
+    if num_towers == 1:
+        with tf.device(device):
+            return tf.identity(tensors[0])
+    devices = [x.device for x in tensors]
+    shape = tf.shape(tensors[0])
+
+    # Flatten and split each tensor in `num_towers` chunks
+    chunks = []
+    for tower_device, tensor in zip(devices, tensors):
+        with tf.device(tower_device):
+            flat = tf.reshape(tensor, (-1,))
+            size = tf.size(flat)
+            padding = (num_towers - size % num_towers) % num_towers
+            flat = tf.pad(flat, [[0, padding]])
+            chunks.append(tf.split(flat, num_towers, axis=0))
+
+    # Reduce-scatter: after this step, tower i holds the sum of chunk (i + 1) % num_towers
+    for step in range(num_towers - 1):
+        new_chunks = [list(x) for x in chunks]
+        for i in range(num_towers):
+            c = (i - step) % num_towers
+            target = (i + 1) % num_towers
+            with tf.device(devices[target]):
+                new_chunks[target][c] = chunks[target][c] + chunks[i][c]
+        chunks = new_chunks
+
+    # Gather the summed chunks
+    with tf.device(device):
+        flat = tf.concat([chunks[(c - 1) % num_towers][c] for c in range(num_towers)], axis=0)
+        return tf.reshape(flat[:tf.reduce_prod(shape)], shape)
+
+
+def hierarchical_reduce(tensors, device, group_size=2):
+    """Sum the given tensors, one per tower, hierarchically: towers are split in groups of consecutive devices
+    (for instance, the GPUs sharing a PCIe switch), whose tensors are first summed on the group leader. The
+    sums of the leaders are then reduced with `ring_reduce`.
+
+    Args:
+        tensors: A list of Tensors with the same shape, each one placed on a different device
+        device: Device of the output, for instance the device of the corresponding variable
+        group_size: Number of towers per group
+
+    Returns:
+        The summed Tensor, placed on `device`
+    """
+    groups = [list(range(i, min(i + group_size, len(tensors)))) for i in range(0, len(tensors), group_size)]
+    group_sums = []
+    for group in groups:
+        with tf.device(tensors[group[0]].device):
+            group_sums.append(tf.add_n([tensors[i] for i in group]))
+    return ring_reduce(group_sums, device)
+
+
+def reduce_gradients(tower_grads_and_vars, algorithm='ring', group_size=2):
+    """Average the gradients computed by each tower, for variables shared across towers. Each averaged
+    gradient is placed on the device of its variable.
+
+    Args:
+        tower_grads_and_vars: A list with one list of (gradient, variable) pairs per tower,
+            as returned by `Optimizer.compute_gradients`, for the same variables in the same order
+        algorithm: Reduction algorithm, `ring` or `hierarchical`
+        group_size: Number of towers per group for the `hierarchical` algorithm
+
+    Returns:
+        A list of (averaged gradient, variable) pairs
+    """
+    num_towers = len(tower_grads_and_vars)
+    if algorithm == 'ring':
+        reduce_fn = ring_reduce
+    elif algorithm == 'hierarchical':
+        reduce_fn = lambda x, device: hierarchical_reduce(x, device, group_size=group_size)
+    else:
+        raise NotImplementedError('Unknown reduction algorithm', algorithm)
+
+    outputs = []
+    for grads_and_vars in zip(*tower_grads_and_vars):
+        var = grads_and_vars[0][1]
+        assert all(v is var for _, v in grads_and_vars)
+        grads = [g for g, _ in grads_and_vars]
+        if any(g is None for g in grads):
+            assert all(g is None for g in grads)
+            outputs.append((None, var))
+            continue
+        with tf.name_scope('reduce_%s' % var.op.name.replace('/', '_')):
+            summed = reduce_fn([tf.convert_to_tensor(g) for g in grads], var.device)
+            with tf.device(var.device):
+                outputs.append((summed / float(num_towers), var))
+    return outputs
+
+
+#################################################### Batch norm
+def aggregate_moving_averages_updates(update_ops):
+    """Merge the batch norm moving averages updates that each tower computes from its own batch moments into a
+    single update per variable, from the moments averaged over all towers. This only affects the statistics used
+    at inference: during training, each tower still normalizes its batch with its own moments.
+    Update operations which are not moving averages updates are kept as is.
+
+    Args:
+        update_ops: list of update operations, for instance from the `UPDATE_OPS` collection
+
+    Returns:
+        The list of aggregated update operations
+    """
+    variables = {v.op.name: v for v in tf.global_variables()}
+    deltas = OrderedDict()
+    outputs = []
+    for update_op in update_ops:
+        op = update_op.op if isinstance(update_op, tf.Tensor) else update_op
+        # moving averages updates have the form `assign_sub(variable, (variable - value) * (1 - decay))`
+        if op.type in ['AssignSub', 'AssignSubVariableOp'] and op.inputs[0].op.name in variables:
+            deltas.setdefault(op.inputs[0].op.name, []).append(op.inputs[1])
+        else:
+            outputs.append(update_op)
+    with tf.name_scope('averaged_moving_averages'):
+        for name, values in deltas.items():
+            variable = variables[name]
+            with tf.device(variable.device):
+                outputs.append(tf.assign_sub(variable, tf.add_n(values) / float(len(values))))
+    return outputs
@@ -5,8 +5,18 @@ import tensorflow as tf
 from .configuration import get_defaults
 
 #################################################### Write Output of the feed forward pass    
-def append_detection_outputs(file_path,
-                             image_ids, 
+def append_detection_outputs(file_path, *args, **kwargs):
+    """Append outputs of the current evaluation pass to the given file.
+    
+    Args:
+        file_path: target file
+        *args, **kwargs: see `format_detection_outputs`
+    """
+    with open(file_path, 'a') as f:
+        f.write(format_detection_outputs(*args, **kwargs))
+        
+        
+def format_detection_outputs(image_ids, 
                              num_gt_boxes, 
                              gt_boxes, 
                              pred_boxes,
@@ -15,10 +25,10 @@ def append_detection_outputs(file_path,
                              s1_confidences=None,
                              s1_kept_out_filter=None,
                              **kwargs):
-    """Append outputs of the current evaluation pass to the given file.
+    """Format the outputs of the current evaluation pass (after non-maximum suppression) as
+    they should be written in the results file.
     
     Args:
-        file_path: target file
         image_ids: Ids of images evaluated in this batch
         num_gt_boxes: Number of ground-truth boxes for each evaluated image
         gt_boxes: Coordinates of the ground-truth boxes for each evaluated image
@@ -28,43 +38,47 @@ def append_detection_outputs(file_path,
         s1_confidences: Confidences of boxes from the first stage, used to collect short-cut boxes
         s1_kept_out_filted: filter to collect short-cut boxes from the first stage, 
             i.e. (individuals + confidence above a certain threshold)        
+            
+    Returns:
+        A string containing the lines to write to the results file
     """
     iou_threshold, score_threshold = get_defaults(
         kwargs, ['retrieval_nms_threshold', 'retrieval_confidence_threshold'])
     del kwargs
     
-    with open(file_path, 'a') as f:
-        batch_size = image_ids.shape[0]
-        num_classes = pred_confidences.shape[-1]
-        for i in range(batch_size):            
-            # first line (id, number of ground-truth, ground-truth boxes)
-            im_id = image_ids[i]
-            num_gt = num_gt_boxes[i]
-            f.write('%s-gt\t%d\t%s\n' % (im_id, num_gt, '\t'.join(
-                ','.join('%.5f' % x for x in b) for b in gt_boxes[i, :num_gt])))
-            
-            
-            # following lines (id, class, number of boxes, predicted boxes with scores and nms filter boolean)            
-            pred_c_flat = np.reshape(pred_confidences[i], (-1, num_classes))
-            pred_boxes_flat = np.reshape(pred_boxes[i], (-1, 4))
+    lines = []
+    batch_size = image_ids.shape[0]
+    num_classes = pred_confidences.shape[-1]
+    for i in range(batch_size):            
+        # first line (id, number of ground-truth, ground-truth boxes)
+        im_id = image_ids[i]
+        num_gt = num_gt_boxes[i]
+        lines.append('%s-gt\t%d\t%s\n' % (im_id, num_gt, '\t'.join(
+            ','.join('%.5f' % x for x in b) for b in gt_boxes[i, :num_gt])))
+        
+        
+        # following lines (id, class, number of boxes, predicted boxes with scores and nms filter boolean)            
+        pred_c_flat = np.reshape(pred_confidences[i], (-1, num_classes))
+        pred_boxes_flat = np.reshape(pred_boxes[i], (-1, 4))
+        
+        # Collect kept-out boxes from the previous stage
+        if not (s1_boxes is None or s1_confidences is None or s1_kept_out_filter is None):
+            assert num_classes == 1 #TODO(aroyer) group clasess
+            index = np.where(s1_kept_out_filter[i])
+            kept_out_boxes = np.reshape(s1_boxes[i], (-1, 4))
+            kept_out_boxes = kept_out_boxes[index]
+            pred_boxes_flat = np.concatenate([pred_boxes_flat, kept_out_boxes], axis=0)
+            kept_out_scores = np.reshape(s1_confidences[i], (-1, 1))
+            kept_out_scores = kept_out_scores[index]
+            pred_c_flat = np.concatenate([pred_c_flat, kept_out_scores], axis=0)
             
-            # Collect kept-out boxes from the previous stage
-            if not (s1_boxes is None or s1_confidences is None or s1_kept_out_filter is None):
-                assert num_classes == 1 #TODO(aroyer) group clasess
-                index = np.where(s1_kept_out_filter[i])
-                kept_out_boxes = np.reshape(s1_boxes[i], (-1, 4))
-                kept_out_boxes = kept_out_boxes[index]
-                pred_boxes_flat = np.concatenate([pred_boxes_flat, kept_out_boxes], axis=0)
-                kept_out_scores = np.reshape(s1_confidences[i], (-1, 1))
-                kept_out_scores = kept_out_scores[index]
-                pred_c_flat = np.concatenate([pred_c_flat, kept_out_scores], axis=0)
-                
-            # for each classwrite boxes sorted by confidences + non-maximum suppresion 
-            for c in range(num_classes):
-                output = non_max_suppression(
-                    pred_boxes_flat, pred_c_flat[:, c], iou_threshold=iou_threshold, score_threshold=score_threshold)
-                f.write('%s-pred-%d\t%d\t%s\n' % (im_id, c, output.shape[0], '\t'.join(
-                    '%.6f,%.6f,%.6f,%.6f,%.3f,%d' % tuple(x) for x in output)))          
+        # for each classwrite boxes sorted by confidences + non-maximum suppresion 
+        for c in range(num_classes):
+            output = non_max_suppression(
+                pred_boxes_flat, pred_c_flat[:, c], iou_threshold=iou_threshold, score_threshold=score_threshold)
+            lines.append('%s-pred-%d\t%d\t%s\n' % (im_id, c, output.shape[0], '\t'.join(
+                '%.6f,%.6f,%.6f,%.6f,%.3f,%d' % tuple(x) for x in output)))          
+    return ''.join(lines)
                 
                 
 def is_valid(box):
@@ -148,12 +162,14 @@ def max_iou(box, boxes, epsilon=1e-12):
 
 
 ###################################################################### Map evaluation based on PASCAL
-def detect_eval(output_file_path, **kwargs):
+def detect_eval(output_file_path, return_per_image_aps=False, **kwargs):
     """PASCAL VOC-2010+ style evaluation for one class
     Based off https://github.com/rbgirshick/py-faster-rcnn/blob/master/lib/datasets/voc_eval.py#L192
     
     Args:
         output_file_path: Path to the file written with `append_individuals_detection_output`
+        return_per_image_aps: If True, additionally return a dictionnary mapping each image id to its 
+            average precision averaged over classes, such that `mean_aps` is the mean of the per-image values
         kwargs will be queried for `iou_threshold`, the IOU thresholds to compute the map for
     """
     iou_threshold = get_defaults(kwargs, ['retrieval_iou_threshold'], verbose=False)[0]
@@ -161,6 +177,7 @@ def detect_eval(output_file_path, **kwargs):
     
     current_image_id = 0
     ap = defaultdict(lambda: np.zeros(len(iou_threshold),))
+    per_image_ap = {}
     num_images = 0.
     
     # For each image in stored results
@@ -177,6 +194,7 @@ def detect_eval(output_file_path, **kwargs):
                     num_gt = gt_boxes.shape[0]
                     gt_boxes = np.expand_dims(gt_boxes, axis=0) # (1, num_gt, 4)
                     num_images += 1
+                    per_image_ap[current_image_id] = np.zeros(len(iou_threshold),)
                 else:
                     gt_boxes = None
                 
@@ -219,6 +237,83 @@ def detect_eval(output_file_path, **kwargs):
                 average_precision = np.sum(precisions * correct_preds, axis=-1) / num_gt
                 # Append 
                 ap[class_index] += average_precision
+                per_image_ap[im_id] += average_precision
     # Return    
     ap = {k: v / num_images for k, v in ap.items()}
-    return ap, iou_threshold, num_images
\ No newline at end of file
+    if return_per_image_aps:
+        per_image_ap = {k: v / max(1, len(ap)) for k, v in per_image_ap.items()}
+        return ap, iou_threshold, num_images, per_image_ap
+    return ap, iou_threshold, num_images
+
+
+def pareto_front(scores, costs):
+    """Return the points on the Pareto front when maximizing `scores` while minimizing `costs`.
+    
+    Args:
+        scores: A (num_points,) array of values to maximize (e.g. mAP)
+        costs: A (num_points,) or (num_points, num_costs) array of values to minimize (e.g. latency)
+        
+    Returns:
+        The sorted list of indices of the non-dominated points
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    costs = np.reshape(np.asarray(costs, dtype=np.float64), (scores.shape[0], -1))
+    front = []
+    for i in range(scores.shape[0]):
+        dominated = ((scores >= scores[i]) & np.all(costs <= costs[i], axis=-1) & 
+                     ((scores > scores[i]) | np.any(costs < costs[i], axis=-1)))
+        if not np.any(dominated):
+            front.append(i)
+    return front
+
+
+def stratified_sample(values, ratio, num_strata=4, seed=None):
+    """Stratified random sampling with proportional allocation.
+    
+    Args:
+        values: A (num_points,) array used to define the strata (e.g. number of boxes per image)
+        ratio: Ratio of points to sample in each stratum
+        num_strata: Number of strata, defined by the quantiles of `values`
+        seed: Optional random seed
+        
+    Returns:
+        The sorted indices of the sampled points, and the (num_points,) array of strata assignments
+    """
+    rng = np.random.RandomState(seed)
+    values = np.asarray(values)
+    edges = np.unique(np.percentile(values, np.linspace(0., 100., num_strata + 1)[1:-1]))
+    strata = np.searchsorted(edges, values, side='right')
+    samples = []
+    for stratum in np.unique(strata):
+        indices = np.where(strata == stratum)[0]
+        num_samples = min(len(indices), max(1, int(round(ratio * len(indices)))))
+        samples.append(rng.choice(indices, num_samples, replace=False))
+    return np.sort(np.concatenate(samples)), strata
+
+
+def bootstrap_confidence_interval(values, strata, strata_weights, num_bootstraps=1000, confidence=0.95, seed=None):
+    """Stratified mean estimate and its bootstrap percentile confidence interval.
+    
+    Args:
+        values: A (num_samples, num_metrics) array of per-sample values (e.g. per-image APs)
+        strata: A (num_samples,) array of strata assignments
+        strata_weights: Population ratio of each stratum, indexed by stratum
+        num_bootstraps: Number of bootstrap resamplings (within each stratum)
+        confidence: Confidence level of the interval
+        seed: Optional random seed
+        
+    Returns:
+        The (num_metrics,) estimate, lower and upper bounds
+    """
+    rng = np.random.RandomState(seed)
+    values = np.asarray(values, dtype=np.float64)
+    groups = [values[strata == stratum] for stratum in np.unique(strata)]
+    weights = np.array([strata_weights[stratum] for stratum in np.unique(strata)], dtype=np.float64)
+    weights /= np.sum(weights)
+    estimate = np.sum([w * group.mean(axis=0) for w, group in zip(weights, groups)], axis=0)
+    bootstraps = np.zeros((num_bootstraps,) + values.shape[1:])
+    for b in range(num_bootstraps):
+        for w, group in zip(weights, groups):
+            bootstraps[b] += w * group[rng.randint(0, group.shape[0], size=group.shape[0])].mean(axis=0)
+    alpha = 100. * (1. - confidence) / 2.
+    return estimate, np.percentile(bootstraps, alpha, axis=0), np.percentile(bootstraps, 100. - alpha, axis=0)
@@ -1,11 +1,20 @@
 import os
+import pickle
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 
 import numpy as np
 import tensorflow as tf
 
 from .configuration import get_defaults
+from . import distributed_utils
 from . import eval_utils
+from . import loss_utils
+from . import nets
 from . import tf_inputs
 from . import viz   
 
@@ -32,36 +41,44 @@ def generate_log_dir(configuration, verbose=1):
     
 def get_monitored_training_session(with_ready_op=False,
                                    log_dir=None,
+                                   master='',
                                    allow_soft_placement=True,
                                    log_device_placement=False,
+                                   extra_hooks=None,
                                    verbose=True,
                                    **kwargs):
     """Returns a monitored training session object with the specified global configuration.
     Args:
         with_ready_op: Whether to add ready operations to the graph
         log_dir: log directory. 
+        master: Target of the session. Defaults to the local process; the chief's server target in distributed mode
         log_device_placement: Whether to log the Tensorflow device placement
         allow_soft_placement: Whether to allow Tensorflow soft device placement
+        extra_hooks: Additional session hooks, for instance an `AsyncProducerHook`
         verbose: Controls verbosity level
         **kwargs: Additional configuration options, will be queried for:
             gpu_mem_frac. Defauts to 1
             max_to_keep. Number of checkpoints to keep save, defaults to 1
             save_checkpoints_step. Frequency for checkpoint saving 
             save_summaries_steps. Frequency of summary saving
+            num_gpus. Number of virtual CPU devices to create if `device_type` is `cpu`
+            device_type. Type of the towers devices
         
     Returns:
         A tf.train.MonitoredTrainingSeccion object.
     """
     # Kwargs
     assert  log_dir is not None
-    gpu_mem_frac, max_to_keep, save_checkpoint_steps = get_defaults(
-        kwargs, ['gpu_mem_frac', 'max_to_keep', 'save_checkpoint_steps'], verbose=verbose)
+    gpu_mem_frac, max_to_keep, save_checkpoint_steps, num_gpus, device_type = get_defaults(
+        kwargs, ['gpu_mem_frac', 'max_to_keep', 'save_checkpoint_steps', 'num_gpus', 'device_type'], verbose=verbose)
     
     # GPU config
     config = tf.ConfigProto(
         gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpu_mem_frac),
         log_device_placement=log_device_placement,
         allow_soft_placement=allow_soft_placement)
+    if device_type == 'cpu':
+        config.device_count['CPU'] = num_gpus
             
     # Summary hooks
     hooks = []
@@ -85,6 +102,9 @@ def get_monitored_training_session(with_ready_op=False,
         saver = tf.train.Saver(max_to_keep=max_to_keep)
         hooks.append(tf.train.CheckpointSaverHook(log_dir, saver=saver, save_steps=save_checkpoint_steps))
             
+    if extra_hooks is not None:
+        hooks.extend(extra_hooks)
+            
     # Scaffold      
     init_iterator_op = tf.get_collection('iterator_init')
     local_init_op = tf.group(tf.local_variables_initializer(), *init_iterator_op)
@@ -94,7 +114,8 @@ def get_monitored_training_session(with_ready_op=False,
         ready_for_local_init_op=None if with_ready_op else tf.constant([]))
     
     # Session object
-    session_creator = tf.train.ChiefSessionCreator(scaffold=scaffold, checkpoint_dir=log_dir, config=config)
+    session_creator = tf.train.ChiefSessionCreator(
+        scaffold=scaffold, master=master, checkpoint_dir=log_dir, config=config)
     return tf.train.MonitoredSession(session_creator=session_creator, hooks=hooks)
 
 
@@ -105,6 +126,9 @@ def get_inputs(mode='train',
                image_size=-1,
                grid_offsets=None,
                shuffle_test=False,
+               subset_ids=None,
+               sampler=None,
+               as_function=False,
                verbose=0,
                **kwargs):
     """ Returns a dataset iterator on the initial input.
@@ -117,6 +141,9 @@ def get_inputs(mode='train',
         image_size: Image size
         grid_offsets: Precomputed grid offsets
         shuffle_test: Whether to shuffle the dataset at inference. Default is False. Can be true for visualization purposes
+        subset_ids: Optional 1D integer Tensor. At inference, only evaluate the images with the given ids (all if empty)
+        sampler: Optional `tf_inputs.ImportanceSampler`. In train mode, draw the training images from it
+        as_function: If True, return a function building new inputs from the dataset iterator at each call
         verbose: verbosity
         **kwargs: Additional configuration options, will be queried for:
             {train,test}_tf_records. if mode is train, resp. test.
@@ -129,8 +156,10 @@ def get_inputs(mode='train',
             prefetch_capacity. Defaults to 1
             subset. takes subset of the dataset if strictly positive. Defaults to -1
             data_augmentation_threshold. Defaults to 0.5 (train)
+            train_crop_scale_size. If set, train on random `image_size` windows of the images resized to this size
             with_groups: whether to precompute groups based on the grid
             with_classification: whether to load classes
+            worker_hosts: In distributed mode, each worker reads its own shard of the training set
         
     Returns:
         A tf.data.Dataset iterator (and its initializer, if mode is test or val)
@@ -150,9 +179,16 @@ def get_inputs(mode='train',
     if mode == 'train':
         shuffle_buffer, data_augmentation_threshold, num_epochs = get_defaults(
             kwargs, ['shuffle_buffer', 'data_augmentation_threshold', 'num_epochs'], verbose=verbose)
+        random_crop_scale_size, random_crop_intersection_ratio_threshold = get_defaults(
+            kwargs, ['train_crop_scale_size', 'patch_intersection_ratio_threshold'], verbose=verbose)
         drop_remainder = True
         make_initializable_iterator = False
+        pad_remainder = False
+        subset_ids = None
     elif mode in ['val', 'test']:  
+        sampler = None
+        random_crop_scale_size = None
+        random_crop_intersection_ratio_threshold = None
         if not shuffle_test:
             shuffle_buffer = 1
         else:
@@ -161,6 +197,7 @@ def get_inputs(mode='train',
         data_augmentation_threshold = 0.
         drop_remainder = False
         make_initializable_iterator = True
+        pad_remainder = num_devices > 1
     else:
         raise NotImplementedError("Unknown mode for `get_inputs`:", mode)
         
@@ -177,7 +214,8 @@ def get_inputs(mode='train',
             image_folder = os.path.join(image_folder, 'val2017')
     ### Handle the MSCOCO-case: no test split
         
-    return tf_inputs.get_tf_dataset(
+    get_dataset = partial(
+        tf_inputs.get_tf_dataset,
         tfrecords_path,    
         feature_keys,
         image_format,
@@ -193,16 +231,100 @@ def get_inputs(mode='train',
         image_folder=image_folder,
         data_augmentation_threshold=data_augmentation_threshold,
         grid_offsets=grid_offsets,
-        num_devices=num_devices,
         num_threads=num_threads,
         shuffle_buffer=shuffle_buffer,
         prefetch_capacity=prefetch_capacity,
         make_initializable_iterator=make_initializable_iterator,
-        verbose=verbose)        
+        pad_remainder=pad_remainder,
+        filter_ids=subset_ids,
+        sampler=sampler,
+        random_crop_scale_size=random_crop_scale_size,
+        random_crop_intersection_ratio_threshold=random_crop_intersection_ratio_threshold,
+        verbose=verbose)
+    
+    ### Distributed training: one input pipeline per worker, on its own shard
+    worker_hosts = get_defaults(kwargs, ['worker_hosts'], verbose=verbose)[0]
+    if mode != 'train' or not worker_hosts or len(worker_hosts) == 1:
+        return get_dataset(num_devices=num_devices, as_function=as_function)
+    assert sampler is None, 'Importance sampling is only supported in single-process training'
+    
+    num_workers = len(worker_hosts)
+    workers_inputs_fn = []
+    for w in range(num_workers):
+        with tf.device('/job:worker/task:%d/cpu:0' % w), tf.name_scope('worker%d' % w):
+            workers_inputs_fn.append(get_dataset(
+                num_devices=num_devices // num_workers, shard=(num_workers, w), as_function=True)[0])
+            
+    def get_next_inputs():
+        inputs = []
+        for w, inputs_fn in enumerate(workers_inputs_fn):
+            with tf.device('/job:worker/task:%d/cpu:0' % w):
+                inputs.extend(inputs_fn())
+        return inputs
     
+    if as_function:
+        return get_next_inputs, None
+    return get_next_inputs(), None
+
+
+def get_crops_inputs(crops_config,
+                     image_size=-1,
+                     grid_offsets=None,
+                     as_function=False,
+                     verbose=0,
+                     **kwargs):
+    """ Returns the stage 2 training inputs from a crops dataset generated by `extract_crops.py`.
+
+    Args:
+        crops_config: Crops dataset description, saved as `crops_config.pkl` by `extract_crops.py`
+        image_size: Image size of the second stage. Should match the crops size
+        grid_offsets: Precomputed grid offsets of the second stage
+        as_function: If True, return a function building new inputs from the dataset iterator at each call
+        verbose: verbosity
+        **kwargs: Additional configuration options, will be queried for:
+            batch_size. Batch size per device
+            num_epochs: Number of epochs to run
+            num_gpus. Defaults to 1
+            shuffle_buffer. size of the shuffle buffer. Defaults to 1
+            num_threads. For parallel read. Defaults to 8
+            prefetch_capacity. Defaults to 1
+            data_augmentation_threshold. Defaults to 0.5
+            with_classification: whether to load classes
+
+    Returns:
+        A list with `num_gpus` elements, each being a dictionary of inputs.
+    """
+    assert crops_config['image_size'] == image_size, 'Crops were extracted for stage 2 input size %d, got %d' % (
+        crops_config['image_size'], image_size)
+    assert grid_offsets is not None and tuple(crops_config['num_cells']) == tuple(grid_offsets.shape[:2])
+    (num_threads, prefetch_capacity, batch_size, num_devices, with_classes,
+     shuffle_buffer, data_augmentation_threshold, num_epochs) = get_defaults(
+        kwargs, ['num_threads', 'prefetch_capacity', 'batch_size', 'num_gpus', 'with_classification',
+                 'shuffle_buffer', 'data_augmentation_threshold', 'num_epochs'], verbose=verbose)
+    num_classes = get_defaults(kwargs, ['num_classes'], verbose=verbose)[0] if with_classes else None
+    assert not with_classes or crops_config['with_classes'], 'The crops dataset does not contain classes'
+
+    return tf_inputs.get_crops_dataset(
+        crops_config['tfrecords'],
+        crops_config['max_num_bbs'],
+        image_size,
+        crops_config['num_cells'],
+        with_classes=with_classes,
+        num_classes=num_classes,
+        batch_size=batch_size,
+        num_epochs=num_epochs,
+        data_augmentation_threshold=data_augmentation_threshold,
+        num_devices=num_devices,
+        num_threads=num_threads,
+        shuffle_buffer=shuffle_buffer,
+        prefetch_capacity=prefetch_capacity,
+        as_function=as_function,
+        verbose=verbose)
+
 
 def get_stage2_inputs(inputs,
                       crop_boxes,
+                      features=None,
                       mode='train',
                       image_folder='',
                       image_format=None,
@@ -215,6 +337,8 @@ def get_stage2_inputs(inputs,
     Args:
         inputs, a dictionnary of inputs
         crop_boxes, a (batch_size * num_boxes, 4) tensor of crops
+        features: If given, features of the previous stage to RoI-align for each crop instead of extracting 
+            its pixels (`roi_head` networks)
         mode: one of `train`, `val` or `test`. Defaults to `train`.
         image_folder: path to the image folder. Can contain a format %s that will be replace by `mode`
         image_format: used to infer the dataset and loading format
@@ -237,6 +361,9 @@ def get_stage2_inputs(inputs,
     assert mode in ['train', 'val', 'test']
     assert len(crop_boxes.get_shape()) == 3
     intersection_ratio_threshold = get_defaults(kwargs, ['patch_intersection_ratio_threshold'], verbose=verbose)[0]
+    # Intermediate stages are trained on the grouped instances of the crops
+    with_groups, grouping_method = get_defaults(kwargs, ['with_groups', 'grouping_method'], verbose=verbose)
+    with_groups = with_groups and mode == 'train'
     previous_batch_size = kwargs['previous_batch_size']
     batch_size = kwargs['batch_size']
     
@@ -256,14 +383,23 @@ def get_stage2_inputs(inputs,
     except TypeError:
         pass
     
+    # The RoI head pools the aligned features once to its output grid
+    roi_sampling_ratio = get_defaults(kwargs, ['roi_sampling_ratio'], verbose=verbose)[0]
+    if features is not None:
+        image_size = 2 * int(kwargs['num_cells'][0])
+    
     return tf_inputs.get_next_stage_inputs(inputs, 
                                            crop_boxes,
+                                           features=features,
+                                           roi_sampling_ratio=roi_sampling_ratio,
                                            batch_size=batch_size,
                                            previous_batch_size=previous_batch_size,
                                            image_folder=image_folder,
                                            image_format=image_format,
                                            image_size=image_size,
                                            grid_offsets=grid_offsets,
+                                           with_groups=with_groups,
+                                           grouping_method=grouping_method,
                                            intersection_ratio_threshold=intersection_ratio_threshold,
                                            shuffle_buffer=shuffle_buffer,
                                            num_threads=num_threads,
@@ -271,6 +407,432 @@ def get_stage2_inputs(inputs,
                                            verbose=verbose)
         
     
+def stage_transition(stage_inputs, stage_outputs, mode, config, verbose=False): 
+    """Create inputs for the next stage based on the output of the current stage"""
+    assert mode in ['train', 'test']
+    with tf.name_scope('extract_patches'):
+        stage_outputs['crop_boxes'], crop_scores, stage_outputs['kept_out_filter'] = tf_inputs.extract_groups(
+            stage_outputs['bounding_boxes'], 
+            stage_outputs['confidence_scores'],
+            predicted_group_flags=stage_outputs['group_classification_logits'],
+            predicted_offsets=stage_outputs['offsets'] if 'offsets' in stage_outputs else None,
+            ground_truth_boxes=stage_inputs['bounding_boxes'] if mode == 'train' else None,
+            mode=mode, verbose=verbose, **config)  
+        
+    if mode == 'train':
+        del stage_outputs['kept_out_filter']
+    else:
+        # Merge overlapping crops, to reduce the number of passes of the next stage
+        coalesce_max_size = get_defaults(config, ['test_patch_coalesce_max_size'], verbose=verbose)[0]
+        if coalesce_max_size is not None:
+            stage_outputs['num_crops_before_coalescing'] = tf.reduce_sum(
+                tf.to_int32(tf_inputs.get_valid_crops_mask(stage_outputs['crop_boxes'])), axis=-1)
+            stage_outputs['crop_boxes'] = tf_inputs.coalesce_crops(
+                stage_outputs['crop_boxes'], max_size=coalesce_max_size)
+            
+        # Only refine as many crops as the latency budget allows
+        latency_budget_ms, per_batch, latency_model = get_defaults(config, [
+            'test_latency_budget_ms', 'test_latency_budget_per_batch', 'test_latency_model'], verbose=verbose)
+        if latency_budget_ms is not None:
+            assert latency_model is not None, 'A latency budget requires a calibrated latency model'
+            stage_outputs['num_crops_before_budget'] = tf.reduce_sum(
+                tf.to_int32(tf_inputs.get_valid_crops_mask(stage_outputs['crop_boxes'])), axis=-1)
+            stage_outputs['crop_boxes'] = tf_inputs.select_crops_within_budget(
+                stage_outputs['crop_boxes'], crop_scores, latency_budget_ms, latency_model, per_batch=per_batch)
+        
+    # The RoI head runs on the features of the current stage rather than on the image pixels
+    features = None
+    if get_defaults(config, ['network'], verbose=verbose)[0] == 'roi_head':
+        assert 'roi_features' in stage_outputs, 'The `roi_head` network requires the previous stage features'
+        features = stage_outputs['roi_features']
+        
+    return get_stage2_inputs(stage_inputs, 
+                             stage_outputs['crop_boxes'], 
+                             features=features,
+                             mode=mode, 
+                             verbose=verbose, 
+                             **config)
+
+
+def async_stage_transition(stage_inputs, crop_boxes, batch_size, capacity, crops_buffer=None):
+    """Asynchronous transition between two stages: The valid crops of the current stage are pushed
+    into a bounded FIFO buffer, and the next stage pops batches of crops from it. The buffer capacity
+    bounds how stale (relatively to the current stage weights) the crops trained on can be.
+
+    Args:
+        stage_inputs: Next stage inputs, as output by `stage_transition` with `batch_size` None
+        crop_boxes: A (batch_size, num_crops, 4) Tensor of crops, used to filter out empty crops
+        batch_size: Number of crops to pop for the next stage
+        capacity: Maximum number of crops waiting in the buffer
+        crops_buffer: Buffer shared across devices. Created if None
+
+    Returns:
+        The next stage inputs, the enqueue (producer) operation and the crops buffer
+    """
+    keys = sorted(stage_inputs.keys())
+    if crops_buffer is None:
+        crops_buffer = tf.FIFOQueue(capacity,
+                                    [stage_inputs[key].dtype for key in keys],
+                                    shapes=[stage_inputs[key].get_shape()[1:] for key in keys],
+                                    names=keys,
+                                    name='crops_buffer')
+    is_valid = tf.logical_and(crop_boxes[..., 2] > crop_boxes[..., 0], crop_boxes[..., 3] > crop_boxes[..., 1])
+    is_valid = tf.reshape(is_valid, (-1,))
+    enqueue_op = crops_buffer.enqueue_many({key: tf.boolean_mask(stage_inputs[key], is_valid) for key in keys})
+    return crops_buffer.dequeue_many(batch_size), enqueue_op, crops_buffer
+
+
+class AsyncProducerHook(tf.train.SessionRunHook):
+    """Run a producer operation (e.g., the asynchronous stage 1 training step filling the crops buffer) in a 
+    background thread of the monitored session. Unlike a `QueueRunner`, the producer can be paused without 
+    closing its queue, for instance during the evaluations. The producer step in flight when pausing, if any, 
+    still completes.
+    
+    Args:
+        producer_op: Operation run in a loop by the background thread
+        queue: Queue filled by `producer_op`. It is closed when the session stops or when the producer inputs
+            run out, so that its consumers get an `OutOfRangeError`
+    """
+    def __init__(self, producer_op, queue):
+        self.producer_op = producer_op
+        self.close_op = queue.close(cancel_pending_enqueues=True)
+        self.running = threading.Event()
+        self.running.set()
+        
+    def after_create_session(self, session, coord):
+        for target in [self.run_producer, self.close_on_stop]:
+            thread = threading.Thread(target=target, args=(session, coord))
+            thread.daemon = True
+            coord.register_thread(thread)
+            thread.start()
+        
+    def run_producer(self, session, coord):
+        try:
+            while not coord.should_stop():
+                if self.running.wait(timeout=1.):
+                    session.run(self.producer_op)
+        except (tf.errors.OutOfRangeError, tf.errors.CancelledError):
+            self.close(session)
+        except Exception as e:
+            coord.request_stop(e)
+            
+    def close_on_stop(self, session, coord):
+        coord.wait_for_stop()
+        self.close(session)
+        
+    def close(self, session):
+        try:
+            session.run(self.close_op)
+        except Exception:
+            pass
+        
+    def pause(self):
+        self.running.clear()
+        
+    def resume(self):
+        self.running.set()
+        
+    def paused(self, fn):
+        """Wrap `fn` so that the producer is paused while it runs"""
+        def paused_fn(*args, **kwargs):
+            self.pause()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.resume()
+        return paused_fn
+
+
+def compose_crop_boxes(parent_crop_boxes, crop_boxes):
+    """Express crops extracted from crops in the coordinates of the original image.
+    
+    Args:
+        parent_crop_boxes: A (batch_size, num_parent_crops, 4) Tensor of crops, relative to the original image
+        crop_boxes: A (batch_size * num_parent_crops, num_crops, 4) Tensor of crops, relative to their parent crop
+        
+    Returns:
+        A (batch_size, num_parent_crops * num_crops, 4) Tensor of crops, relative to the original image. Crops
+        which are empty, or extracted from an empty parent crop, are empty
+    """
+    with tf.name_scope('compose_crop_boxes'):
+        num_parent_crops = tf.shape(parent_crop_boxes)[1]
+        num_crops = tf.shape(crop_boxes)[1]
+        crop_boxes = tf.reshape(crop_boxes, tf.stack([-1, num_parent_crops, num_crops, 4]))
+        is_valid = tf.logical_and(tf_inputs.get_valid_crops_mask(crop_boxes), tf.expand_dims(
+            tf_inputs.get_valid_crops_mask(parent_crop_boxes), axis=-1))
+        parent_mins, parent_maxs = tf.split(tf.expand_dims(parent_crop_boxes, axis=2), 2, axis=-1)
+        crop_boxes = tf.tile(parent_mins, (1, 1, 1, 2)) + crop_boxes * tf.tile(parent_maxs - parent_mins, (1, 1, 1, 2))
+        is_valid = tf.to_float(tf.expand_dims(is_valid, axis=-1))
+        crop_boxes = crop_boxes * is_valid + np.array([1., 1., 0., 0.], dtype=np.float32) * (1. - is_valid)
+        return tf.reshape(crop_boxes, tf.stack([-1, num_parent_crops * num_crops, 4]))
+
+
+def get_kept_out_outputs(stages_outputs):
+    """Collect the boxes kept out of the refinement by each intermediate stage, relatively to the original image.
+    
+    Args:
+        stages_outputs: Outputs of each stage, as output by `get_odgi_inference_outputs`
+        
+    Returns:
+        A (batch_size, num_boxes, 4) Tensor of boxes, the corresponding (batch_size, num_boxes, num_classes) 
+        detection scores and the (batch_size, num_boxes) kept out filter
+    """
+    boxes, scores, kept_out_filter = [], [], []
+    with tf.name_scope('kept_out_outputs'):
+        for s, stage_outputs in enumerate(stages_outputs[:-1]):
+            num_classes = stage_outputs['detection_scores'].get_shape()[-1].value
+            # stage_boxes: (batch_size, num_crops, num_boxes_per_crop, 4)
+            num_crops = 1 if s == 0 else tf.shape(stages_outputs[s - 1]['image_crop_boxes'])[1]
+            num_boxes_per_crop = tf.reduce_prod(tf.shape(stage_outputs['bounding_boxes'])[1:-1])
+            stage_boxes = tf.reshape(stage_outputs['bounding_boxes'], tf.stack([-1, num_crops, num_boxes_per_crop, 4]))
+            if s > 0:
+                crop_boxes = tf.split(tf.expand_dims(stages_outputs[s - 1]['image_crop_boxes'], axis=2), 2, axis=-1)
+                stage_boxes *= tf.maximum(1e-8, tf.tile(crop_boxes[1] - crop_boxes[0], (1, 1, 1, 2)))
+                stage_boxes += tf.tile(crop_boxes[0], (1, 1, 1, 2))
+                stage_boxes = tf.clip_by_value(stage_boxes, 0., 1.)
+            boxes.append(tf.reshape(stage_boxes, (tf.shape(stage_boxes)[0], -1, 4)))
+            scores.append(tf.reshape(stage_outputs['detection_scores'], (tf.shape(stage_boxes)[0], -1, num_classes)))
+            kept_out_filter.append(tf.reshape(stage_outputs['kept_out_filter'], (tf.shape(stage_boxes)[0], -1)))
+        return tf.concat(boxes, axis=1), tf.concat(scores, axis=1), tf.concat(kept_out_filter, axis=1)
+
+
+def format_final_boxes(final_stage_outputs, crop_boxes):
+    """Rescale outputs relatively to the original input image for evaluating the final 
+       detection results
+    
+    Args:
+        final_stage_outputs: Output dictionnary of the last stage
+        crop_boxes: Crops the last stage was run on, relative to the original image
+    """
+    num_crops = tf.shape(crop_boxes)[1]
+    num_boxes = final_stage_outputs['bounding_boxes'].get_shape()[3].value
+    num_cells = final_stage_outputs['bounding_boxes'].get_shape()[1].value
+    
+    # reshape
+    with tf.name_scope('reshape_outputs'):
+        # outputs: (stage1_batch * num_crops, num_cell, num_cell, num_boxes, ...)
+        # to: (stage1_batch, num_cell, num_cell, num_boxes * num_crops, ...)
+        for key, value in final_stage_outputs.items():   
+            # reshape to (batch_size, num_crops, ...)
+            original_shape = tf.shape(value)       
+            num_dims = len(value.get_shape().as_list())
+            new_shape = tf.concat([tf.stack([-1, num_crops]), original_shape[1:]], axis=0)
+            batches = tf.reshape(value, new_shape)
+            # transpose to (batch_size, num_cells, num_cells, num_crops, num_boxes, ...)
+            transpose_axis = [0, 2, 3, 1] + list(range(4, num_dims + 1))
+            batches = tf.transpose(batches, transpose_axis)
+            # reshape to (batch_size, num_cells, num_cells, num_crops * num_boxes, ...)
+            new_shape = tf.concat([tf.stack([-1, num_cells, num_cells, num_crops * num_boxes]), new_shape[5:]], axis=0)
+            final_stage_outputs[key] = tf.reshape(batches, new_shape)  
+    
+    # rescale
+    with tf.name_scope('rescale_bounding_boxes'):
+        # tile crop_boxes to (stage1_batch, 1, 1, num_crops * num_boxes, 4)
+        crop_boxes = tf.expand_dims(crop_boxes, axis=-2)
+        crop_boxes = tf.tile(crop_boxes, (1, 1, num_boxes, 1))
+        crop_boxes = tf.reshape(crop_boxes, (-1, 1, 1, num_crops * num_boxes, 4))
+        crop_boxes = tf.split(crop_boxes, 2, axis=-1)
+        # bounding_boxes: (stage1_batch, num_cells, num_cells, num_crops * num_boxes, 4)
+        final_stage_outputs['bounding_boxes'] *= tf.maximum(1e-8, tf.tile(crop_boxes[1] - crop_boxes[0], (1, 1, 1, 1, 2)))
+        final_stage_outputs['bounding_boxes'] += tf.tile(crop_boxes[0], (1, 1, 1, 1, 2))
+        final_stage_outputs['bounding_boxes'] = tf.clip_by_value(final_stage_outputs['bounding_boxes'], 0., 1.)        
+    return final_stage_outputs
+
+
+def get_odgi_stages(stages_configs, verbose=True):
+    """Create the forward pass templates and loss functions for each stage of the ODGI cascade.
+    
+    Args:
+        stages_configs: List of configuration dictionaries, one for each stage
+        verbose: Verbosity level
+        
+    Returns:
+        A list of tuples (stage name, network name, forward pass function, configuration, loss function)
+    """
+    stages = []
+    for i, config in enumerate(stages_configs):
+        base_name = 'stage%d' % (i + 1)
+        network_name = get_defaults(config, ['network'], verbose=verbose)[0]
+        forward_fn = tf.make_template('%s/%s' % (base_name, network_name), getattr(nets, network_name)) 
+
+        # intermediate stages
+        if i < len(stages_configs) - 1:
+            decode_fn = tf.make_template('%s/decode' % base_name, nets.get_detection_outputs_with_groups)
+            loss_fn = partial(loss_utils.get_odgi_loss, loss_base_name=base_name)
+        # final stage
+        else:
+            decode_fn = tf.make_template('%s/decode' % base_name, nets.get_detection_outputs)
+            loss_fn = partial(loss_utils.get_standard_loss, loss_base_name=base_name)
+
+        forward_pass = partial(nets.forward, forward_fn=forward_fn, decode_fn=decode_fn)
+        stages.append((base_name, network_name, forward_pass, config, loss_fn))
+    return stages
+
+
+def load_stages_configs(log_dir):
+    """Load the stages configuration saved by `train_odgi.py` in the given log directory.
+    
+    Args:
+        log_dir: Log directory of a ODGI run
+        
+    Returns:
+        A list of configuration dictionaries, one for each stage
+    """
+    stages_configs = []
+    while 1:
+        path = os.path.join(log_dir, 'stage%d_config.pkl' % (len(stages_configs) + 1))
+        if not os.path.isfile(path):
+            break
+        with open(path, 'rb') as f:
+            stages_configs.append(pickle.load(f))
+    assert len(stages_configs) > 1, 'No ODGI stages configuration found in %s' % log_dir
+    return stages_configs
+
+
+def set_previous_batch_sizes(stages_configs):
+    """Propagate the (maximum) batch size of the second stage to the next ones: each stage runs on the crops 
+    extracted from all the inputs of the previous stage (at training or inference time).
+    
+    Args:
+        stages_configs: List of configuration dictionaries, one for each stage
+    """
+    for s in range(2, len(stages_configs)):
+        config = stages_configs[s - 1]
+        assert config['batch_size'] is None, 'Intermediate stages do not support a fixed batch size'
+        stages_configs[s]['previous_batch_size'] = config['previous_batch_size'] * max(
+            get_defaults(config, ['train_num_crops', 'test_num_crops'], verbose=False))
+        
+
+def set_inference_batch_size(stages_configs, batch_size):
+    """Set the (maximum) number of images per batch when running the ODGI cascade in inference mode.
+    
+    Args:
+        stages_configs: List of configuration dictionaries, one for each stage
+        batch_size: Number of images per batch fed to the first stage
+    """
+    stages_configs[0]['batch_size'] = batch_size
+    stages_configs[1]['previous_batch_size'] = batch_size
+    set_previous_batch_sizes(stages_configs)
+    
+
+def load_latency_model(log_dir):
+    """Load the stage 2 latency model calibrated by `benchmark.py calibrate` in the given log directory.
+    
+    Args:
+        log_dir: Log directory of a ODGI run
+        
+    Returns:
+        A dictionnary of the cost model parameters (in milliseconds), or None if the run was not calibrated
+    """
+    path = os.path.join(log_dir, 'latency_model.pkl')
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def set_inference_latency_budget(stages_configs, latency_budget_ms, latency_model, per_batch=False):
+    """Only refine, in stage 2, as many crops as the given latency budget allows.
+    
+    Args:
+        stages_configs: List of configuration dictionaries, one for each stage
+        latency_budget_ms: Latency budget in milliseconds, or None to disable
+        latency_model: Cost model of the cascade, as output by `load_latency_model`
+        per_batch: If True, the budget applies to the whole batch instead of to each image
+    """
+    assert len(stages_configs) == 2, 'The latency model only describes two-stage cascades'
+    stages_configs[1]['test_latency_budget_ms'] = latency_budget_ms
+    stages_configs[1]['test_latency_budget_per_batch'] = per_batch
+    stages_configs[1]['test_latency_model'] = latency_model
+    
+
+def forward_valid_crops(forward_pass, images, crop_boxes, config, verbose=0):
+    """Inference forward pass of a stage on the non-empty crops only. The outputs are scattered back to all 
+    crops, with zeros for the empty ones.
+    
+    Args:
+        forward_pass: Forward pass function of the stage
+        images: A (batch_size * num_crops, image_size, image_size, 3) Tensor of crops images
+        crop_boxes: The corresponding (batch_size, num_crops, 4) crops
+        config: Configuration of the stage
+        verbose: Verbosity level
+        
+    Returns:
+        The outputs dictionnary, for all crops
+    """
+    with tf.name_scope('compact_crops'):
+        indices = tf.to_int32(tf.where(tf.reshape(tf_inputs.get_valid_crops_mask(crop_boxes), (-1,))))
+        images = tf.gather_nd(images, indices)
+    outputs = forward_pass(images, config, is_training=False, verbose=verbose)
+    with tf.name_scope('scatter_outputs'):
+        num_crops = tf.shape(crop_boxes)[0] * tf.shape(crop_boxes)[1]
+        for key, value in outputs.items():
+            outputs[key] = tf.scatter_nd(indices, value, tf.concat([[num_crops], tf.shape(value)[1:]], axis=0))
+            outputs[key].set_shape([None] + value.get_shape().as_list()[1:])
+    return outputs
+
+
+def get_odgi_inference_outputs(inputs, stages, verbose=0):
+    """Build the ODGI cascade in inference mode.
+    
+    Args:
+        inputs: A dictionnary of inputs for the first stage
+        stages: List of stages, as output by `get_odgi_stages`
+        verbose: Verbosity level
+        
+    Returns:
+        A list containing the outputs dictionnary of each intermediate stage (including the extracted
+            `crop_boxes` and `kept_out_filter`, and the `image_crop_boxes` relative to the input image) and the 
+            outputs of the final stage, rescaled to the input image.
+    """
+    stages_outputs = []
+    stage_inputs = inputs
+    for s, (name, _, forward_pass, stage_config, _) in enumerate(stages):                    
+        if s > 0:
+            stage_inputs = stage_transition(
+                stage_inputs, stage_outputs, 'test', stage_config, verbose=verbose)
+            stage_outputs['image_crop_boxes'] = stage_outputs['crop_boxes']
+            if len(stages_outputs):
+                stage_outputs['image_crop_boxes'] = compose_crop_boxes(
+                    stages_outputs[-1]['image_crop_boxes'], stage_outputs['crop_boxes'])
+            stages_outputs.append(stage_outputs)
+
+        with tf.name_scope(name):
+            # The budgeted crops selection only saves time if the empty crops are skipped
+            compact_crops, latency_budget_ms = get_defaults(
+                stage_config, ['test_compact_crops', 'test_latency_budget_ms'], verbose=verbose)
+            if s > 0 and (compact_crops or latency_budget_ms is not None):
+                stage_outputs = forward_valid_crops(forward_pass, stage_inputs['image'], 
+                                                    stages_outputs[-1]['crop_boxes'], stage_config, verbose=verbose)
+            else:
+                stage_outputs = forward_pass(
+                    stage_inputs['image'], stage_config, is_training=False, verbose=verbose)
+    
+    with tf.name_scope('format_final_boxes'):
+        stage_outputs = format_final_boxes(stage_outputs, stages_outputs[-1]['image_crop_boxes'])
+    stages_outputs.append(stage_outputs)
+    return stages_outputs
+
+
+def gather_eval_outputs(keys, mask_key='inference_is_valid'):
+    """Concatenate the evaluation outputs collected on each device.
+    
+    Args:
+        keys: List of collection keys to gather, in order
+        mask_key: Collection containing the per-device `is_valid` masks. If it is non-empty, 
+            the padding samples of the last batch are filtered out of the outputs
+        
+    Returns:
+        A list of Tensors, one for each collection key
+    """
+    outputs = [tf.concat(tf.get_collection(key), axis=0) for key in keys]
+    masks = tf.get_collection(mask_key)
+    if len(masks):
+        is_valid = tf.concat(masks, axis=0)
+        outputs = [tf.boolean_mask(x, is_valid) for x in outputs]
+    return outputs
+    
+    
 def add_losses_to_graph(loss_fn, inputs, outputs, configuration, is_chief=False, verbose=0):
     """Add losses to graph collections.
     
@@ -287,9 +849,35 @@ def add_losses_to_graph(loss_fn, inputs, outputs, configuration, is_chief=False,
         if not key.endswith('_loss') and is_chief:
             print('\033[31mWarning:\033[0m %s will be ignored. Losses name should end with "_loss"' % key)
         tf.add_to_collection(key, loss)
+    # Per-image losses, for updating the importance sampler (identities so that they can be filtered by scope)
+    if 'per_image_loss' in outputs and 'im_id' in inputs:
+        tf.add_to_collection('importance_sampling_im_ids', tf.identity(inputs['im_id'], name='im_id'))
+        tf.add_to_collection('importance_sampling_losses', tf.identity(outputs['per_image_loss'], name='per_image_loss'))
+    # Running stage 2 loss per number of boxes in the crops, for the training crops sampler
+    if get_defaults(configuration, ['track_crop_difficulty'])[0] and 'per_image_loss' in outputs:
+        momentum = get_defaults(configuration, ['train_crop_sampler_momentum'])[0]
+        tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, tf_inputs.update_crop_difficulty(
+            inputs['num_boxes'], outputs['per_image_loss'], momentum=momentum))
+        
+        
+def get_importance_sampling_outputs(scope=None):
+    """Gather the image ids and per-image losses collected by `add_losses_to_graph`, used to update the running
+    losses of the importance sampler.
+    
+    Args:
+        scope: If given, only gather the losses created under this name scope (regular expression)
+        
+    Returns:
+        A pair of (num_images,) Tensors, the image ids and the corresponding losses
+    """
+    im_ids = tf.get_collection('importance_sampling_im_ids', scope=scope)
+    losses = tf.get_collection('importance_sampling_losses', scope=scope)
+    assert len(im_ids) and len(im_ids) == len(losses)
+    with tf.name_scope('importance_sampling_losses'):
+        return tf.concat(im_ids, axis=0), tf.concat(losses, axis=0)
         
         
-def get_total_loss(splits=[''], collection='outputs', with_summaries=True, verbose=0):
+def get_total_loss(splits=[''], collection='outputs', with_summaries=True, scope=None, verbose=0):
     """Retrieve the total loss over all collections and all devices.
     All collections ending with '_loss' will be taken as a loss function
     
@@ -298,6 +886,7 @@ def get_total_loss(splits=[''], collection='outputs', with_summaries=True, verbo
             By just sum all the losses present in the graph for all the trainable variables
         collection: collection to add loss summaries to
         with_summaries: Whether to add summaries to the graph
+        scope: If given, only collect the losses created under this name scope
         verbose: Verbosity level
         
     Returns:
@@ -307,10 +896,10 @@ def get_total_loss(splits=[''], collection='outputs', with_summaries=True, verbo
     for split in splits:
         full_loss = 0.
         loss_collections = [x for x in tf.get_default_graph().get_all_collection_keys() if 
-                            x.endswith('_loss') and x.startswith(split)]
+                            x.endswith('_loss') and x.startswith(split) and len(tf.get_collection(x, scope=scope))]
         ## sum losses
         for key in loss_collections:
-            collected = tf.get_collection(key)
+            collected = tf.get_collection(key, scope=scope)
             loss = tf.add_n(collected) / float(len(collected))
             full_loss += loss
             if with_summaries:
@@ -344,13 +933,55 @@ def get_total_loss(splits=[''], collection='outputs', with_summaries=True, verbo
     return losses
 
 
+def get_tower_device(i, **kwargs):
+    """Device of the `i`-th tower. 
+    
+    Args:
+        i: Tower index
+        **kwargs: Additional configuration options, will be queried for:
+            device_type. Type of the towers devices
+            num_gpus. Total number of towers
+            worker_hosts. In distributed mode, the towers are evenly split across workers
+    """
+    device_type, num_gpus, worker_hosts = get_defaults(kwargs, ['device_type', 'num_gpus', 'worker_hosts'])
+    if not worker_hosts:
+        return '/%s:%d' % (device_type, i)
+    num_devices_per_worker = num_gpus // len(worker_hosts)
+    return '/job:worker/task:%d/device:%s:%d' % (
+        i // num_devices_per_worker, device_type.upper(), i % num_devices_per_worker)
+
+
+def get_tower_losses(num_towers, splits=[''], scope=''):
+    """Retrieve the total losses of each tower separately.
+    
+    Args:
+        num_towers: Number of towers, built in the `dev%d` name scopes
+        splits: see `get_total_loss`
+        scope: name scope containing the towers
+        
+    Returns:
+        A list with, for each tower, a list of tuples as returned by `get_total_loss`
+    """
+    return [get_total_loss(splits=splits, with_summaries=False, scope='%sdev%d/' % (scope, i)) 
+            for i in range(num_towers)]
+
+
 def get_train_op(full_losses, 
+                 optimizers=None,
+                 tower_losses=None,
+                 update_ops_scope=None,
+                 return_optimizers=False,
                  verbose=True,
                  **kwargs):
     """Return the global step and graph operation (training, update batch norm and moving average)
     
     Args:
         full_loss: the total loss tensor
+        optimizers: If given, reuse these optimizers (one per loss) and their slots instead of creating new ones
+        tower_losses: If given, the losses of each tower as returned by `get_tower_losses`. Used to compute 
+            per-tower gradients when `gradient_reduction` is not `colocated`
+        update_ops_scope: If given, only consider the update operations created under this name scope
+        return_optimizers: If True, additionally return the list of optimizers
         
     Kwargs:
         optimizer. Defaults to ADAM
@@ -359,6 +990,13 @@ def get_train_op(full_losses,
         lr_decay_steps. If optimizer si MOMENTUM
         lr_decay_rate. If optimizer si MOMENTUM
         momentum. If optimizer si MOMENTUM
+        gradient_accumulation_steps. If > 1, each train operation accumulates the gradients of one micro-batch 
+            and the averaged gradients are only applied every given number of runs. Defaults to 1
+        gradient_reduction. `colocated` to differentiate the loss averaged over towers, or `ring` or 
+            `hierarchical` to reduce the per-tower gradients on the variables devices. Defaults to `colocated`
+        all_reduce_group_size. Number of towers per group for the `hierarchical` reduction
+        average_bn_updates. If True, update the batch norm moving averages once from the moments averaged over 
+            towers. The normalization of each tower still uses its own batch moments
         
     Returns:
         global step tensor
@@ -396,19 +1034,268 @@ def get_train_op(full_losses,
     else:
         raise NotImplementedError(optimizer_type)
         
+    # Gradient accumulation
+    accumulation_steps = get_defaults(kwargs, ['gradient_accumulation_steps'], verbose=verbose)[0]
+    if accumulation_steps > 1:
+        assert optimizers is None, 'Gradient accumulation can not be used with shared optimizers'
+        if verbose:
+            print('    Accumulating gradients over %d micro-batches' % accumulation_steps)
+            
+    # Gradient reduction across towers
+    gradient_reduction, all_reduce_group_size, average_bn_updates = get_defaults(
+        kwargs, ['gradient_reduction', 'all_reduce_group_size', 'average_bn_updates'], verbose=verbose)
+    if gradient_reduction == 'colocated' or tower_losses is None or len(tower_losses) == 1:
+        tower_losses = None
+    elif verbose:
+        print('    Per-tower gradients with %s reduction over %d towers' % (gradient_reduction, len(tower_losses)))
+        
     train_ops = []
-    for full_loss, var_list, scope in full_losses:
-        update_ops = [x for x in tf.get_collection(tf.GraphKeys.UPDATE_OPS) if scope in x.name]
+    if optimizers is None:
+        optimizers = [get_optimizer_op() for _ in full_losses]
+    for l, ((full_loss, var_list, scope), optimizer) in enumerate(zip(full_losses, optimizers)):
+        update_ops = [x for x in tf.get_collection(tf.GraphKeys.UPDATE_OPS, scope=update_ops_scope) if scope in x.name]
         print('   ', len(update_ops), 'update operations found in %s scope' % (scope if scope else "global"))
+        if average_bn_updates:
+            update_ops = distributed_utils.aggregate_moving_averages_updates(update_ops)
         with tf.control_dependencies(update_ops):
-            train_op = get_optimizer_op().minimize(
-                full_loss, var_list=var_list, colocate_gradients_with_ops=True)
+            # Gradients
+            if tower_losses is None:
+                grads_and_vars = optimizer.compute_gradients(
+                    full_loss, var_list=var_list, colocate_gradients_with_ops=True)
+            else:
+                tower_grads_and_vars = [optimizer.compute_gradients(
+                    losses[l][0], var_list=var_list, colocate_gradients_with_ops=True) for losses in tower_losses]
+                grads_and_vars = distributed_utils.reduce_gradients(
+                    tower_grads_and_vars, algorithm=gradient_reduction, group_size=all_reduce_group_size)
+            # Update
+            if accumulation_steps > 1:
+                train_op = get_accumulate_gradients_op(
+                    grads_and_vars, optimizer, accumulation_steps, 
+                    name='accumulate_%s' % scope if scope else 'accumulate')
+            else:
+                train_op = optimizer.apply_gradients(grads_and_vars)
         train_ops.append(train_op)
     
     # Return
+    if return_optimizers:
+        return global_step_op, train_ops, optimizers
     return global_step_op, train_ops
 
 
+def get_accumulate_gradients_op(grads_and_vars, optimizer, accumulation_steps, name='accumulate'):
+    """Train operation accumulating the given gradients in local variables, and applying
+       their average with `optimizer` every `accumulation_steps` runs.
+    
+    Args:
+        grads_and_vars: the (gradient, variable) pairs for one micro-batch
+        optimizer: the optimizer applying the accumulated gradients
+        accumulation_steps: Number of micro-batches per update
+        name: name scope of the accumulators
+        
+    Returns:
+        The train operation to run once per micro-batch
+    """
+    grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+    
+    with tf.variable_scope(name):
+        # Accumulators are local variables: they are neither trained nor checkpointed
+        accumulators = []
+        for _, v in grads_and_vars:
+            with tf.colocate_with(v):
+                accumulators.append(tf.get_local_variable(
+                    v.op.name.replace('/', '_'), shape=v.get_shape(), dtype=v.dtype.base_dtype,
+                    initializer=tf.zeros_initializer(), trainable=False))
+        counter = tf.get_local_variable('counter', shape=(), dtype=tf.int32, 
+                                        initializer=tf.zeros_initializer(), trainable=False)
+    
+    # Accumulate the current micro-batch
+    accumulate_ops = [acc.assign_add(g) for acc, (g, _) in zip(accumulators, grads_and_vars)]
+    with tf.control_dependencies(accumulate_ops):
+        num_accumulated = counter.assign_add(1)
+        
+    # Apply the averaged gradients and reset the accumulators every `accumulation_steps` runs
+    def apply_and_reset():
+        apply_op = optimizer.apply_gradients(
+            [(acc / float(accumulation_steps), v) for acc, (_, v) in zip(accumulators, grads_and_vars)])
+        with tf.control_dependencies([apply_op]):
+            reset_op = tf.group(*[acc.assign(tf.zeros_like(acc)) for acc in accumulators] + [counter.assign(0)])
+        with tf.control_dependencies([reset_op]):
+            return tf.constant(True)
+        
+    is_applied = tf.cond(tf.equal(num_accumulated, accumulation_steps), apply_and_reset, lambda: tf.constant(False))
+    return is_applied.op
+
+
+def get_resolution_phase(global_step, resolution_schedule, num_iters_per_epoch):
+    """Returns the index of the progressive resolution phase at the given step, or None for the target size"""
+    if resolution_schedule:
+        epoch = global_step // num_iters_per_epoch
+        for i, (_, end_epoch) in enumerate(resolution_schedule):
+            if epoch < end_epoch:
+                return i
+    return None
+
+
+def get_multi_step_train_op(train_step_fn, num_steps, num_losses, name='train_loop'):
+    """Run several training steps in a single `sess.run` call, with an in-graph loop. The collections
+    (losses, update operations, summaries...) filled by `train_step_fn` are only visible while building the
+    loop body, and restored afterwards: their Tensors live in the loop and can not be used outside of it.
+    
+    Args:
+        train_step_fn: Function building one training step in the loop body, given the name scope it is built
+            in (inputs, forward pass, losses and train operations). Returns a list of operations to run at each
+            step and a list of `num_losses` scalar losses
+        num_steps: Integer scalar Tensor, number of training steps to run
+        num_losses: Number of losses returned by `train_step_fn`
+        name: Name scope of the loop
+        
+    Returns:
+        The losses of the last step
+    """
+    graph = tf.get_default_graph()
+    with tf.name_scope(name) as scope:
+        def body(step, losses):
+            collections = {key: list(graph.get_collection(key)) for key in graph.get_all_collection_keys()}
+            train_ops, losses = train_step_fn(scope)
+            for key in graph.get_all_collection_keys():
+                graph.get_collection_ref(key)[:] = collections.get(key, [])
+            with tf.control_dependencies(train_ops):
+                return step + 1, [tf.identity(x) for x in losses]
+        
+        _, losses = tf.while_loop(lambda step, _: step < num_steps, 
+                                  body, 
+                                  [tf.constant(0), [tf.constant(0.) for _ in range(num_losses)]],
+                                  parallel_iterations=1,
+                                  back_prop=False)
+    return losses
+
+
+def get_num_loop_steps(global_step_, max_num_steps, events):
+    """Number of steps that can run in the in-graph loop before the next step that triggers an event 
+    (display, evaluation, checkpoint...), which is then run on its own.
+    
+    Args:
+        global_step_: Current global step
+        max_num_steps: Maximum number of steps to run in the loop
+        events: List of (frequency, offset) pairs. An event triggers after step k if (k - offset) % frequency == 0.
+            Events with a `None` frequency are ignored
+            
+    Returns:
+        The number of steps to run in the loop
+    """
+    num_steps = max_num_steps
+    for frequency, offset in events:
+        if frequency:
+            num_steps = min(num_steps, (offset - global_step_ - 1) % frequency)
+    return num_steps
+
+
+def get_step_peak_memory(run_metadata, persistent_bytes=0):
+    """Estimate the peak memory usage of one traced `sess.run` call, for the most loaded device.
+    
+    Args:
+        run_metadata: tf.RunMetadata collected with tracing enabled
+        persistent_bytes: Memory allocated before the step (e.g. variables), added to the peak
+        
+    Returns:
+        The estimated peak memory, in bytes
+    """
+    allocations = {}
+    process_peaks = {}
+    for device_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in device_stats.node_stats:
+            for memory in node_stats.memory:
+                allocations.setdefault(memory.allocator_name, []).extend(
+                    (x.alloc_micros, x.alloc_bytes) for x in memory.allocation_records)
+                process_peaks[memory.allocator_name] = max(
+                    process_peaks.get(memory.allocator_name, 0), memory.peak_bytes)
+    peak = 0
+    for allocator_name, records in allocations.items():
+        if len(records):
+            # Maximum memory in use during the step, from the allocations timeline
+            allocator_peak = np.max(np.cumsum([x[1] for x in sorted(records)]))
+        else:
+            # Older versions do not record allocations: process-wide peak
+            allocator_peak = process_peaks[allocator_name]
+        peak = max(peak, allocator_peak)
+    return int(peak + persistent_bytes)
+
+
+def autotune_training_settings(build_fn,
+                               candidates, 
+                               memory_budget, 
+                               num_warmup=2, 
+                               num_runs=5, 
+                               session_config=None,
+                               verbose=1):
+    """Pre-flight search of the training settings (e.g. batch size, number of crops) with the highest throughput
+    whose peak memory usage fits the given budget. Settings whose values are all greater than or equal to a
+    setting that did not fit are skipped.
+    
+    Args:
+        build_fn: Function building the training graph for the given setting in the current default graph, and 
+            returning the operations of one training step and the number of images per step
+        candidates: List of dictionaries of settings to try
+        memory_budget: Memory budget per device in bytes
+        num_warmup: Number of training steps before measuring
+        num_runs: Number of timed training steps
+        session_config: tf.ConfigProto for the session
+        verbose: Verbosity level
+        
+    Returns:
+        The selected setting (None if no setting fits) and the list of results for all tried settings
+    """
+    results = []
+    failures = []
+    for setting in candidates:
+        if any(all(setting[k] == x[k] or (setting[k] is not None and x[k] is not None and setting[k] >= x[k])
+                   for k in setting) for x in failures):
+            continue
+        graph = tf.Graph()
+        with graph.as_default():
+            train_ops, num_images = build_fn(setting)
+            init_op = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer(), 
+                               *tf.get_collection('iterator_init'))
+            persistent_bytes = sum(np.prod(x.get_shape().as_list()) * x.dtype.base_dtype.size 
+                                   for x in tf.global_variables())
+        result = dict(setting)
+        try:
+            with tf.Session(graph=graph, config=session_config) as sess:
+                sess.run(init_op)
+                coord = tf.train.Coordinator()
+                threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+                for _ in range(num_warmup):
+                    sess.run(train_ops)
+                run_metadata = tf.RunMetadata()
+                sess.run(train_ops, options=tf.RunOptions(trace_level=tf.RunOptions.SOFTWARE_TRACE), 
+                         run_metadata=run_metadata)
+                result['peak_memory'] = get_step_peak_memory(run_metadata, persistent_bytes=persistent_bytes)
+                start_time = time.time()
+                for _ in range(num_runs):
+                    sess.run(train_ops)
+                result['images_per_second'] = num_images * num_runs / (time.time() - start_time)
+                coord.request_stop()
+                coord.join(threads, stop_grace_period_secs=10)
+        except tf.errors.ResourceExhaustedError:
+            result['peak_memory'] = None
+            result['images_per_second'] = 0.
+        result['fits'] = result['peak_memory'] is not None and result['peak_memory'] <= memory_budget
+        if not result['fits']:
+            failures.append(setting)
+        results.append(result)
+        if verbose:
+            print('    %s: %s - %.2f images/s%s' % (
+                ', '.join('%s=%s' % x for x in sorted(setting.items())),
+                'out of memory' if result['peak_memory'] is None else '%.2fGB' % (result['peak_memory'] / 1e9),
+                result['images_per_second'], '' if result['fits'] else ' \033[31m(over budget)\033[0m'))
+        
+    fitting = [x for x in results if x['fits']]
+    if not len(fitting):
+        return None, results
+    best = max(fitting, key=lambda x: x['images_per_second'])
+    return {k: best[k] for k in candidates[0]}, results
+
+
 def add_summaries(inputs, 
                   outputs, 
                   mode='train',
@@ -433,6 +1320,9 @@ def add_summaries(inputs,
         kwargs, ['num_summaries', 'summary_confidence_thresholds'], verbose=verbose)
     del kwargs
     collection = 'outputs' if mode == 'train' else 'evaluation'
+    # RoI-aligned features inputs (`roi_head`) can not be displayed
+    if inputs['image'].get_shape()[-1].value != 3:
+        return
     
     # Image summaries
     viz.add_image_summaries(inputs,
@@ -453,8 +1343,11 @@ def run_eval(sess,
              results_path,
              configuration,
              additional_feed_dict=None,
+             return_per_image_aps=False,
              verbose=True):
-    """Run evaluation in a given session
+    """Run evaluation in a given session.
+    The session keeps fetching batches while a pool of workers applies the non-maximum suppression
+    and formats the outputs of the previous batches. Results are written in the batches order.
     
     Args:
         sess: Current session
@@ -464,8 +1357,22 @@ def run_eval(sess,
         mode: Whether to run on the validation or test split
         global_step_: Current global step, for display purpose
         results_path: Path to a file where to log results
+        additional_feed_dict: Additional feed dictionnary for the inference graph
+        return_per_image_aps: If True, additionally return the average precisions of each image
+        configuration: configuration dictionnary, queried for:
+            eval_num_workers. Number of post-processing workers. Defaults to 2, 0 for sequential evaluation
+            eval_worker_type. Either `thread` or `process`. Defaults to `thread`
+            eval_queue_size. Maximum number of batches waiting for post-processing. Defaults to 8
     """
     assert mode in ['val', 'test']
+    num_workers, worker_type, queue_size = get_defaults(
+        configuration, ['eval_num_workers', 'eval_worker_type', 'eval_queue_size'], verbose=False)
+    assert worker_type in ['thread', 'process']
+    assert queue_size > 0
+    # only pass the picklable post-processing options to the workers
+    postprocessing_kwargs = dict(zip(
+        ['retrieval_nms_threshold', 'retrieval_confidence_threshold'],
+        get_defaults(configuration, ['retrieval_nms_threshold', 'retrieval_confidence_threshold'], verbose=False)))
     with open(results_path, 'w') as f:
         f.write('%s results at step %d\n' % (mode, global_step_))
         
@@ -474,16 +1381,97 @@ def run_eval(sess,
         feed_dict.update(additional_feed_dict)
         
     sess.run(eval_initializer, feed_dict=feed_dict)
-    try:
-        while 1:   
-            out_ = sess.run(eval_outputs,  feed_dict=feed_dict)
-            eval_utils.append_detection_outputs(results_path, *out_, **configuration)
-    except tf.errors.OutOfRangeError:
-        pass
+    # Sequential evaluation
+    if num_workers == 0:
+        try:
+            while 1:   
+                out_ = sess.run(eval_outputs,  feed_dict=feed_dict)
+                eval_utils.append_detection_outputs(results_path, *out_, **postprocessing_kwargs)
+        except tf.errors.OutOfRangeError:
+            pass
+    # Overlap inference with post-processing
+    else:
+        executor_cls = ThreadPoolExecutor if worker_type == 'thread' else ProcessPoolExecutor
+        with executor_cls(max_workers=num_workers) as executor, open(results_path, 'a') as f:
+            pending = deque()
+            try:
+                while 1:   
+                    out_ = sess.run(eval_outputs,  feed_dict=feed_dict)
+                    pending.append(executor.submit(
+                        eval_utils.format_detection_outputs, *out_, **postprocessing_kwargs))
+                    # bounded queue: wait for the oldest batch to be processed
+                    while len(pending) >= queue_size:
+                        f.write(pending.popleft().result())
+            except tf.errors.OutOfRangeError:
+                pass
+            while len(pending):
+                f.write(pending.popleft().result())
     
-    eval_aps, eval_aps_thresholds, num_images = eval_utils.detect_eval(results_path, **configuration)
+    eval_aps, eval_aps_thresholds, num_images, per_image_aps = eval_utils.detect_eval(
+        results_path, return_per_image_aps=True, **configuration)
     mean_aps = np.sum([x for x in eval_aps.values()], axis=0) / len(eval_aps)
     if verbose:
         print('evaluated %d %s images at step %d:' % (num_images, mode, global_step_), ' - '.join(
             'map@%.2f = %.5f' % (thresh, mean_aps[t]) for t, thresh in enumerate(eval_aps_thresholds)))
-    return mean_aps, eval_aps_thresholds, num_images
\ No newline at end of file
+    if return_per_image_aps:
+        return mean_aps, eval_aps_thresholds, num_images, per_image_aps
+    return mean_aps, eval_aps_thresholds, num_images
+
+
+def run_fast_eval(sess,
+                  global_step_,
+                  run_eval_fn,
+                  subset_placeholder,
+                  records_index,
+                  configuration,
+                  best_map=None,
+                  verbose=True):
+    """Evaluate on a stratified random subset of the validation split, with bootstrap confidence
+    intervals. Escalate to a full pass only when the estimate is close to the best mAP so far.
+    
+    Args:
+        sess: Current session
+        global_step_: Current global step, for display purpose
+        run_eval_fn: `run_eval` with all arguments fixed except `sess`, `global_step_`, `additional_feed_dict`,
+            `return_per_image_aps` and `verbose`
+        subset_placeholder: Placeholder for the ids of the images to evaluate, see `get_inputs`
+        records_index: Index of the split, see `tfrecords_utils.read_records_index`
+        configuration: configuration dictionnary, queried for:
+            fast_validation_ratio. Ratio of images to evaluate in each stratum
+            fast_validation_num_strata. Number of strata (quantiles of the number of boxes per image)
+            fast_validation_num_bootstraps. Number of bootstrap samples
+            fast_validation_confidence. Confidence level of the interval
+            fast_validation_margin. Escalate when the upper bound is above `best_map - margin`
+        best_map: Best mAP (at the first IoU threshold) reached by a full pass so far
+        
+    Returns:
+        The mAP (estimate or full pass) and whether it was computed on the full split
+    """
+    ratio, num_strata, num_bootstraps, confidence, margin = get_defaults(configuration, [
+        'fast_validation_ratio', 'fast_validation_num_strata', 'fast_validation_num_bootstraps',
+        'fast_validation_confidence', 'fast_validation_margin'], verbose=False)
+    
+    # Stratified subset
+    positions, strata = eval_utils.stratified_sample(records_index['num_boxes'], ratio, num_strata=num_strata)
+    im_ids = records_index['im_id'][positions]
+    strata_weights = np.bincount(strata) / float(len(strata))
+    strata = {'%s' % im_id: stratum for im_id, stratum in zip(records_index['im_id'], strata)}
+    
+    # Estimate
+    _, eval_aps_thresholds, num_images, per_image_aps = run_eval_fn(
+        sess, global_step_, additional_feed_dict={subset_placeholder: im_ids}, 
+        return_per_image_aps=True, verbose=False)
+    keys = sorted(per_image_aps.keys())
+    estimate, lower, upper = eval_utils.bootstrap_confidence_interval(
+        np.stack([per_image_aps[k] for k in keys], axis=0), np.array([strata[k] for k in keys]), strata_weights,
+        num_bootstraps=num_bootstraps, confidence=confidence)
+    if verbose:
+        print('estimated on %d val images at step %d:' % (num_images, global_step_), ' - '.join(
+            'map@%.2f = %.5f [%.5f, %.5f]' % (thresh, estimate[t], lower[t], upper[t]) 
+            for t, thresh in enumerate(eval_aps_thresholds)))
+        
+    # Escalate to a full evaluation
+    if best_map is None or upper[0] >= best_map - margin:
+        mean_aps = run_eval_fn(sess, global_step_, verbose=verbose)[0]
+        return mean_aps, True
+    return estimate, False
\ No newline at end of file
@@ -0,0 +1,458 @@
+import os
+import pickle
+import re
+import time
+from collections import Counter
+from functools import partial
+
+import numpy as np
+import tensorflow as tf
+
+from . import graph_manager
+from . import nets
+
+
+"""Utils functions for building, freezing and optimizing the inference graphs"""
+
+########################################################################## Inference graphs
+def build_odgi_model(log_dir, max_batch_size, inference_options=None):
+    """Build the ODGI inference graph fed with a batch of images in the current default graph.
+
+    Args:
+        log_dir: Log directory of a trained ODGI model
+        max_batch_size: Maximum number of images per batch
+        inference_options: Optional dictionnary of inference options overriding the stages configurations
+            (e.g. `test_patch_coalesce_max_size`, `test_compact_crops`, `test_latency_budget_ms`)
+
+    Returns:
+        A dictionnary describing the model: configuration, `images` placeholder, `outputs` tensors to evaluate
+        and their `outputs_keys`, the stages and the per-stage complexity
+    """
+    stages_configs = graph_manager.load_stages_configs(log_dir)
+    for config in stages_configs:
+        config['num_gpus'] = 1
+        config.update(inference_options or {})
+    graph_manager.set_inference_batch_size(stages_configs, max_batch_size)
+    latency_budget_ms = stages_configs[1].get('test_latency_budget_ms')
+    if latency_budget_ms is not None:
+        latency_model = graph_manager.load_latency_model(log_dir)
+        assert latency_model is not None, 'No latency model found in %s, run `benchmark.py calibrate` first' % log_dir
+        graph_manager.set_inference_latency_budget(
+            stages_configs, latency_budget_ms, latency_model, 
+            per_batch=stages_configs[1].get('test_latency_budget_per_batch', False))
+    stages = graph_manager.get_odgi_stages(stages_configs, verbose=False)
+
+    image_size = stages_configs[0]['image_size']
+    images = tf.placeholder(tf.float32, (None, image_size, image_size, 3), name='images')
+    stages_outputs = graph_manager.get_odgi_inference_outputs({'image': images}, stages)
+    # Crops processed by the final stage
+    crop_boxes = stages_outputs[-2]['image_crop_boxes']
+    outputs = [stages_outputs[-1]['bounding_boxes'], stages_outputs[-1]['detection_scores']]
+    outputs.extend(graph_manager.get_kept_out_outputs(stages_outputs))
+    num_valid_crops = tf.reduce_sum(tf.to_int32(tf.logical_and(crop_boxes[..., 2] > crop_boxes[..., 0],
+                                                               crop_boxes[..., 3] > crop_boxes[..., 1])))
+    num_crops_before_budget = num_valid_crops
+    if 'num_crops_before_budget' in stages_outputs[-2]:
+        num_crops_before_budget = tf.reduce_sum(stages_outputs[-2]['num_crops_before_budget'])
+    num_crops_before_coalescing = num_crops_before_budget
+    if 'num_crops_before_coalescing' in stages_outputs[-2]:
+        num_crops_before_coalescing = tf.reduce_sum(stages_outputs[-2]['num_crops_before_coalescing'])
+
+    # Complexity of each stage for one input (image or crop)
+    complexity = {}
+    for s, (name, network_name, _, config, _) in enumerate(stages):
+        decode_fn = nets.get_detection_outputs_with_groups if s < len(stages) - 1 else nets.get_detection_outputs
+        input_shape = None
+        if network_name == 'roi_head':
+            # RoI-aligned features of the previous stage
+            input_shape = get_roi_head_input_shape(config, stages_outputs[s - 1])
+        flops, num_parameters = nets.get_model_complexity(config, decode_fn, input_shape=input_shape)
+        complexity[name] = {'network': network_name, 'image_size': int(config['image_size']),
+                            'flops': int(flops), 'num_parameters': num_parameters}
+    # Upper bound: each stage runs on all the crops extracted from each input of the previous one
+    num_inputs, complexity['max_flops_per_image'] = 1, 0
+    for s, (name, _, _, config, _) in enumerate(stages):
+        num_inputs *= 1 if s == 0 else config['test_num_crops']
+        complexity[name]['max_inputs_per_image'] = num_inputs
+        complexity['max_flops_per_image'] += num_inputs * complexity[name]['flops']
+    # The final stage only runs on the non-empty crops
+    complexity['compact_crops'] = bool(stages_configs[-1].get('test_compact_crops', False) or 
+                                       latency_budget_ms is not None)
+    complexity['final_stage'] = stages[-1][0]
+
+    return {'name': 'odgi_%s' % '_'.join('%s-%d' % (x[1], x[3]['image_size']) for x in stages),
+            'config': stages_configs[0],
+            'images': images,
+            'outputs': outputs,
+            'outputs_keys': ['bounding_boxes', 'detection_scores', 'kept_out_boxes', 'kept_out_scores',
+                             'kept_out_filter'],
+            'num_valid_crops': [num_valid_crops, num_crops_before_budget, num_crops_before_coalescing],
+            'stages': stages,
+            'stages_outputs': stages_outputs,
+            'latency_budget_ms': latency_budget_ms,
+            'complexity': complexity}
+
+
+def get_roi_head_input_shape(config, previous_stage_outputs):
+    """Shape of one input of a `roi_head` stage: the previous stage features, RoI-aligned to twice its grid"""
+    roi_size = 2 * int(config['num_cells'][0])
+    return (roi_size, roi_size, previous_stage_outputs['roi_features'].get_shape()[-1].value)
+
+
+def build_standard_model(log_dir):
+    """Build the standard detector inference graph fed with a batch of images in the current default graph.
+
+    Args:
+        log_dir: Log directory of a trained standard model
+
+    Returns:
+        A dictionnary describing the model: configuration, `images` placeholder, `outputs` tensors to evaluate
+        and their `outputs_keys`, and its complexity
+    """
+    with open(os.path.join(log_dir, 'config.pkl'), 'rb') as f:
+        config = pickle.load(f)
+    config['num_gpus'] = 1
+    network = config['network']
+    forward_fn = tf.make_template(network, getattr(nets, network))
+    decode_fn = tf.make_template('decode', nets.get_detection_outputs)
+    forward_pass = partial(nets.forward, forward_fn=forward_fn, decode_fn=decode_fn)
+
+    images = tf.placeholder(tf.float32, (None, config['image_size'], config['image_size'], 3), name='images')
+    outputs = forward_pass(images, config, is_training=False)
+    flops, num_parameters = nets.get_model_complexity(config, nets.get_detection_outputs)
+
+    return {'name': 'standard_%s-%d' % (network, config['image_size']),
+            'config': config,
+            'images': images,
+            'outputs': [outputs['bounding_boxes'], outputs['detection_scores']],
+            'outputs_keys': ['bounding_boxes', 'detection_scores'],
+            'num_valid_crops': None,
+            'latency_budget_ms': None,
+            'complexity': {network: {'network': network, 'image_size': int(config['image_size']),
+                                     'flops': int(flops), 'num_parameters': num_parameters},
+                           'max_flops_per_image': int(flops)}}
+
+
+########################################################################## Input images
+def collect_images(sess, images, initializer, num_images):
+    """Collect a pool of real input images from an input pipeline.
+
+    Args:
+        sess: Current session
+        images: Tensor of input images produced by the input pipeline
+        initializer: Initializer of the input pipeline
+        num_images: Minimum number of images to collect, if the split is large enough
+
+    Returns:
+        An array of shape (num_images, image_size, image_size, 3)
+    """
+    pool = []
+    sess.run(initializer)
+    try:
+        while sum(x.shape[0] for x in pool) < num_images:
+            pool.append(sess.run(images))
+    except tf.errors.OutOfRangeError:
+        pass
+    return np.concatenate(pool, axis=0)
+
+
+########################################################################## Optimized graphs
+def freeze_model(sess, model):
+    """Freeze the inference graph of a model built in the session graph: variables are replaced with their 
+    current value, and the outputs are exposed as `output_0`, `output_1`, ...
+
+    Args:
+        sess: Session with the restored checkpoint
+        model: Model built by `build_odgi_model` or `build_standard_model` in the session graph
+
+    Returns:
+        graph_def: The frozen GraphDef
+        input_name: Name of the images placeholder
+        output_names: Names of the outputs nodes
+    """
+    with sess.graph.as_default():
+        output_names = [tf.identity(x, name='output_%d' % i).op.name for i, x in enumerate(model['outputs'])]
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_names)
+    return graph_def, model['images'].op.name, output_names
+
+
+def remove_assertions(graph_def):
+    """Drop the control dependencies on runtime assertions (e.g. the range check of the input images); the 
+    assertions are then removed as dead nodes"""
+    nodes = {node.name: node for node in graph_def.node}
+    def is_assertion(name):
+        node = nodes.get(name)
+        return ((node is not None and node.op == 'Assert') or 
+                any(x.startswith('assert_') or x.startswith('Assert') for x in name.split('/')))
+    graph_def = tf.GraphDef.FromString(graph_def.SerializeToString())
+    for node in graph_def.node:
+        inputs = [x for x in node.input if not (x.startswith('^') and is_assertion(x[1:]))]
+        del node.input[:]
+        node.input.extend(inputs)
+    return graph_def
+
+
+def get_constant_value(graph_def, name):
+    """Value of a constant node in a frozen graph, following `Identity` nodes, or None if not a constant"""
+    nodes = {node.name: node for node in graph_def.node}
+    node = nodes.get(name.lstrip('^').split(':')[0])
+    while node is not None and node.op == 'Identity':
+        node = nodes.get(node.input[0].split(':')[0])
+    if node is None or node.op != 'Const':
+        return None
+    return tf.make_ndarray(node.attr['value'].tensor)
+
+
+def merge_padding(graph_def):
+    """Merge the explicit zero-padding of the inputs into the following convolutions: a `Pad` of `(k - 1) / 2` 
+    pixels followed by a stride 1 `VALID` convolution with an odd kernel size `k` is a `SAME` convolution.
+
+    Returns:
+        The optimized GraphDef and the number of merged `Pad` nodes
+    """
+    graph_def = tf.GraphDef.FromString(graph_def.SerializeToString())
+    nodes = {node.name: node for node in graph_def.node}
+    num_merged = 0
+    for node in graph_def.node:
+        if node.op not in ['Conv2D', 'DepthwiseConv2dNative'] or node.attr['padding'].s != b'VALID':
+            continue
+        if (any(x != 1 for x in node.attr['strides'].list.i) or 
+            any(x != 1 for x in node.attr['dilations'].list.i)):
+            continue
+        pad_node = nodes.get(node.input[0].split(':')[0])
+        if pad_node is None or pad_node.op != 'Pad':
+            continue
+        paddings = get_constant_value(graph_def, pad_node.input[1])
+        kernel = get_constant_value(graph_def, node.input[1])
+        if paddings is None or kernel is None or kernel.shape[0] % 2 == 0 or kernel.shape[1] % 2 == 0:
+            continue
+        pad_h, pad_w = (kernel.shape[0] - 1) // 2, (kernel.shape[1] - 1) // 2
+        if paddings.tolist() != [[0, 0], [pad_h, pad_h], [pad_w, pad_w], [0, 0]]:
+            continue
+        node.input[0] = pad_node.input[0]
+        node.attr['padding'].s = b'SAME'
+        num_merged += 1
+    return graph_def, num_merged
+
+
+def optimize_inference_graph(graph_def, input_names, output_names, verbose=True):
+    """Optimize a frozen inference graph: remove the runtime assertions, constant-fold the static tensors 
+    (e.g. the `grid_offsets` of the output layers), fold the batch normalization into the convolutions 
+    weights and merge the padding into the convolutions.
+
+    Args:
+        graph_def: Frozen GraphDef, see `freeze_model`
+        input_names: Names of the inputs nodes
+        output_names: Names of the outputs nodes
+        verbose: If True, print the number of nodes removed by each step
+
+    Returns:
+        The optimized GraphDef
+    """
+    from tensorflow.tools.graph_transforms import TransformGraph
+    if verbose:
+        print('    \033[34mOriginal graph:\033[0m %d nodes' % len(graph_def.node))
+    graph_def = tf.graph_util.extract_sub_graph(remove_assertions(graph_def), output_names)
+    if verbose:
+        print('    \033[34mRemove assertions:\033[0m %d nodes' % len(graph_def.node))
+    # Control flow (non-maximum suppression conds) is left untouched
+    graph_def = TransformGraph(graph_def, input_names, output_names, ['fold_constants(ignore_errors=true)',
+                                                                      'fold_batch_norms',
+                                                                      'fold_old_batch_norms',
+                                                                      'fold_constants(ignore_errors=true)'])
+    if verbose:
+        print('    \033[34mFold constants and batch norm:\033[0m %d nodes' % len(graph_def.node))
+    graph_def, num_merged = merge_padding(graph_def)
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, output_names)
+    if verbose:
+        print('    \033[34mMerge padding:\033[0m %d nodes (%d pad merged)' % (len(graph_def.node), num_merged))
+    return graph_def
+
+
+def run_outputs(sess, images, outputs, pool, batch_size):
+    """Run the outputs on the whole pool of images and return the concatenated results and the per-image latency"""
+    results, latencies = [], []
+    for i in range(0, pool.shape[0], batch_size):
+        batch = pool[i:i + batch_size]
+        start_time = time.time()
+        results.append(sess.run(outputs, feed_dict={images: batch}))
+        latencies.append(1000. * (time.time() - start_time) / batch.shape[0])
+    return [np.concatenate(x, axis=0) for x in zip(*results)], float(np.median(latencies))
+
+
+def check_parity(original_outputs, optimized_outputs, tolerance, names=None, verbose=True):
+    """Compare the outputs of the original and optimized graphs: boolean outputs must be equal, and the other 
+    ones within `tolerance` (maximum absolute difference).
+
+    Args:
+        original_outputs: List of outputs arrays of the original graph, see `run_outputs`
+        optimized_outputs: The corresponding outputs of the optimized graph
+        tolerance: Maximum absolute difference
+        names: Optional names of the outputs, for display
+        verbose: If True, print the difference for each output
+
+    Returns:
+        A list of (max absolute difference, passed) for each output
+    """
+    report = []
+    for x, y in zip(original_outputs, optimized_outputs):
+        if x.dtype == bool:
+            diff = float(np.sum(x != y))
+            report.append((diff, diff == 0))
+        else:
+            diff = float(np.max(np.abs(x - y))) if x.size else 0.
+            report.append((diff, diff <= tolerance))
+    if verbose:
+        print('\n    Parity check on %d images:' % original_outputs[0].shape[0])
+        for name, (diff, passed) in zip(names or range(len(report)), report):
+            print('    %s %s: %s' % ('\033[32m[ok]\033[0m' if passed else '\033[31m[failed]\033[0m', name, diff))
+    return report
+
+
+def count_ops(graph_def, ops=('FusedBatchNorm', 'FusedBatchNormV2', 'FusedBatchNormV3', 'Assert', 'Pad')):
+    """Number of nodes in a GraphDef, in total and for the given op types"""
+    counts = Counter(node.op for node in graph_def.node)
+    out = {op: counts[op] for op in ops}
+    out['nodes'] = len(graph_def.node)
+    return out
+
+
+def import_inference_graph(graph_def, input_name='images'):
+    """Import a frozen inference graph in the current default graph.
+
+    Args:
+        graph_def: Frozen GraphDef, see `freeze_model`
+        input_name: Name of the images placeholder
+
+    Returns:
+        The `images` placeholder and the list of `outputs` tensors
+    """
+    output_names = sorted([node.name for node in graph_def.node if re.match(r'^output_\d+$', node.name)],
+                          key=lambda x: int(x.rsplit('_', 1)[1]))
+    tensors = tf.import_graph_def(graph_def, return_elements=[input_name + ':0'] + [x + ':0' for x in output_names],
+                                  name='')
+    return tensors[0], tensors[1:]
+
+
+########################################################################## Quantized backbones
+def get_inference_backbones(graph=None):
+    """Input and output Tensors of each backbone run in inference mode in the graph, in build order 
+    (i.e., stage 1 first for ODGI), see `nets.forward`"""
+    graph = graph or tf.get_default_graph()
+    inputs = graph.get_collection('inference_backbone_inputs')
+    outputs = graph.get_collection('inference_backbone_outputs')
+    assert len(inputs) == len(outputs)
+    return list(zip(inputs, outputs))
+
+
+def freeze_backbone(sess, backbone_input, backbone_output):
+    """Freeze the backbone between the given Tensors of the session graph into a standalone GraphDef, whose 
+    input is a placeholder with the same name as `backbone_input`'s op.
+
+    Returns:
+        The frozen GraphDef, and the names of its input and output nodes
+    """
+    from tensorflow.tools.graph_transforms import TransformGraph
+    assert backbone_input.value_index == 0 and backbone_output.value_index == 0
+    input_name, output_name = backbone_input.op.name, backbone_output.op.name
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), [output_name])
+    graph_def = tf.graph_util.extract_sub_graph(remove_assertions(graph_def), [output_name])
+    shape = ','.join(str(x) for x in [1] + backbone_input.get_shape().as_list()[1:])
+    graph_def = TransformGraph(graph_def, [input_name], [output_name], [
+        'strip_unused_nodes(type=float, shape="%s")' % shape, 'fold_constants(ignore_errors=true)'])
+    return graph_def, input_name, output_name
+
+
+def quantize_backbone(graph_def_path, input_name, output_name, input_shape, calibration_inputs):
+    """Post-training int8 quantization of a frozen backbone with TensorFlow Lite. Weights are quantized per 
+    channel, and the activations ranges are calibrated on the given inputs. The model inputs and outputs 
+    stay in float.
+
+    Args:
+        graph_def_path: Path to the frozen backbone, see `freeze_backbone`
+        input_name: Name of the input node
+        output_name: Name of the output node
+        input_shape: Shape of one input, without the batch dimension
+        calibration_inputs: Array of inputs, representative of the inputs of the backbone at inference
+
+    Returns:
+        The serialized TFLite model
+    """
+    converter = tf.lite.TFLiteConverter.from_frozen_graph(
+        graph_def_path, [input_name], [output_name], input_shapes={input_name: [1] + list(input_shape)})
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = lambda: ([x[None].astype(np.float32)] for x in calibration_inputs)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+
+def run_tflite(interpreter, inputs):
+    """Run a TFLite model with a batch size of 1 on each of the given inputs, and return the stacked outputs"""
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    outputs = []
+    for x in inputs:
+        interpreter.set_tensor(input_details['index'], x[None].astype(np.float32))
+        interpreter.invoke()
+        outputs.append(interpreter.get_tensor(output_details['index']))
+    if not len(outputs):
+        return np.zeros([0] + list(output_details['shape'][1:]), dtype=np.float32)
+    return np.concatenate(outputs, axis=0)
+
+
+def run_with_backbones(sess, model, backbones, interpreters, images):
+    """Run a model with its backbones replaced by TFLite models, and the rest of the inference graph (decoding, 
+    crops extraction, ...) in the session. Each backbone is fed the outputs of the previous ones.
+
+    Args:
+        sess: Session with the restored checkpoint
+        model: Model built by `build_odgi_model` or `build_standard_model` in the session graph
+        backbones: Inputs and outputs Tensors of the backbones, see `get_inference_backbones`
+        interpreters: The corresponding `tf.lite.Interpreter`s
+        images: Batch of input images
+
+    Returns:
+        The model outputs
+    """
+    feed_dict = {model['images']: images}
+    for (backbone_input, backbone_output), interpreter in zip(backbones, interpreters):
+        feed_dict[backbone_output] = run_tflite(interpreter, sess.run(backbone_input, feed_dict=feed_dict))
+    return sess.run(model['outputs'], feed_dict=feed_dict)
+
+
+########################################################################## SavedModel
+def export_saved_model(graph_def, input_name, outputs_keys, export_dir):
+    """Export a frozen inference graph as a standalone SavedModel, with a single `serving_default` signature 
+    mapping the `images` input to the named outputs.
+
+    Args:
+        graph_def: Frozen GraphDef, see `freeze_model` and `optimize_inference_graph`
+        input_name: Name of the images placeholder
+        outputs_keys: Names of the outputs in the signature, in the order of the `output_0`, ... nodes
+        export_dir: Output directory, must not exist
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        images, outputs = import_inference_graph(graph_def, input_name=input_name)
+        assert len(outputs) == len(outputs_keys)
+        signature = tf.saved_model.signature_def_utils.predict_signature_def(
+            inputs={'images': images}, outputs=dict(zip(outputs_keys, outputs)))
+        with tf.Session(graph=graph) as sess:
+            builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+            builder.add_meta_graph_and_variables(
+                sess, [tf.saved_model.tag_constants.SERVING], strip_default_attrs=True,
+                signature_def_map={tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY: signature})
+            builder.save()
+
+
+def load_saved_model(sess, export_dir):
+    """Load a SavedModel exported by `export_saved_model` in the session graph.
+
+    Returns:
+        The `images` placeholder and a dictionnary of outputs tensors
+    """
+    meta_graph_def = tf.saved_model.loader.load(sess, [tf.saved_model.tag_constants.SERVING], export_dir)
+    signature = meta_graph_def.signature_def[tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+    images = sess.graph.get_tensor_by_name(signature.inputs['images'].name)
+    outputs = {k: sess.graph.get_tensor_by_name(v.name) for k, v in signature.outputs.items()}
+    return images, outputs
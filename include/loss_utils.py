@@ -3,6 +3,44 @@ from .configuration import get_defaults
 from .utils import get_iou
 
 
+def get_weighted_loss(values, weights, inputs, per_image_losses=None):
+    """Weighted average of `values` over the non-zero weights (`SUM_BY_NONZERO_WEIGHTS` reduction).
+    With importance sampling, i.e. if `inputs` contains `importance_weights`, the weights of each image are
+    additionally scaled by its importance weight to keep the loss unbiased.
+
+    Args:
+        values: A (batch, ...) Tensor of loss terms
+        weights: Weights broadcastable to `values`
+        inputs: A dictionnary of inputs
+        per_image_losses: If given, a list to which the (unweighted) loss of each image, shape (batch,), is appended
+
+    Returns:
+        The scalar loss
+    """
+    if per_image_losses is not None:
+        full_weights = weights * tf.ones_like(values)
+        axis = list(range(1, len(values.get_shape())))
+        per_image_losses.append(tf.reduce_sum(values * full_weights, axis=axis) / tf.maximum(
+            1., tf.reduce_sum(tf.to_float(tf.not_equal(full_weights, 0.)), axis=axis)))
+    if 'importance_weights' in inputs:
+        weights *= tf.reshape(inputs['importance_weights'], [-1] + [1] * (len(values.get_shape()) - 1))
+    return tf.losses.compute_weighted_loss(values, weights=weights, reduction=tf.losses.Reduction.SUM_BY_NONZERO_WEIGHTS)
+
+
+def get_per_image_losses(inputs, track_crop_difficulty=False):
+    """Returns a list to collect the per-image loss terms in, if they are needed: to update the importance sampler
+    or the stage 2 difficulty estimates of the training crops sampler. None otherwise"""
+    if 'importance_weights' in inputs or track_crop_difficulty:
+        return []
+    return None
+
+
+def add_per_image_loss(outputs, per_image_losses):
+    """Store the sum of the per-image loss terms in `outputs['per_image_loss']`, if they were computed."""
+    if per_image_losses:
+        outputs['per_image_loss'] = tf.stop_gradient(tf.add_n(per_image_losses))
+
+
 def get_standard_loss(inputs, 
                       outputs,
                       is_chief=True,
@@ -28,12 +66,15 @@ def get_standard_loss(inputs,
         confidence_loss_weight: Weights for the confidence loss. defaults to 5
         noobj_confidence_loss_weight: Weights for the confidence loss  (empty cells). defautls to 1
         classification_loss_weight: weights for the counting loss. defaults to 1
+        track_crop_difficulty: whether to output the per-image loss, for the training crops sampler
     """     
     (centers_localization_loss_weight, scales_localization_loss_weight, 
      confidence_loss_weight, noobj_confidence_loss_weight) = get_defaults(kwargs, [
         'centers_localization_loss_weight', 'scales_localization_loss_weight', 
         'confidence_loss_weight', 'noobj_confidence_loss_weight'], verbose=verbose)
     assert num_cells is not None
+    per_image_losses = get_per_image_losses(
+        inputs, track_crop_difficulty=get_defaults(kwargs, ['track_crop_difficulty'], verbose=verbose)[0])
     
     # obj_i_mask: (batch, num_cells, num_cells, 1, num_gt), indicates presence of a box in a cell
     obj_i_mask = inputs['obj_i_mask_bbs']
@@ -74,17 +115,19 @@ def get_standard_loss(inputs,
         # centers
         with tf.name_scope('xy_loss'):
             centers_diffs = tf.expand_dims(outputs['shifted_centers'], axis=-2) - num_cells * (true_mins + true_maxs) / 2
-            centers_localization_loss = tf.losses.compute_weighted_loss(
+            centers_localization_loss = get_weighted_loss(
                 centers_diffs**2,
-                weights=centers_localization_loss_weight * obj_ij_mask,
-                reduction=tf.losses.Reduction.SUM_BY_NONZERO_WEIGHTS)        
+                centers_localization_loss_weight * obj_ij_mask,
+                inputs,
+                per_image_losses=per_image_losses)        
         # scales
         with tf.name_scope('wh_loss'):
             scales_diff = tf.expand_dims(outputs['log_scales'], axis=-2) - tf.log(tf.maximum(epsilon, true_maxs - true_mins))
-            scales_localization_loss = tf.losses.compute_weighted_loss(
+            scales_localization_loss = get_weighted_loss(
                 scales_diff**2,
-                weights=scales_localization_loss_weight * obj_ij_mask,
-                reduction=tf.losses.Reduction.SUM_BY_NONZERO_WEIGHTS)
+                scales_localization_loss_weight * obj_ij_mask,
+                inputs,
+                per_image_losses=per_image_losses)
         
     ## Confidence loss
     with tf.name_scope('conf_loss'):  
@@ -93,18 +136,20 @@ def get_standard_loss(inputs,
             # confs_diffs: (batch, num_cells, num_cells, num_preds, num_gt)
             obj_mask = tf.squeeze(obj_ij_mask, axis=-1)
             confs_diffs = target_confs - outputs["confidence_scores"]
-            confidence_loss_obj = tf.losses.compute_weighted_loss(
+            confidence_loss_obj = get_weighted_loss(
                 confs_diffs**2,
-                weights=confidence_loss_weight * obj_mask,
-                reduction=tf.losses.Reduction.SUM_BY_NONZERO_WEIGHTS)        
+                confidence_loss_weight * obj_mask,
+                inputs,
+                per_image_losses=per_image_losses)        
         # Predictors in empty cells
         with tf.name_scope('empty'):
             # noobj_mask: (batch, num_cells, num_cells, 1, 1)
             noobj_mask = 1. - tf.minimum(1., tf.reduce_sum(obj_i_mask, axis=-1, keepdims=True))
-            confidence_loss_noobj = tf.losses.compute_weighted_loss(
+            confidence_loss_noobj = get_weighted_loss(
                 outputs["confidence_scores"]**2,
-                weights=noobj_confidence_loss_weight * noobj_mask,
-                reduction=tf.losses.Reduction.SUM_BY_NONZERO_WEIGHTS)
+                noobj_confidence_loss_weight * noobj_mask,
+                inputs,
+                per_image_losses=per_image_losses)
         
     ## Classification loss
     if 'classification_probs' in outputs:        
@@ -121,13 +166,16 @@ def get_standard_loss(inputs,
             logits = tf.expand_dims(logits, axis=4)
             # classification loss
             class_diffs = labels - logits
-            classification_loss = tf.losses.compute_weighted_loss(
+            classification_loss = get_weighted_loss(
                 class_diffs**2,
-                weights=classification_loss_weight * obj_ij_mask,
-                reduction=tf.losses.Reduction.SUM_BY_NONZERO_WEIGHTS)
+                classification_loss_weight * obj_ij_mask,
+                inputs,
+                per_image_losses=per_image_losses)
     else:
         classification_loss = 0.        
     
+    add_per_image_loss(outputs, per_image_losses)
+    
     ## Add informative summaries
     if is_chief:
         is_assigned_predictor = tf.to_float(tf.reduce_sum(obj_ij_mask, axis=-2) > 0.)
@@ -168,12 +216,15 @@ def get_odgi_loss(inputs,
         group_classification_loss_weight: weights for the group flags loss. defaults to 1
         offsets_loss_weight: weights for the offsets loss. defaults to 1
         classification_loss_weight: weights for the classification loss. defaults to 1
+        track_crop_difficulty: whether to output the per-image loss, for the training crops sampler
     """     
     (centers_localization_loss_weight, scales_localization_loss_weight, 
      confidence_loss_weight, noobj_confidence_loss_weight) = get_defaults(kwargs, [
         'centers_localization_loss_weight', 'scales_localization_loss_weight', 
         'confidence_loss_weight', 'noobj_confidence_loss_weight'], verbose=verbose)
     assert num_cells is not None
+    per_image_losses = get_per_image_losses(
+        inputs, track_crop_difficulty=get_defaults(kwargs, ['track_crop_difficulty'], verbose=verbose)[0])
     
     # obj_i_mask: (batch, num_cells, num_cells, 1, num_gt), indicates presence of a box in a cell
     obj_i_mask = inputs['obj_i_mask_bbs']
@@ -200,17 +251,19 @@ def get_odgi_loss(inputs,
         # centers
         with tf.name_scope('xy_loss'):
             centers_diffs = outputs['shifted_centers'] - num_cells * (true_mins + true_maxs) / 2
-            centers_localization_loss = tf.losses.compute_weighted_loss(
+            centers_localization_loss = get_weighted_loss(
                 centers_diffs**2,
-                weights=centers_localization_loss_weight * non_empty_cell_mask,
-                reduction=tf.losses.Reduction.SUM_BY_NONZERO_WEIGHTS)
+                centers_localization_loss_weight * non_empty_cell_mask,
+                inputs,
+                per_image_losses=per_image_losses)
         # scales) 
         with tf.name_scope('wh_loss'):
             scales_diff = outputs['log_scales'] - tf.log(tf.maximum(1e-8, true_maxs - true_mins))
-            scales_localization_loss = tf.losses.compute_weighted_loss(
+            scales_localization_loss = get_weighted_loss(
                 scales_diff**2,
-                weights=scales_localization_loss_weight * non_empty_cell_mask,
-                reduction=tf.losses.Reduction.SUM_BY_NONZERO_WEIGHTS)
+                scales_localization_loss_weight * non_empty_cell_mask,
+                inputs,
+                per_image_losses=per_image_losses)
         
     ## Confidence loss
     with tf.name_scope('conf_loss'):  
@@ -218,16 +271,18 @@ def get_odgi_loss(inputs,
         with tf.name_scope('non_empty'):
             # confs_diffs: (batch, num_cells, num_cells, 1, 1)
             confs_diffs = target_confs - outputs["confidence_scores"]
-            confidence_loss_obj = tf.losses.compute_weighted_loss(
+            confidence_loss_obj = get_weighted_loss(
                 confs_diffs**2,
-                weights=confidence_loss_weight * non_empty_cell_mask,
-                reduction=tf.losses.Reduction.SUM_BY_NONZERO_WEIGHTS)        
+                confidence_loss_weight * non_empty_cell_mask,
+                inputs,
+                per_image_losses=per_image_losses)        
         # Predictors in empty cells
         with tf.name_scope('empty'):
-            confidence_loss_noobj = tf.losses.compute_weighted_loss(
+            confidence_loss_noobj = get_weighted_loss(
                 outputs["confidence_scores"]**2,
-                weights=noobj_confidence_loss_weight * (1. - non_empty_cell_mask),
-                reduction=tf.losses.Reduction.SUM_BY_NONZERO_WEIGHTS)
+                noobj_confidence_loss_weight * (1. - non_empty_cell_mask),
+                inputs,
+                per_image_losses=per_image_losses)
         
     ## Group classification loss
     if 'group_classification_logits' in outputs:  
@@ -239,7 +294,10 @@ def get_odgi_loss(inputs,
         # Flatten 
         labels = tf.reshape(labels, (-1, 1))
         logits = tf.reshape(logits, (-1, 1))
-        weights = tf.reshape(non_empty_cell_mask, (-1, 1))
+        weights = non_empty_cell_mask
+        if 'importance_weights' in inputs:
+            weights *= tf.reshape(inputs['importance_weights'], (-1, 1, 1, 1, 1))
+        weights = tf.reshape(weights, (-1, 1))
         # Loss
         group_classification_loss = tf.losses.sigmoid_cross_entropy(
             tf.stop_gradient(labels), 
@@ -269,10 +327,11 @@ def get_odgi_loss(inputs,
         target_offsets = tf.minimum(1., pred_scales / tf.maximum(epsilon, target_scales))        
         target_offsets = tf.stop_gradient(target_offsets)
         offsets_diffs = target_offsets - outputs["offsets"]
-        offsets_loss = tf.losses.compute_weighted_loss(
+        offsets_loss = get_weighted_loss(
             offsets_diffs**2,
-            weights=offsets_loss_weight * non_empty_cell_mask,
-            reduction=tf.losses.Reduction.SUM_BY_NONZERO_WEIGHTS)
+            offsets_loss_weight * non_empty_cell_mask,
+            inputs,
+            per_image_losses=per_image_losses)
     else:
         offsets_loss = 0.        
     
@@ -287,13 +346,16 @@ def get_odgi_loss(inputs,
             logits = outputs['classification_probs']
             # classification loss
             class_diffs = labels - logits
-            classification_loss = tf.losses.compute_weighted_loss(
+            classification_loss = get_weighted_loss(
                 class_diffs**2,
-                weights=classification_loss_weight * empty_cell_mask,
-                reduction=tf.losses.Reduction.SUM_BY_NONZERO_WEIGHTS)
+                classification_loss_weight * empty_cell_mask,
+                inputs,
+                per_image_losses=per_image_losses)
     else:
         classification_loss = 0.
     
+    add_per_image_loss(outputs, per_image_losses)
+    
     ## Add informative summaries
     if is_chief:
         outputs["target_bounding_boxes"] = outputs["bounding_boxes"] * non_empty_cell_mask   
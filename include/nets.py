@@ -6,7 +6,7 @@ import numpy as np
 import tensorflow as tf
 import tensorflow.contrib.slim as slim
 
-from .configuration import get_defaults
+from .configuration import get_defaults, COMPACT_NETWORKS
 
 
 def forward(images, config, forward_fn, decode_fn, is_training=True, verbose=0):
@@ -19,16 +19,27 @@ def forward(images, config, forward_fn, decode_fn, is_training=True, verbose=0):
         decode_fn: one of the decoding functions (either with or without groups)
         is_training: Whether the model is in training mode (for batch norm)
         verbose: verbosity level
+        
+    Kwargs:
+        with_roi_features: If True, additionally output the intermediate `roi_features` of the backbone
     """
+    end_points = {} if get_defaults(config, ['with_roi_features'], verbose=verbose)[0] else None
     embeddings = forward_fn(images,
                             is_training=is_training,
                             verbose=verbose,
+                            end_points=end_points,
                             **config)
+    if not is_training:
+        # Backbone boundaries, to run the inference backbones in another runtime (e.g. int8 quantized)
+        tf.add_to_collection('inference_backbone_inputs', images)
+        tf.add_to_collection('inference_backbone_outputs', embeddings)
     outputs = { k: v for (k, v) in decode_fn(embeddings,
                                              is_training=is_training,
                                              verbose=verbose,
                                              **config)
                if v is not None}
+    if end_points is not None:
+        outputs['roi_features'] = end_points['roi_features']
 
     if verbose == 2:
         print('\n'.join("    \033[32m%s\033[0m: shape=%s, dtype=%s" % (
@@ -41,6 +52,32 @@ def forward(images, config, forward_fn, decode_fn, is_training=True, verbose=0):
     return outputs
 
 
+def get_model_complexity(config, decode_fn, batch_size=1, input_shape=None):
+    """Count the floating point operations and the number of parameters of one stage.
+
+    Args:
+        config: configuration dictionnary, queried for `network`, `image_size` and `grid_offsets`
+        decode_fn: one of the decoding functions (either with or without groups)
+        batch_size: number of images in the batch
+        input_shape: Shape of one input, if the stage does not run on images (e.g. `roi_head`)
+
+    Returns:
+        The number of floating point operations and the number of parameters
+    """
+    network, image_size = get_defaults(config, ['network', 'image_size'])
+    if input_shape is None:
+        input_shape = (image_size, image_size, 3)
+    graph = tf.Graph()
+    with graph.as_default():
+        images = tf.placeholder(tf.float32, (batch_size,) + tuple(input_shape))
+        forward(images, config, getattr(sys.modules[__name__], network), decode_fn, is_training=False)
+        options = tf.profiler.ProfileOptionBuilder.float_operation()
+        options['output'] = 'none'
+        flops = tf.profiler.profile(graph, options=options).total_float_ops
+        num_parameters = int(sum(np.prod(x.get_shape().as_list()) for x in tf.trainable_variables()))
+    return flops, num_parameters
+
+
 #########################################
 #          Decoding Functions           #
 #                                       #
@@ -251,6 +288,31 @@ def get_detection_outputs_with_groups(activations,
 #############################################
 
 
+def run_block(block_fn, net, name, recompute_blocks=None, is_training=True):
+    """Apply one backbone block. If `name` is in `recompute_blocks` (or if it is `all`), the block activations are
+    not kept in memory for the backward pass, but recomputed from the block input (gradient checkpointing).
+
+    Args:
+        block_fn: Function building the block, net -> net
+        net: Input Tensor of the block
+        name: Name of the block
+        recompute_blocks: List of the names of the blocks to recompute, or `all`
+        is_training: Only recompute the activations in training mode
+    """
+    if not is_training or not recompute_blocks or (recompute_blocks != 'all' and name not in recompute_blocks):
+        return block_fn(net)
+
+    def recomputed_block_fn(inputs, is_recomputing=False):
+        # Do not apply the batch norm statistics updates a second time when recomputing
+        updates_collections = 'recomputed_update_ops' if is_recomputing else tf.GraphKeys.UPDATE_OPS
+        with slim.arg_scope([slim.batch_norm], updates_collections=updates_collections):
+            return block_fn(inputs)
+
+    # The recomputation tracks the variables used in the block, which requires resource variables
+    with tf.variable_scope(tf.get_variable_scope(), use_resource=True, auxiliary_name_scope=False):
+        return tf.contrib.layers.recompute_grad(recomputed_block_fn)(net)
+
+
 """
     tiny-YOLOv2
     Based on https://github.com/pjreddie/darknet/blob/master/cfg/yolov2-tiny.cfg
@@ -260,8 +322,10 @@ def tiny_yolo_v2(images,
                  stddev_init=0.01,
                  weight_decay=0.,
                  normalizer_decay=0.9,
+                 recompute_blocks=None,
                  is_training=True,
                  verbose=False,
+                 end_points=None,
                  **kwargs):
     """ Base tiny-YOLOv2 architecture.
 
@@ -269,10 +333,12 @@ def tiny_yolo_v2(images,
         images: input images in [0., 1.]
         is_training: training bool for batch norm
         verbose: verbosity level
+        end_points: If given, filled with the `roi_features` (stride 16 activations)
 
     Kwargs:
         weight_decay: Regularization constant. Defaults to 0.
         normalizer_decay: Batch norm decay. Defaults to 0.9
+        recompute_blocks: Blocks (`conv1` to `conv7`) whose activations are recomputed in the backward pass
     """
     del kwargs
 
@@ -306,17 +372,23 @@ def tiny_yolo_v2(images,
                     paddings = [[0, 0], [pad, pad], [pad, pad], [0, 0]]
                     pool_strides = [2] * (len(num_filters) - 2) + [1,   0]
                     for i, num_filter in enumerate(num_filters):
-                        net = tf.pad(net, paddings)
-                        net = slim.conv2d(net,
-                                          num_filter,
-                                          [kernel_size,
-                                           kernel_size],
-                                          scope='conv%d' % (i + 1))
-                        if pool_strides[i] > 0:
-                            net = slim.max_pool2d(net,
-                                                  [2, 2],
-                                                  stride=pool_strides[i],
-                                                  scope='pool%d' % (i + 1))
+                        def block_fn(net, i=i, num_filter=num_filter):
+                            net = tf.pad(net, paddings)
+                            net = slim.conv2d(net,
+                                              num_filter,
+                                              [kernel_size,
+                                               kernel_size],
+                                              scope='conv%d' % (i + 1))
+                            if pool_strides[i] > 0:
+                                net = slim.max_pool2d(net,
+                                                      [2, 2],
+                                                      stride=pool_strides[i],
+                                                      scope='pool%d' % (i + 1))
+                            return net
+                        net = run_block(block_fn, net, 'conv%d' % (i + 1), 
+                                        recompute_blocks=recompute_blocks, is_training=is_training)
+                        if end_points is not None and i == 3:
+                            end_points['roi_features'] = net
                     # Last conv
                     net = tf.pad(net, paddings)
                     net = slim.conv2d(net, 512, [3, 3], scope='conv_out_2')
@@ -335,8 +407,10 @@ def yolo_v2(images,
             stddev_init=0.01,
             weight_decay=0.,
             normalizer_decay=0.9,
+            recompute_blocks=None,
             is_training=True,
             verbose=False,
+            end_points=None,
             **kwargs):
     """ Base YOLOv2 architecture
     Based on https://github.com/pjreddie/darknet/blob/master/cfg/yolov2.cfg
@@ -345,10 +419,12 @@ def yolo_v2(images,
         images: input images in [0., 1.]
         is_training: training bool for batch norm
         verbose: verbosity level
+        end_points: If given, filled with the `roi_features` (stride 16 activations)
 
     Kwargs:
         weight_decay: Regularization cosntant. Defaults to 0.
         normalizer_decay: Batch norm decay. Defaults to 0.9
+        recompute_blocks: Blocks (`conv1` to `conv6`) whose activations are recomputed in the backward pass
     """
     del kwargs
 
@@ -374,38 +450,53 @@ def yolo_v2(images,
             with tf.control_dependencies([tf.assert_greater_equal(images, 0.)]):
                 with tf.control_dependencies([tf.assert_less_equal(images, 1.)]):
                     net = images
+                    block = partial(run_block, recompute_blocks=recompute_blocks, is_training=is_training)
                     # conv 1
-                    net = slim.conv2d(net, 32, [3, 3], scope='conv1')
-                    net = slim.max_pool2d(net, [2, 2], stride=2, scope='pool1')
+                    def conv1(net):
+                        net = slim.conv2d(net, 32, [3, 3], scope='conv1')
+                        return slim.max_pool2d(net, [2, 2], stride=2, scope='pool1')
+                    net = block(conv1, net, 'conv1')
                     # conv 2
-                    net = slim.conv2d(net, 64, [3, 3], scope='conv2')
-                    net = slim.max_pool2d(net, [2, 2], stride=2, scope='pool2')
+                    def conv2(net):
+                        net = slim.conv2d(net, 64, [3, 3], scope='conv2')
+                        return slim.max_pool2d(net, [2, 2], stride=2, scope='pool2')
+                    net = block(conv2, net, 'conv2')
                     # conv 3
-                    net = slim.conv2d(net, 128, [3, 3], scope='conv3_1')
-                    net = slim.conv2d(net, 64, [1, 1], scope='conv3_2')
-                    net = slim.conv2d(net, 128, [3, 3], scope='conv3_3')
-                    net = slim.max_pool2d(net, [2, 2], stride=2, scope='pool3')
+                    def conv3(net):
+                        net = slim.conv2d(net, 128, [3, 3], scope='conv3_1')
+                        net = slim.conv2d(net, 64, [1, 1], scope='conv3_2')
+                        net = slim.conv2d(net, 128, [3, 3], scope='conv3_3')
+                        return slim.max_pool2d(net, [2, 2], stride=2, scope='pool3')
+                    net = block(conv3, net, 'conv3')
                     # conv 4
-                    net = slim.conv2d(net, 256, [3, 3], scope='conv4_1')
-                    net = slim.conv2d(net, 128, [1, 1], scope='conv4_2')
-                    net = slim.conv2d(net, 256, [3, 3], scope='conv4_3')
-                    net = slim.max_pool2d(net, [2, 2], stride=2, scope='pool4')
+                    def conv4(net):
+                        net = slim.conv2d(net, 256, [3, 3], scope='conv4_1')
+                        net = slim.conv2d(net, 128, [1, 1], scope='conv4_2')
+                        net = slim.conv2d(net, 256, [3, 3], scope='conv4_3')
+                        return slim.max_pool2d(net, [2, 2], stride=2, scope='pool4')
+                    net = block(conv4, net, 'conv4')
                     # conv 5
-                    net = slim.conv2d(net, 512, [3, 3], scope='conv5_1')
-                    net = slim.conv2d(net, 256, [1, 1], scope='conv5_2')
-                    net = slim.conv2d(net, 512, [3, 3], scope='conv5_3')
-                    net = slim.conv2d(net, 256, [1, 1], scope='conv5_4')
+                    def conv5(net):
+                        net = slim.conv2d(net, 512, [3, 3], scope='conv5_1')
+                        net = slim.conv2d(net, 256, [1, 1], scope='conv5_2')
+                        net = slim.conv2d(net, 512, [3, 3], scope='conv5_3')
+                        net = slim.conv2d(net, 256, [1, 1], scope='conv5_4')
+                        return slim.conv2d(net, 512, [3, 3], scope='conv5_5')
                     # routing
-                    route = slim.conv2d(net, 512, [3, 3], scope='conv5_5')
-                    net = slim.max_pool2d(route, [2, 2], stride=2, scope='pool5')
+                    route = block(conv5, net, 'conv5')
+                    if end_points is not None:
+                        end_points['roi_features'] = route
                     # conv 6
-                    net = slim.conv2d(net, 1024, [3, 3], scope='conv6_1')
-                    net = slim.conv2d(net, 512, [1, 1], scope='conv6_2')
-                    net = slim.conv2d(net, 1024, [3, 3], scope='conv6_3')
-                    net = slim.conv2d(net, 512, [1, 1], scope='conv6_4')
-                    net = slim.conv2d(net, 1024, [3, 3], scope='conv6_5')
-                    net = slim.conv2d(net, 1024, [3, 3], scope='conv6_6')
-                    net = slim.conv2d(net, 1024, [3, 3], scope='conv6_7')
+                    def conv6(net):
+                        net = slim.max_pool2d(net, [2, 2], stride=2, scope='pool5')
+                        net = slim.conv2d(net, 1024, [3, 3], scope='conv6_1')
+                        net = slim.conv2d(net, 512, [1, 1], scope='conv6_2')
+                        net = slim.conv2d(net, 1024, [3, 3], scope='conv6_3')
+                        net = slim.conv2d(net, 512, [1, 1], scope='conv6_4')
+                        net = slim.conv2d(net, 1024, [3, 3], scope='conv6_5')
+                        net = slim.conv2d(net, 1024, [3, 3], scope='conv6_6')
+                        return slim.conv2d(net, 1024, [3, 3], scope='conv6_7')
+                    net = block(conv6, route, 'conv6')
                     # routing
                     route = slim.conv2d(route, 64, [3, 3], scope='conv_route')
                     route = tf.space_to_depth(route, 2)
@@ -431,6 +522,7 @@ def mobilenet(images,
               depth_multiplier=1.0,
               is_training=True,
               verbose=False,
+              end_points=None,
               **kwargs):
     """ Base MobileNet architecture
     Based on https://github.com/tensorflow/models/tree/master/research/slim/nets/mobilenet
@@ -440,11 +532,14 @@ def mobilenet(images,
         depth_multiplier: MobileNet depth multiplier.
         is_training: training bool for batch norm
         verbose: verbosity level
+        end_points: If given, filled with the `roi_features` (stride 16 activations)
 
     Kwargs:
         weight_decay: Regularization constant. Defaults to 0.
         normalizer_decay: Batch norm decay. Defaults to 0.9
     """
+    if kwargs.get('recompute_blocks') and is_training and verbose:
+        print('    \033[31mWarning:\033[0m `recompute_blocks` is not supported for MobileNet')
     del kwargs
     base_scope = tf.get_variable_scope().name
 
@@ -456,11 +551,13 @@ def mobilenet(images,
     # Mobilenet
     with tf.contrib.slim.arg_scope(mobilenet_v2.training_scope(is_training=is_training)):
         if depth_multiplier == 1.0:
-            net, _ = mobilenet_v2.mobilenet(net, base_only=True)
+            net, mobilenet_end_points = mobilenet_v2.mobilenet(net, base_only=True)
         elif depth_multiplier == 0.5:
-            net, _ = mobilenet_v2.mobilenet_v2_050(net, base_only=True)
+            net, mobilenet_end_points = mobilenet_v2.mobilenet_v2_050(net, base_only=True)
         elif depth_multiplier == 0.35:
-            net, _ = mobilenet_v2.mobilenet_v2_035(net, base_only=True)
+            net, mobilenet_end_points = mobilenet_v2.mobilenet_v2_035(net, base_only=True)
+    if end_points is not None:
+        end_points['roi_features'] = mobilenet_end_points['layer_14']
 
     # Add a saver to restore Imagenet-pretrained weights
     saver_collection = '%s_mobilenet_%s_saver' % (base_scope, depth_multiplier)
@@ -475,3 +572,152 @@ def mobilenet(images,
 mobilenet_100 = partial(mobilenet, depth_multiplier=1.0)
 mobilenet_50 = partial(mobilenet, depth_multiplier=0.5)
 mobilenet_35 = partial(mobilenet, depth_multiplier=0.35)
+
+
+"""
+    Compact
+    Family of efficient backbones: space-to-depth stem and depthwise separable convolutions, scaled by width and
+    depth multipliers. Stage 1 only has to find groups at low resolution, so it can use a small variant
+"""
+
+def compact(images,
+            width_multiplier=1.0,
+            depth_multiplier=1,
+            space_to_depth_stem=True,
+            stddev_init=0.01,
+            weight_decay=0.,
+            normalizer_decay=0.9,
+            recompute_blocks=None,
+            is_training=True,
+            verbose=False,
+            end_points=None,
+            **kwargs):
+    """ Compact architecture: a stem and 5 blocks of depthwise separable convolutions, with a total stride of 32.
+
+    Args:
+        images: input images in [0., 1.]
+        width_multiplier: Multiplier of the number of filters of each layer
+        depth_multiplier: Multiplier of the number of layers of each block
+        space_to_depth_stem: If True, the stem rearranges 2x2 pixels blocks into channels (lossless stride 2) 
+            before its convolution. Otherwise, it is a strided convolution
+        is_training: training bool for batch norm
+        verbose: verbosity level
+        end_points: If given, filled with the `roi_features` (stride 16 activations)
+
+    Kwargs:
+        weight_decay: Regularization constant. Defaults to 0.
+        normalizer_decay: Batch norm decay. Defaults to 0.9
+        recompute_blocks: Blocks (`block1` to `block5`) whose activations are recomputed in the backward pass
+    """
+    del kwargs
+
+    # Config
+    num_filters = [max(8, int(round(x * width_multiplier / 8.)) * 8) for x in [32, 64, 128, 256, 512]]
+    num_layers = [int(np.ceil(x * depth_multiplier)) for x in [1, 1, 2, 3, 2]]
+    weights_initializer = tf.truncated_normal_initializer(stddev=stddev_init)
+    weights_regularizer = tf.contrib.layers.l2_regularizer(weight_decay)
+    activation_fn = lambda x: tf.nn.leaky_relu(x, 0.1)
+    normalizer_fn = slim.batch_norm
+    normalizer_params = {'is_training': is_training, 'decay': normalizer_decay}
+
+    # Network
+    with slim.arg_scope([slim.conv2d, slim.separable_conv2d],
+                        padding='SAME',
+                        weights_initializer=weights_initializer,
+                        weights_regularizer=weights_regularizer,
+                        activation_fn=activation_fn,
+                        normalizer_fn=normalizer_fn,
+                        normalizer_params=normalizer_params):
+
+        # Input in [0., 1.]
+        with tf.control_dependencies([tf.assert_greater_equal(images, 0.)]):
+            with tf.control_dependencies([tf.assert_less_equal(images, 1.)]):
+                net = images
+
+                # Stem (stride 2)
+                if space_to_depth_stem:
+                    assert net.get_shape()[1].value % 2 == 0, 'The space-to-depth stem requires even image sizes'
+                    net = tf.space_to_depth(net, 2)
+                    net = slim.conv2d(net, num_filters[0], [3, 3], scope='stem')
+                else:
+                    net = slim.conv2d(net, num_filters[0], [3, 3], stride=2, scope='stem')
+
+                # Blocks: all but the first one start by halving the resolution
+                for i, (num_filter, num_layer) in enumerate(zip(num_filters, num_layers)):
+                    def block_fn(net, i=i, num_filter=num_filter, num_layer=num_layer):
+                        for j in range(num_layer):
+                            net = slim.separable_conv2d(net, 
+                                                        num_filter, 
+                                                        [3, 3], 
+                                                        depth_multiplier=1, 
+                                                        stride=2 if (i > 0 and j == 0) else 1,
+                                                        scope='block%d/conv%d' % (i + 1, j + 1))
+                        return net
+                    net = run_block(block_fn, net, 'block%d' % (i + 1), 
+                                    recompute_blocks=recompute_blocks, is_training=is_training)
+                    if end_points is not None and i == 3:
+                        end_points['roi_features'] = net
+
+                # Last conv
+                net = slim.conv2d(net, 2 * num_filters[-1], [1, 1], scope='conv_out')
+
+                # Outputs
+                return net
+
+for _name, (_width, _depth) in COMPACT_NETWORKS.items():
+    globals()[_name] = partial(compact, width_multiplier=_width, depth_multiplier=_depth)
+
+
+"""
+    RoI head
+    Small refinement network on the stage 1 features of each crop, instead of a full backbone on its pixels
+"""
+
+def roi_head(features,
+             num_filters=256,
+             stddev_init=0.01,
+             weight_decay=0.,
+             normalizer_decay=0.9,
+             is_training=True,
+             verbose=False,
+             **kwargs):
+    """ RoI refinement head. The RoI-aligned features are twice as large as the output grid (see 
+    `tf_inputs.roi_align`): one pooling brings them to the `num_cells` of the stage.
+
+    Args:
+        features: A (num_crops, 2 * num_cells, 2 * num_cells, num_channels) Tensor of RoI-aligned features
+        num_filters: Base number of filters
+        is_training: training bool for batch norm
+        verbose: verbosity level
+
+    Kwargs:
+        weight_decay: Regularization constant. Defaults to 0.
+        normalizer_decay: Batch norm decay. Defaults to 0.9
+    """
+    del kwargs
+
+    # Config
+    weights_initializer = tf.truncated_normal_initializer(stddev=stddev_init)
+    weights_regularizer = tf.contrib.layers.l2_regularizer(weight_decay)
+    activation_fn = lambda x: tf.nn.leaky_relu(x, 0.1)
+    normalizer_fn = slim.batch_norm
+    normalizer_params = {'is_training': is_training, 'decay': normalizer_decay}
+
+    # Network
+    with slim.arg_scope([slim.conv2d],
+                        stride=1,
+                        padding='SAME',
+                        weights_initializer=weights_initializer,
+                        weights_regularizer=weights_regularizer,
+                        activation_fn=activation_fn,
+                        normalizer_fn=normalizer_fn,
+                        normalizer_params=normalizer_params):
+        net = slim.conv2d(features, num_filters, [3, 3], scope='conv1')
+        net = slim.conv2d(net, num_filters, [3, 3], scope='conv2')
+        net = slim.max_pool2d(net, [2, 2], stride=2, padding='SAME', scope='pool2')
+        net = slim.conv2d(net, 2 * num_filters, [3, 3], scope='conv3')
+        net = slim.conv2d(net, num_filters, [1, 1], scope='conv4')
+        net = slim.conv2d(net, 2 * num_filters, [3, 3], scope='conv_out')
+
+        # Outputs
+        return net
@@ -1,3 +1,6 @@
+import threading
+
+import numpy as np
 import tensorflow as tf
 
 from .configuration import get_defaults
@@ -111,6 +114,136 @@ def apply_data_augmentation(in_, data_augmentation_threshold):
     return in_
 
 
+def apply_random_crop(in_, image_size, intersection_ratio_threshold=0.33, epsilon=1e-8):
+    """ Extract a random `image_size` square window from a single example and shift its bounding boxes
+    to the window coordinates. Boxes that are not visible enough in the window are discarded.
+    
+    Args:
+        in_: A single parsed example with keys `image` (larger than `image_size`), `bounding_boxes` and `num_boxes`
+        image_size: Size of the window
+        intersection_ratio_threshold: Only keep the boxes with at least this ratio of their area inside the window
+        epsilon: for avoiding division by zero
+        
+    Returns:
+        The example with the window as image
+    """
+    with tf.name_scope('random_crop'):
+        full_size = tf.shape(in_['image'])[:2]
+        offsets = tf.random_uniform((2,), maxval=tf.int32.max, dtype=tf.int32) % (full_size - image_size + 1)
+        in_['image'] = tf.image.crop_to_bounding_box(in_['image'], offsets[0], offsets[1], image_size, image_size)
+        # window: (x_min, y_min, x_max, y_max) in normalized coordinates of the full image
+        full_size = tf.to_float(tf.reverse(full_size, [0]))
+        window_mins = tf.to_float(tf.reverse(offsets, [0])) / full_size
+        window_maxs = window_mins + image_size / full_size
+        window = tf.concat([window_mins, window_maxs], axis=0)
+        # Filter out cut bbs
+        bounding_boxes = in_['bounding_boxes']
+        ratios = utils.get_intersection_ratio(tf.split(bounding_boxes, 4, axis=-1), tf.split(window, 4, axis=-1))
+        bounding_boxes *= tf.to_float(ratios > intersection_ratio_threshold)
+        # Rescale coordinates to the window
+        bounding_boxes -= tf.tile(window_mins, (2,))
+        bounding_boxes /= tf.maximum(epsilon, tf.tile(window_maxs - window_mins, (2,)))
+        bounding_boxes = tf.clip_by_value(bounding_boxes, 0., 1.)
+        in_['bounding_boxes'] = bounding_boxes
+        # Number of valid boxes
+        valid_boxes = ((bounding_boxes[..., 2] > bounding_boxes[..., 0]) & 
+                       (bounding_boxes[..., 3] > bounding_boxes[..., 1]))
+        in_['num_boxes'] = tf.reduce_sum(tf.to_int32(valid_boxes))
+    return in_
+
+
+def get_grid_targets(bounding_boxes, 
+                     num_boxes, 
+                     grid_offsets, 
+                     with_groups=True, 
+                     grouping_method='intersect', 
+                     class_labels=None):
+    """Compute the per-cell targets of one image: the presence of each ground-truth box in each cell and, 
+    optionally, the grouped instances.
+    
+    Args:
+        bounding_boxes: A (num_bbs, 4) Tensor of ground-truth boxes, padded with empty boxes
+        num_boxes: Number of valid ground-truth boxes
+        grid_offsets: Precomputed grid offsets, a (num_cells, num_cells, 2) array
+        with_groups: whether to compute the grouped instances targets
+        grouping_method: Criterion to determine whether an object "belongs" to a cell
+        class_labels: If given, a (num_bbs, num_classes) Tensor of one-hot classes, to compute the group classes
+        
+    Returns:
+        A dictionnary with the `obj_i_mask_bbs`, and optionally the `group_bounding_boxes_per_cell`, 
+        `num_group_boxes`, `group_flags` and `group_class_labels` targets
+    """
+    assert grouping_method in ['intersect', 'intersect_with_density', 'unique_intersect']
+    output = {}
+    num_cells = grid_offsets.shape[:2]
+    grid_offsets_mins = grid_offsets / num_cells
+    grid_offsets_maxs = (grid_offsets + 1.) / num_cells 
+    
+    # Empty/active cells mask
+    # obj_i_mask_bbs: (num_cells, num_cells, 1, num_bbs)
+    mins, maxs = tf.split(bounding_boxes, 2, axis=-1) # (num_bbs, 2)
+    inters = tf.maximum(0., tf.minimum(maxs, grid_offsets_maxs) - tf.maximum(mins, grid_offsets_mins))
+    inters = tf.reduce_prod(inters, axis=-1)
+    obj_i_mask = tf.expand_dims(tf.to_float(inters > 0.) , axis=-2)
+    output["obj_i_mask_bbs"] = obj_i_mask
+    if not with_groups:
+        return output
+                
+    # Grouped instances 
+    # group_bounding_boxes_per_cell: (num_cells, num_cells, 1, 4), cell bounding box after grouping
+    # group_flags: (num_cells, num_cells, 1, 1), whether a cell contains a group or not
+    # num_group_boxes: (), number of bounding boxes after grouping
+    ## Define group_mask: (num_cells, num_cells, num_bbs, 1)
+    ## Maps each gt bounding box to a grid cell to be merged into a group
+    if grouping_method == 'intersect_with_density':
+        obj_i_mask = tf.expand_dims(tf.to_float(inters > 0.) , axis=-2)
+        obj_i_mask *= tf.expand_dims(tf.to_float(inters < 1. / (num_cells[0] * num_cells[1])) , axis=-2)
+        group_mask = tf.transpose(obj_i_mask, (0, 1, 3, 2)) # (num_cells, num_cells, num_bbs, 1)
+    elif grouping_method == 'unique_intersect':
+        # weight 1: Intersection between gt boxes and cells
+        # Upper bounded by 1
+        # (num_cells, num_cells, num_bbs)
+        w1 = inters * num_cells[0] * num_cells[1]
+        # weight 2: Opposite of How many objects coocurs in each cells
+        # Upper bounded by 1
+        # (num_cells, num_cells, 1)
+        w2 = 1. - tf.reduce_sum(obj_i_mask, axis=-1) / tf.to_float(num_boxes)
+        # Assign each ground-truth to one unique group
+        group_mask = w1 * w2
+        group_mask = tf.to_float(group_mask > 0.) * tf.to_float(group_mask >= tf.reduce_max(group_mask, axis=(0, 1), keep_dims=True))
+        group_mask = tf.expand_dims(group_mask, axis=-1)
+    elif grouping_method == 'intersect':
+        group_mask = tf.transpose(obj_i_mask, (0, 1, 3, 2)) # (num_cells, num_cells, num_bbs, 1)
+    ## Merge bbs coocurring in the same cell to form groups
+    mins = mins + 1. - group_mask 
+    mins = tf.reduce_min(mins, axis=2, keep_dims=True) # (num_cells, num_cells, 1, 2)
+    maxs = maxs * group_mask
+    maxs = tf.reduce_max(maxs, axis=2, keep_dims=True)
+    group_bounding_boxes_per_cell = tf.concat([mins, maxs], axis=-1)
+    group_bounding_boxes_per_cell = tf.clip_by_value(group_bounding_boxes_per_cell, 0., 1.)
+    output["group_bounding_boxes_per_cell"] = group_bounding_boxes_per_cell
+    
+    num_bbs_per_cell = tf.reduce_sum(group_mask, axis=2, keep_dims=True) 
+    num_group_boxes = tf.reduce_sum(tf.to_int32(num_bbs_per_cell > 0))
+    output["num_group_boxes"] = num_group_boxes
+    
+    group_flags = tf.maximum(tf.minimum(num_bbs_per_cell, 2.) - 1., 0.)
+    output["group_flags"] = group_flags
+    
+    # Group classes (majority vote) # (num_cells, num_cells, 1, num_classes)
+    if class_labels is not None:
+        num_classes = class_labels.get_shape()[-1].value
+        percell_class_labels = tf.expand_dims(tf.expand_dims(class_labels, axis=0), axis=0)
+        percell_class_labels = group_mask * tf.to_float(percell_class_labels)
+        percell_class_labels = tf.reduce_sum(percell_class_labels, axis=2, keep_dims=True)
+        group_class_labels = tf.argmax(percell_class_labels, axis=-1)
+        group_class_labels = tf.one_hot(group_class_labels, num_classes,
+                                        axis=-1, on_value=1, off_value=0, dtype=tf.int32)
+        group_class_labels = tf.to_int32(percell_class_labels * tf.to_float(group_class_labels))
+        output["group_class_labels"] = group_class_labels
+    return output
+
+
 def get_tf_dataset(tfrecords_file,
                    record_keys,
                    image_format,
@@ -131,6 +264,13 @@ def get_tf_dataset(tfrecords_file,
                    shuffle_buffer=1,
                    prefetch_capacity=1,
                    make_initializable_iterator=False,
+                   pad_remainder=False,
+                   filter_ids=None,
+                   shard=None,
+                   sampler=None,
+                   random_crop_scale_size=None,
+                   random_crop_intersection_ratio_threshold=0.33,
+                   as_function=False,
                    verbose=1):
     """Parse and load inputs from the given TFRecords as a tf.data.Dataset.
 
@@ -152,6 +292,18 @@ def get_tf_dataset(tfrecords_file,
       shuffle_buffer: Size of the shuffling buffer.
       prefetch_capacity: Buffer size for prefetching.
       make_initializable_iterator: if True, make an initializable and add its initializer to the collection `iterator_init`
+      pad_remainder: if True, pad the last batch to `batch_size * num_devices` and add an `is_valid` mask to the inputs
+      filter_ids: if given, a 1D integer Tensor. Only keep the examples whose `im_id` is in `filter_ids`,
+        or all of them if it is empty.
+      shard: if given, a (num_shards, index) pair. Only read the `index`-th shard of the data: every `num_shards`-th
+        TFRecords file if there are enough of them, otherwise every `num_shards`-th record.
+      sampler: if given, an `ImportanceSampler` drawing the records (instead of shuffling them). The inputs then
+        contain the `importance_weights` of the sampled images.
+      random_crop_scale_size: if given, load the images at this (square) size and take a random `image_size` window
+        from each of them, instead of resizing the whole image to `image_size`. Targets are computed in the window.
+      random_crop_intersection_ratio_threshold: Only keep the boxes with at least this ratio visible in the window
+      as_function: if True, return a function creating new inputs from the shared iterator at each call
+        (e.g. to read inputs in the body of an in-graph training loop) instead of the inputs themselves
       verbose: Verbosity level
 
     Returns: 
@@ -163,6 +315,7 @@ def get_tf_dataset(tfrecords_file,
     assert batch_size > 0
     assert image_size > 0
     assert 0. <= data_augmentation_threshold <= 1.
+    assert random_crop_scale_size is None or random_crop_scale_size >= image_size
     if grid_offsets is not None:
         num_cells = grid_offsets.shape[:2]
     assert num_devices > 0
@@ -174,101 +327,70 @@ def get_tf_dataset(tfrecords_file,
     elif verbose == 1:
         print(' > load_inputs')
         
-    # Normalize grid cells offsets
-    if grid_offsets is not None:
-        grid_offsets_mins = grid_offsets / num_cells
-        grid_offsets_maxs = (grid_offsets + 1.) / num_cells 
-    
     # Create TFRecords feature
     features = read_tfrecords(record_keys, max_num_bbs=max_num_bbs)
     
-    def parsing_function(example_proto):
+    def parsing_function(example_proto, importance_weight=None):
         # Basic features
         parsed_features = tf.parse_single_example(example_proto, features)
-        output = parse_basic_feature(parsed_features, image_folder, image_format, image_size=image_size)
-        bounding_boxes = output['bounding_boxes']
-        
-        # Empty/active cells mask
-        # obj_i_mask_bbs: (num_cells, num_cells, 1, num_bbs)
-        mins, maxs = tf.split(bounding_boxes, 2, axis=-1) # (num_bbs, 2)
-        inters = tf.maximum(0., tf.minimum(maxs, grid_offsets_maxs) - tf.maximum(mins, grid_offsets_mins))
-        inters = tf.reduce_prod(inters, axis=-1)
-        obj_i_mask = tf.expand_dims(tf.to_float(inters > 0.) , axis=-2)
-        output["obj_i_mask_bbs"] = obj_i_mask
-                    
-        # Grouped instances 
-        # group_bounding_boxes_per_cell: (num_cells, num_cells, 1, 4), cell bounding box after grouping
-        # group_flags: (num_cells, num_cells, 1, 1), whether a cell contains a group or not
-        # num_group_boxes: (), number of bounding boxes after grouping
-        if with_groups:
-            ## Define group_mask: (num_cells, num_cells, num_bbs, 1)
-            ## Maps each gt bounding box to a grid cell to be merged into a group
-            if grouping_method == 'intersect_with_density':
-                obj_i_mask = tf.expand_dims(tf.to_float(inters > 0.) , axis=-2)
-                obj_i_mask *= tf.expand_dims(tf.to_float(inters < 1. / (num_cells[0] * num_cells[1])) , axis=-2)
-                group_mask = tf.transpose(obj_i_mask, (0, 1, 3, 2)) # (num_cells, num_cells, num_bbs, 1)
-            elif grouping_method == 'unique_intersect':
-                # weight 1: Intersection between gt boxes and cells
-                # Upper bounded by 1
-                # (num_cells, num_cells, num_bbs)
-                w1 = inters * num_cells[0] * num_cells[1]
-                # weight 2: Opposite of How many objects coocurs in each cells
-                # Upper bounded by 1
-                # (num_cells, num_cells, 1)
-                w2 = 1. - tf.reduce_sum(obj_i_mask, axis=-1) / tf.to_float(output['num_boxes'])
-                # Assign each ground-truth to one unique group
-                group_mask = w1 * w2
-                group_mask = tf.to_float(group_mask > 0.) * tf.to_float(group_mask >= tf.reduce_max(group_mask, axis=(0, 1), keep_dims=True))
-                group_mask = tf.expand_dims(group_mask, axis=-1)
-            elif grouping_method == 'intersect':
-                group_mask = tf.transpose(obj_i_mask, (0, 1, 3, 2)) # (num_cells, num_cells, num_bbs, 1)
-            ## Merge bbs coocurring in the same cell to form groups
-            mins = mins + 1. - group_mask 
-            mins = tf.reduce_min(mins, axis=2, keep_dims=True) # (num_cells, num_cells, 1, 2)
-            maxs = maxs * group_mask
-            maxs = tf.reduce_max(maxs, axis=2, keep_dims=True)
-            group_bounding_boxes_per_cell = tf.concat([mins, maxs], axis=-1)
-            group_bounding_boxes_per_cell = tf.clip_by_value(group_bounding_boxes_per_cell, 0., 1.)
-            output["group_bounding_boxes_per_cell"] = group_bounding_boxes_per_cell
-            
-            num_bbs_per_cell = tf.reduce_sum(group_mask, axis=2, keep_dims=True) 
-            num_group_boxes = tf.reduce_sum(tf.to_int32(num_bbs_per_cell > 0))
-            output["num_group_boxes"] = num_group_boxes
-            
-            group_flags = tf.maximum(tf.minimum(num_bbs_per_cell, 2.) - 1., 0.)
-            output["group_flags"] = group_flags
-          
-        # is_flipped flag: (), indicates whether the image has been flipped during data augmentation
-        output["is_flipped"] = tf.constant(0.)
-            
+        if random_crop_scale_size is None:
+            output = parse_basic_feature(parsed_features, image_folder, image_format, image_size=image_size)
+        else:
+            output = parse_basic_feature(parsed_features, image_folder, image_format, image_size=random_crop_scale_size)
+            output = apply_random_crop(output, image_size, 
+                                       intersection_ratio_threshold=random_crop_intersection_ratio_threshold)
         # Optional : add classes
+        class_labels = None
         if with_classes:            
             class_labels = tf.one_hot(parsed_features['classes'], num_classes, 
                                       axis=-1, on_value=1, off_value=0, dtype=tf.int32)
             output['class_labels'] = class_labels
             
-            # Group classes (majority vote) # (num_cells, num_cells, 1, num_classes)
-            if with_groups:
-                percell_class_labels = tf.expand_dims(tf.expand_dims(class_labels, axis=0), axis=0)
-                percell_class_labels = group_mask * tf.to_float(percell_class_labels)
-                percell_class_labels = tf.reduce_sum(percell_class_labels, axis=2, keep_dims=True)
-                group_class_labels = tf.argmax(percell_class_labels, axis=-1)
-                group_class_labels = tf.one_hot(group_class_labels, num_classes,
-                                                axis=-1, on_value=1, off_value=0, dtype=tf.int32)
-                group_class_labels = tf.to_int32(percell_class_labels * tf.to_float(group_class_labels))
-                output["group_class_labels"] = group_class_labels
+        # Empty/active cells mask and grouped instances
+        output.update(get_grid_targets(output['bounding_boxes'], 
+                                       output['num_boxes'], 
+                                       grid_offsets, 
+                                       with_groups=with_groups, 
+                                       grouping_method=grouping_method, 
+                                       class_labels=class_labels))
+          
+        # is_flipped flag: (), indicates whether the image has been flipped during data augmentation
+        output["is_flipped"] = tf.constant(0.)
+                
+        # Optional: importance sampling weight
+        if importance_weight is not None:
+            output['importance_weights'] = importance_weight
         return output
                     
         
     ## Create the dataset
     with tf.name_scope('load_dataset'):
         # Parse data
-        dataset = tf.data.TFRecordDataset(tfrecords_file)     
+        if sampler is not None:
+            assert shard is None and filter_ids is None
+            dataset = tf.data.Dataset.from_generator(
+                lambda: sampler.sample(num_epochs * sampler.num_samples), (tf.string, tf.float32), ((), ()))
+        elif shard is not None and shard[0] > 1:
+            num_shards, shard_index = shard
+            if isinstance(tfrecords_file, (list, tuple)) and len(tfrecords_file) >= num_shards:
+                dataset = tf.data.TFRecordDataset(list(tfrecords_file[shard_index::num_shards]))
+            else:
+                dataset = tf.data.TFRecordDataset(tfrecords_file).shard(num_shards, shard_index)
+        else:
+            dataset = tf.data.TFRecordDataset(tfrecords_file)     
+        # Filter (before loading the images)
+        if filter_ids is not None:
+            im_id_feature = {'im_id': features['im_id']}
+            def filter_function(example_proto):
+                im_id = tf.cast(tf.parse_single_example(example_proto, im_id_feature)['im_id'], tf.int32)
+                return tf.logical_or(tf.equal(tf.size(filter_ids), 0), tf.reduce_any(tf.equal(filter_ids, im_id)))
+            dataset = dataset.filter(filter_function)
         # Map
-        dataset = dataset.shuffle(buffer_size=shuffle_buffer)
+        if sampler is None:
+            dataset = dataset.shuffle(buffer_size=shuffle_buffer)
         dataset = dataset.map(parsing_function, num_parallel_calls=num_threads)
         # Repeat
-        if num_epochs > 1:
+        if num_epochs > 1 and sampler is None:
             dataset = dataset.repeat(num_epochs)
         # Batch
         if tf.__version__ == '1.4.0':
@@ -288,33 +410,242 @@ def get_tf_dataset(tfrecords_file,
             iterator = dataset.make_one_shot_iterator()    
             iterator_init = None
 
-    batch = iterator.get_next()
+    def get_next_inputs():
+        batch = iterator.get_next()
         
-    ## Apply data augmentation
-    with tf.name_scope('data_augmentation'):
-        if data_augmentation_threshold > 0.:
-            batch = apply_data_augmentation(batch, data_augmentation_threshold)      
+        ## Apply data augmentation
+        with tf.name_scope('data_augmentation'):
+            if data_augmentation_threshold > 0.:
+                batch = apply_data_augmentation(batch, data_augmentation_threshold)      
+            
+        ## Pad the last batch so that every device receives exactly `batch_size` samples
+        ## (zero-size splits break the reshape operations of the later stages)
+        if pad_remainder:
+            with tf.name_scope('pad_remainder'):
+                full_batch_size = batch_size * num_devices
+                current_batch_size = tf.shape(batch['im_id'])[0]
+                for key, value in list(batch.items()):
+                    paddings = [[0, full_batch_size - current_batch_size]] + [[0, 0]] * (len(value.get_shape()) - 1)
+                    batch[key] = tf.pad(value, paddings)
+                batch['is_valid'] = tf.sequence_mask(current_batch_size, full_batch_size)
         
-    ## Split across device
-    slice_dims = [0] * num_devices
-    unpadded_batch = tf.to_int32(tf.shape(batch['im_id'])[0])
-    for i in range(num_devices):
-        slice_dims[i] = tf.maximum(0, tf.minimum(batch_size, unpadded_batch))
-        unpadded_batch -= batch_size
+        ## Split across device
+        slice_dims = [0] * num_devices
+        unpadded_batch = tf.to_int32(tf.shape(batch['im_id'])[0])
+        for i in range(num_devices):
+            slice_dims[i] = tf.maximum(0, tf.minimum(batch_size, unpadded_batch))
+            unpadded_batch -= batch_size
         
-    inputs = [{} for _ in range(num_devices)]
-    for key, value in batch.items():
-        for i, split_value in enumerate(tf.split(value, slice_dims, axis=0)):
-            inputs[i][key] = split_value            
+        inputs = [{} for _ in range(num_devices)]
+        for key, value in batch.items():
+            for i, split_value in enumerate(tf.split(value, slice_dims, axis=0)):
+                inputs[i][key] = split_value            
               
-    ## Verbose log
+        ## Verbose log
+        if verbose == 2:
+            print('\n'.join("    \033[32m%s\033[0m: shape=%s, dtype=%s" % (key, value.get_shape().as_list(), value.dtype) 
+                            for key, value in inputs[0].items()))
+        elif verbose == 1:
+            print('\n'.join("    *%s*: shape=%s, dtype=%s" % (key, value.get_shape().as_list(), value.dtype) 
+                            for key, value in inputs[0].items()))
+        return inputs
+
+    if as_function:
+        return get_next_inputs, iterator_init
+    return get_next_inputs(), iterator_init
+
+
+class ImportanceSampler(object):
+    """Loss-aware sampling of the training images: keeps a running average of the loss of each image and draws
+    images with a probability proportional to it, mixed with a uniform distribution so that every image keeps a
+    chance to be seen. Each sample comes with the importance weight `1 / (num_samples * p)`, which keeps the
+    weighted loss an unbiased estimate of the loss under uniform sampling.
+    
+    Images that were not seen yet are given the mean loss of the seen ones.
+    """
+    
+    def __init__(self, tfrecords_file, uniform_ratio=0.2, momentum=0.9, resample_every=256, seed=None):
+        """
+        Args:
+            tfrecords_file: Path to the TFRecords file, or list of paths of the TFRecords shards
+            uniform_ratio: Weight of the uniform distribution in the sampling distribution (in ]0, 1])
+            momentum: Momentum of the running loss of each image
+            resample_every: Number of samples drawn before the sampling distribution is updated
+            seed: Random seed
+        """
+        assert 0. < uniform_ratio <= 1.
+        assert 0. <= momentum < 1.
+        self.uniform_ratio = uniform_ratio
+        self.momentum = momentum
+        self.resample_every = resample_every
+        self.random_state = np.random.RandomState(seed)
+        # Index the serialized records (the images themselves are loaded from the image folder)
+        self.records = []
+        im_ids = []
+        for path in (tfrecords_file if isinstance(tfrecords_file, (list, tuple)) else [tfrecords_file]):
+            for record in tf.python_io.tf_record_iterator(path):
+                self.records.append(record)
+                im_ids.append(tf.train.Example.FromString(record).features.feature['im_id'].int64_list.value[0])
+        self.num_samples = len(self.records)
+        assert self.num_samples > 0
+        self.index = {im_id: i for i, im_id in enumerate(im_ids)}
+        self.losses = np.full(self.num_samples, np.nan)
+        self.lock = threading.Lock()
+        
+    def get_probabilities(self):
+        """Returns the current sampling distribution over the records"""
+        with self.lock:
+            losses = np.copy(self.losses)
+        is_seen = ~np.isnan(losses)
+        uniform = np.full(self.num_samples, 1. / self.num_samples)
+        if not np.any(is_seen):
+            return uniform
+        losses[~is_seen] = np.mean(losses[is_seen])
+        losses = np.maximum(0., losses)
+        total = np.sum(losses)
+        if total <= 0.:
+            return uniform
+        return (1. - self.uniform_ratio) * losses / total + self.uniform_ratio * uniform
+    
+    def sample(self, num_samples):
+        """Generator yielding `num_samples` (serialized record, importance weight) pairs"""
+        while num_samples > 0:
+            probabilities = self.get_probabilities()
+            indices = self.random_state.choice(
+                self.num_samples, size=min(num_samples, self.resample_every), p=probabilities)
+            for i in indices:
+                yield self.records[i], np.float32(1. / (self.num_samples * probabilities[i]))
+            num_samples -= len(indices)
+            
+    def update(self, im_ids, losses):
+        """Update the running loss of the given images
+        
+        Args:
+            im_ids: A (num_images,) array of image ids (possibly repeated, e.g. for crops)
+            losses: A (num_images,) array of the corresponding losses
+        """
+        with self.lock:
+            for im_id, loss in zip(im_ids, losses):
+                i = self.index.get(im_id, None)
+                if i is None or not np.isfinite(loss):
+                    continue
+                if np.isnan(self.losses[i]):
+                    self.losses[i] = loss
+                else:
+                    self.losses[i] = self.momentum * self.losses[i] + (1. - self.momentum) * loss
+                    
+    def summary(self):
+        """Returns a short description of the current sampling distribution"""
+        probabilities = self.get_probabilities()
+        return 'seen %.1f%% images, max/min sampling ratio %.2f' % (
+            100. * np.mean(~np.isnan(self.losses)), np.max(probabilities) / np.min(probabilities))
+
+
+def get_crops_dataset(tfrecords_files,
+                      max_num_bbs,
+                      image_size,
+                      num_cells,
+                      with_classes=False,
+                      num_classes=None,
+                      batch_size=1,
+                      num_epochs=1,
+                      data_augmentation_threshold=0.5,
+                      num_devices=1,
+                      num_threads=4,
+                      shuffle_buffer=1,
+                      prefetch_capacity=1,
+                      as_function=False,
+                      verbose=1):
+    """Load the stage 2 training inputs written by `extract_crops.py` as a tf.data.Dataset.
+
+    Args:
+      tfrecords_files: List of TFRecords shards
+      max_num_bbs: Maximum number of bounding boxes in the dataset
+      image_size: Size of the stored crops
+      num_cells: Size of the stage 2 output grid the `obj_i_mask_bbs` were computed for
+      with_classes: wheter to load the class labels
+      num_classes: Number of classes in the dataset
+      batch_size: Batch size per device
+      num_epochs: Number of epochs to repeat.
+      data_augmentation_threshold: Data augmentation (horizontal flip) probability
+      num_devices: Number of devices to split the batch across.
+      num_threads: Number of parallel read
+      shuffle_buffer: Size of the shuffle buffer
+      prefetch_capacity: Buffer size for prefetching.
+      as_function: if True, return a function creating new inputs from the shared iterator at each call
+      verbose: Verbosity level
+
+    Returns:
+      A list with `num_devices` elements, each being a dictionnary of inputs.
+    """
     if verbose == 2:
-        print('\n'.join("    \033[32m%s\033[0m: shape=%s, dtype=%s" % (key, value.get_shape().as_list(), value.dtype) 
-                        for key, value in inputs[0].items()))
+        print(' \033[31m> load_crops\033[0m')
     elif verbose == 1:
-        print('\n'.join("    *%s*: shape=%s, dtype=%s" % (key, value.get_shape().as_list(), value.dtype) 
-                        for key, value in inputs[0].items()))
-    return inputs, iterator_init
+        print(' > load_crops')
+
+    # Create TFRecords feature
+    record_keys = ['im_id', 'image', 'num_boxes', 'bounding_boxes', 'obj_i_mask_bbs']
+    if with_classes:
+        record_keys.append('classes')
+    features = read_tfrecords(record_keys, max_num_bbs=max_num_bbs, num_cells=num_cells)
+
+    def parsing_function(example_proto):
+        parsed_features = tf.parse_single_example(example_proto, features)
+        image = tf.image.decode_png(parsed_features['image'], channels=3)
+        image = tf.image.convert_image_dtype(image, tf.float32)
+        image.set_shape((image_size, image_size, 3))
+        output = {'im_id': tf.cast(parsed_features['im_id'], tf.int32),
+                  'image': image,
+                  'num_boxes': tf.cast(parsed_features['num_boxes'], tf.int32),
+                  'bounding_boxes': parsed_features['bounding_boxes'],
+                  'obj_i_mask_bbs': parsed_features['obj_i_mask_bbs'],
+                  'is_flipped': tf.constant(0.)}
+        if with_classes:
+            output['class_labels'] = tf.one_hot(parsed_features['classes'], num_classes,
+                                                axis=-1, on_value=1, off_value=0, dtype=tf.int32)
+        return output
+
+    ## Create the dataset
+    with tf.name_scope('load_dataset'):
+        dataset = tf.data.TFRecordDataset(tfrecords_files)
+        dataset = dataset.shuffle(buffer_size=shuffle_buffer)
+        dataset = dataset.map(parsing_function, num_parallel_calls=num_threads)
+        if num_epochs > 1:
+            dataset = dataset.repeat(num_epochs)
+        if tf.__version__ == '1.4.0':
+            dataset = dataset.batch(batch_size * num_devices)
+        else:
+            dataset = dataset.batch(batch_size * num_devices, drop_remainder=True)
+        if prefetch_capacity > 0:
+            dataset = dataset.prefetch(prefetch_capacity)
+        iterator = dataset.make_one_shot_iterator()
+
+    def get_next_inputs():
+        batch = iterator.get_next()
+
+        ## Apply data augmentation
+        with tf.name_scope('data_augmentation'):
+            if data_augmentation_threshold > 0.:
+                batch = apply_data_augmentation(batch, data_augmentation_threshold)
+
+        ## Split across device
+        inputs = [{} for _ in range(num_devices)]
+        for key, value in batch.items():
+            for i, split_value in enumerate(tf.split(value, num_devices, axis=0)):
+                inputs[i][key] = split_value
+
+        ## Verbose log
+        if verbose == 2:
+            print('\n'.join("    \033[32m%s\033[0m: shape=%s, dtype=%s" % (key, value.get_shape().as_list(), value.dtype)
+                            for key, value in inputs[0].items()))
+        elif verbose == 1:
+            print('\n'.join("    *%s*: shape=%s, dtype=%s" % (key, value.get_shape().as_list(), value.dtype)
+                            for key, value in inputs[0].items()))
+        return inputs
+
+    if as_function:
+        return get_next_inputs
+    return get_next_inputs()
 
 
 def filter_individuals(predicted_boxes, predicted_scores, predicted_group_flags, strong_confidence_threshold=1.0):
@@ -343,10 +674,123 @@ def filter_threshold(predicted_boxes, predicted_scores, confidence_threshold=-1.
     return predicted_boxes, predicted_scores
 
 
+CROP_DIFFICULTY_NUM_BUCKETS = 8
+
+
+def get_crop_difficulty():
+    """Running stage 2 loss of the training crops, per number of ground-truth boxes they contain (the last bucket 
+    gathers all crops with more boxes). Shared by all towers, and not saved in checkpoints."""
+    with tf.variable_scope('crop_sampler', reuse=tf.AUTO_REUSE):
+        return tf.get_variable('stage2_difficulty', shape=(CROP_DIFFICULTY_NUM_BUCKETS,), dtype=tf.float32,
+                               initializer=tf.ones_initializer(), trainable=False,
+                               collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+
+def update_crop_difficulty(num_boxes, per_crop_loss, momentum=0.9):
+    """Update the running stage 2 loss of each bucket of crops from the losses of the current batch of crops.
+    
+    Args:
+        num_boxes: A (num_crops,) integer Tensor, number of ground-truth boxes in each crop
+        per_crop_loss: A (num_crops,) Tensor, stage 2 loss of each crop
+        momentum: Momentum of the running losses
+        
+    Returns:
+        The update operation
+    """
+    crop_difficulty = get_crop_difficulty()
+    with tf.name_scope('update_crop_difficulty'):
+        buckets = tf.minimum(num_boxes, CROP_DIFFICULTY_NUM_BUCKETS - 1)
+        sums = tf.unsorted_segment_sum(per_crop_loss, buckets, CROP_DIFFICULTY_NUM_BUCKETS)
+        counts = tf.unsorted_segment_sum(tf.ones_like(per_crop_loss), buckets, CROP_DIFFICULTY_NUM_BUCKETS)
+        new_difficulty = tf.where(counts > 0., 
+                                  momentum * crop_difficulty + (1. - momentum) * sums / tf.maximum(1., counts),
+                                  crop_difficulty)
+        return tf.assign(crop_difficulty, new_difficulty)
+
+
+def sample_training_crops(predicted_boxes,
+                          predicted_scores,
+                          ground_truth_boxes,
+                          num_outputs,
+                          nms_threshold=0.5,
+                          positive_ratio=0.75,
+                          intersection_ratio_threshold=0.33,
+                          epsilon=1e-3):
+    """ Diversity-aware sampling of the stage 2 training crops. Candidates are ranked by their confidence scaled 
+    by the current stage 2 loss on crops with as many ground-truth boxes (see `get_crop_difficulty`), so that
+    crops on which stage 2 does badly are favoured. Near-duplicates are suppressed with NMS, separately for crops 
+    with and without ground-truth boxes, and `positive_ratio` of the output crops contain ground-truth. If there
+    are not enough candidates of one kind, the other kind completes the crops.
+    
+    Args:
+        predicted_boxes: A (batch_size, num_boxes, 4) Tensor of candidate crops
+        predicted_scores: A (batch_size, num_boxes) Tensor of confidence scores
+        ground_truth_boxes: A (batch_size, max_num_bbs, 4) Tensor of ground-truth boxes
+        num_outputs: Number of crops to sample per image
+        nms_threshold: IoU threshold for suppressing near-duplicate crops
+        positive_ratio: Ratio of crops containing ground-truth boxes
+        intersection_ratio_threshold: A box counts in a crop if at least this ratio of its area is inside
+        epsilon: Minimum confidence, so that the difficulty still ranks zero-confidence candidates
+        
+    Returns:
+        A (batch_size, num_outputs, 4) Tensor of crops, padded with empty crops, and their (batch_size, num_outputs) 
+        priorities
+    """
+    num_positives = int(round(positive_ratio * num_outputs))
+    num_negatives = num_outputs - num_positives
+    
+    ## Number of ground-truth boxes in each candidate
+    # ratios: (batch, num_boxes, max_num_bbs, 1)
+    with tf.name_scope('count_boxes'):
+        ratios = utils.get_intersection_ratio(tf.split(tf.expand_dims(ground_truth_boxes, axis=1), 4, axis=-1),
+                                              tf.split(tf.expand_dims(predicted_boxes, axis=2), 4, axis=-1))
+        num_boxes = tf.to_int32(tf.reduce_sum(tf.to_float(ratios > intersection_ratio_threshold), axis=(2, 3)))
+        is_positive = num_boxes > 0
+    
+    ## Priorities
+    with tf.name_scope('priorities'):
+        crop_difficulty = get_crop_difficulty()
+        crop_difficulty /= tf.maximum(1e-8, tf.reduce_mean(crop_difficulty))
+        difficulty = tf.gather(crop_difficulty, tf.minimum(num_boxes, CROP_DIFFICULTY_NUM_BUCKETS - 1))
+        priorities = (tf.maximum(0., predicted_scores) + epsilon) * difficulty
+        
+    ## Sample crops for each image
+    def sample_crops(args):
+        boxes, scores, positive = args
+        selected_indices = []
+        selected_valid = []
+        for mask in [positive, tf.logical_not(positive)]:
+            # Candidates of the other kind come last, and are only selected if there are not enough candidates
+            selected = tf.image.non_max_suppression(
+                boxes, tf.where(mask, scores, scores - 2. * tf.reduce_max(scores) - 1.), num_outputs, 
+                iou_threshold=nms_threshold)
+            is_valid = tf.gather(mask, selected)
+            padding = [[0, num_outputs - tf.shape(selected)[0]]]
+            selected_indices.append(tf.pad(selected, padding))
+            selected_valid.append(tf.pad(is_valid, padding))
+        # Priority order: the first `num_positives` positives and `num_negatives` negatives, then the other ones
+        rank = tf.concat([tf.cumsum(tf.to_int32(x)) for x in selected_valid], axis=0)
+        quota = tf.concat([tf.fill((num_outputs,), num_positives), tf.fill((num_outputs,), num_negatives)], axis=0)
+        is_valid = tf.concat(selected_valid, axis=0)
+        order = 2. * tf.to_float(tf.logical_and(is_valid, rank <= quota)) + tf.to_float(is_valid)
+        order -= tf.range(2 * num_outputs, dtype=tf.float32) / (2. * num_outputs)
+        _, top_indices = tf.nn.top_k(order, k=num_outputs)
+        indices = tf.gather(tf.concat(selected_indices, axis=0), top_indices)
+        is_valid = tf.to_float(tf.expand_dims(tf.gather(is_valid, top_indices), axis=-1))
+        # Empty crops for padding, as in `utils.nms_with_pad`
+        crops = tf.gather(boxes, indices) * is_valid + np.array([1., 1., 0., 0.], dtype=np.float32) * (1. - is_valid)
+        return crops, tf.gather(scores, indices) * tf.squeeze(is_valid, axis=-1)
+    
+    with tf.name_scope('sample_crops'):
+        return tf.map_fn(sample_crops, (predicted_boxes, priorities, is_positive), dtype=(tf.float32, tf.float32),
+                         back_prop=False)
+
+
 def extract_groups(predicted_boxes,
                    predicted_scores,
                    predicted_group_flags=None,
                    predicted_offsets=None,
+                   ground_truth_boxes=None,
                    mode='train',
                    verbose=False,
                    epsilon=1e-8,
@@ -358,6 +802,7 @@ def extract_groups(predicted_boxes,
         predicted_scores: A (batch_size, num_cells, num_cells, num_boxes, 1) array
         predicted_group_flags: A (batch_size, num_cells, num_cells, num_boxes, 1) array
         predicted_offsets: A (batch_size, num_cells, num_cells, num_boxes, 2) array
+        ground_truth_boxes: A (batch_size, max_num_bbs, 4) array, used by the training crops sampler
         mode: If test, the boxes are only passed to the next stage if they are worth being refined 
             (ie groups or unprecise individual)
         
@@ -366,6 +811,7 @@ def extract_groups(predicted_boxes,
         patch_nms_threshold: NMS threshold
         {train, test}_num_crops: Number of crops to extract
         test_patch_strong_confidence_threshold: high confidence threshold
+        train_crop_sampler: If True, sample the training crops with `sample_training_crops`
         previous_batch_size: Batch size of the previous stage (for which `predicted boxes` where output). Needs 
             to be statistically known for the NMS loop.
         
@@ -391,7 +837,7 @@ def extract_groups(predicted_boxes,
         predicted_scores = utils.flatten_percell_output(predicted_scores)
         
     ## Filter
-    kept_out_filter = tf.zeros(tf.shape(predicted_scores)) # default
+    kept_out_filter = tf.zeros(tf.shape(predicted_scores)[:-1]) # default, (batch, num_boxes)
     with tf.name_scope('filter_groups'):
         # At test time, we keep out individual confidences with high confidence
         # we save these `shortcut` boxes in the `kept_out_filter` Tensor
@@ -407,6 +853,13 @@ def extract_groups(predicted_boxes,
             with tf.name_scope('filter_confidence'):
                 predicted_boxes, predicted_scores = filter_threshold(
                     predicted_boxes, predicted_scores, confidence_threshold)
+                
+        # With a latency budget, rank the candidates by confidence, favouring groups that benefit the most
+        # from being refined (the kept out individuals have a zero confidence)
+        if mode in ['test', 'val'] and predicted_group_flags is not None and get_defaults(
+                kwargs, ['test_latency_budget_ms'], verbose=verbose)[0] is not None:
+            group_priority = get_defaults(kwargs, ['test_latency_group_priority'], verbose=verbose)[0]
+            predicted_scores *= 1. + group_priority * utils.flatten_percell_output(tf.nn.sigmoid(predicted_group_flags))
         
     ## Rescale remaining  boxes with the learned offsets
     with tf.name_scope('offsets_rescale_boxes'):
@@ -418,7 +871,19 @@ def extract_groups(predicted_boxes,
     # crop_boxes: (batch, num_crops, 4)
     # crop_boxes_confidences: (batch, num_crops)
     predicted_scores = tf.squeeze(predicted_scores, axis=-1)
-    if isinstance(num_outputs, tf.Tensor) or num_outputs > 0:    
+    use_crop_sampler = mode == 'train' and get_defaults(kwargs, ['train_crop_sampler'], verbose=verbose)[0]
+    if use_crop_sampler and ground_truth_boxes is not None:
+        crop_nms_threshold, positive_ratio, intersection_ratio_threshold = get_defaults(kwargs, [
+            'train_crop_sampler_nms_threshold', 'train_crop_sampler_positive_ratio', 
+            'patch_intersection_ratio_threshold'], verbose=verbose)
+        if verbose:
+            print('    sampling crops with NMS %.2f and %d%% positive crops' % (crop_nms_threshold, 100 * positive_ratio))
+        with tf.name_scope('crop_sampler'):
+            predicted_boxes, predicted_scores = sample_training_crops(
+                predicted_boxes, predicted_scores, ground_truth_boxes, num_outputs, 
+                nms_threshold=crop_nms_threshold, positive_ratio=positive_ratio, 
+                intersection_ratio_threshold=intersection_ratio_threshold)
+    elif isinstance(num_outputs, tf.Tensor) or num_outputs > 0:    
         # Non-Maximum Suppression: outputs the top `num_outputs` boxes after NMS
         if (isinstance(nms_threshold, tf.Tensor) or nms_threshold < 1.0) or (isinstance(num_outputs, tf.Tensor)):
             batch_size = get_defaults(kwargs, ['previous_batch_size'], verbose=verbose)[0]
@@ -457,6 +922,99 @@ def extract_groups(predicted_boxes,
     return predicted_boxes, predicted_scores, kept_out_filter
 
 
+def get_valid_crops_mask(crop_boxes):
+    """Returns a boolean mask of the non-empty crops in the given (..., 4) Tensor of crops"""
+    return tf.logical_and(crop_boxes[..., 2] > crop_boxes[..., 0], crop_boxes[..., 3] > crop_boxes[..., 1])
+
+
+def coalesce_crops(crop_boxes, max_size=0.5):
+    """ Merge overlapping or nested crops, as long as their union fits in a square of side `max_size` (relatively 
+    to the image size). At each iteration, each image merges the pair of crops whose union wastes the least area
+    (area of the union not covered by either crop). The union replaces the first crop of the pair, which keeps the
+    ranking of the crops, and the second one is emptied. Every box of the original crops is still in a crop.
+    
+    Args:
+        crop_boxes: A (batch_size, num_crops, 4) Tensor of crops, as output by `extract_groups`
+        max_size: Maximum side of a merged crop
+        
+    Returns:
+        A (batch_size, num_crops, 4) Tensor of crops
+    """
+    empty_crop = np.array([1., 1., 0., 0.], dtype=np.float32)
+    def get_area(boxes):
+        return tf.reduce_prod(tf.maximum(0., boxes[..., 2:] - boxes[..., :2]), axis=-1)
+    
+    def merge_step(i, boxes):
+        batch_size, num_crops = tf.shape(boxes)[0], tf.shape(boxes)[1]
+        is_valid = get_valid_crops_mask(boxes)
+        # Union and intersection of every pair: (batch, num_crops, num_crops, 4)
+        a = tf.expand_dims(boxes, axis=2)
+        b = tf.expand_dims(boxes, axis=1)
+        union = tf.concat([tf.minimum(a[..., :2], b[..., :2]), tf.maximum(a[..., 2:], b[..., 2:])], axis=-1)
+        intersection = tf.concat([tf.maximum(a[..., :2], b[..., :2]), tf.minimum(a[..., 2:], b[..., 2:])], axis=-1)
+        wasted_area = get_area(union) - get_area(a) - get_area(b) + get_area(intersection)
+        # Pairs of valid crops (i < j) whose union fits in the budget
+        is_pair = tf.matrix_band_part(tf.ones((num_crops, num_crops)), 0, -1) - tf.eye(num_crops)
+        can_merge = tf.logical_and(tf.logical_and(tf.expand_dims(is_valid, 2), tf.expand_dims(is_valid, 1)),
+                                   tf.reduce_max(union[..., 2:] - union[..., :2], axis=-1) <= max_size)
+        can_merge = tf.logical_and(can_merge, is_pair > 0.)
+        wasted_area = tf.reshape(tf.where(can_merge, wasted_area, 2. * tf.ones_like(wasted_area)), (batch_size, -1))
+        # Merge the best pair of each image
+        best_pair = tf.to_int32(tf.argmin(wasted_area, axis=-1))
+        do_merge = tf.to_float(tf.reduce_min(wasted_area, axis=-1) <= 1.)
+        first, second = best_pair // num_crops, best_pair % num_crops
+        merged = tf.gather_nd(union, tf.stack([tf.range(batch_size), first, second], axis=-1))
+        first = tf.expand_dims(tf.one_hot(first, num_crops) * tf.expand_dims(do_merge, 1), axis=-1)
+        second = tf.expand_dims(tf.one_hot(second, num_crops) * tf.expand_dims(do_merge, 1), axis=-1)
+        boxes = boxes * (1. - first - second) + first * tf.expand_dims(merged, axis=1) + second * empty_crop
+        return i + 1, boxes
+    
+    with tf.name_scope('coalesce_crops'):
+        _, crop_boxes = tf.while_loop(lambda i, _: i < tf.shape(crop_boxes)[1] - 1, merge_step, 
+                                      [tf.constant(0), crop_boxes], back_prop=False)
+    return crop_boxes
+
+
+def select_crops_within_budget(crop_boxes, crop_scores, latency_budget_ms, latency_model, per_batch=False):
+    """ Keep the highest ranked crops that the next stage can process within the given latency budget, according 
+    to a linear cost model of the cascade: `stage1_ms` per image, and `stage2_fixed_ms` plus `stage2_per_crop_ms` 
+    per crop for the next stage (which only runs on the non-empty crops). The next stage runs once on the crops 
+    of the whole batch, so its fixed cost is shared by the images of the batch. The other crops are emptied.
+    
+    Args:
+        crop_boxes: A (batch_size, num_crops, 4) Tensor of crops, sorted by decreasing priority for each image
+        crop_scores: The corresponding (batch_size, num_crops) priorities
+        latency_budget_ms: Latency budget (in milliseconds), for each image or for the whole batch
+        latency_model: Dictionnary of the cost model parameters, see `benchmark.py calibrate`
+        per_batch: If True, the budget is shared by the whole batch, and its crops are ranked together. 
+            Otherwise, each image has its own budget
+        
+    Returns:
+        A (batch_size, num_crops, 4) Tensor of crops
+    """
+    with tf.name_scope('latency_budget'):
+        is_valid = get_valid_crops_mask(crop_boxes)
+        num_images = tf.to_float(tf.shape(crop_boxes)[0])
+        if per_batch:
+            remaining_ms = (tf.to_float(latency_budget_ms) - latency_model['stage1_ms'] * num_images - 
+                            latency_model['stage2_fixed_ms'])
+        else:
+            remaining_ms = (tf.to_float(latency_budget_ms) - latency_model['stage1_ms'] - 
+                            latency_model['stage2_fixed_ms'] / num_images)
+        max_num_crops = tf.to_int32(tf.floor(remaining_ms / max(1e-8, latency_model['stage2_per_crop_ms'])))
+        if per_batch:
+            # Rank of each crop in the batch
+            scores = tf.reshape(tf.where(is_valid, crop_scores, crop_scores - 2. * tf.reduce_max(tf.abs(
+                crop_scores)) - 1.), (-1,))
+            _, order = tf.nn.top_k(scores, k=tf.size(scores))
+            rank = tf.reshape(tf.invert_permutation(order), tf.shape(crop_scores))
+        else:
+            # Rank of each crop in its image
+            rank = tf.cumsum(tf.to_int32(is_valid), axis=-1, exclusive=True)
+        keep = tf.to_float(tf.expand_dims(tf.logical_and(is_valid, rank < max_num_crops), axis=-1))
+        return crop_boxes * keep + np.array([1., 1., 0., 0.], dtype=np.float32) * (1. - keep)
+
+
 def tile_and_reshape(t, num_crops):
     """ Given an initial Tensor `t` of shape (batch_size, s1...sn), tile and reshape it to size 
         (batch_size * `num_crops`, s1..sn) to be forwarded to the next stage input.
@@ -474,8 +1032,33 @@ def tile_and_reshape(t, num_crops):
     return t
 
 
+def roi_align(features, boxes, box_indices, output_size, sampling_ratio=2):
+    """RoI Align: bilinearly sample `sampling_ratio` x `sampling_ratio` points in each output bin of each box, 
+    and average them.
+    
+    Args:
+        features: A (batch_size, height, width, num_channels) Tensor of feature maps
+        boxes: A (num_boxes, 4) Tensor of normalized boxes (ymin, xmin, ymax, xmax), as for `crop_and_resize`
+        box_indices: A (num_boxes,) Tensor, index of the feature map of each box
+        output_size: Number of output bins along each axis
+        sampling_ratio: Number of samples per bin along each axis
+        
+    Returns:
+        A (num_boxes, output_size, output_size, num_channels) Tensor
+    """
+    with tf.name_scope('roi_align'):
+        size = output_size * sampling_ratio
+        features = tf.image.crop_and_resize(features, boxes, box_indices, (size, size))
+        if sampling_ratio > 1:
+            features = tf.nn.avg_pool(features, [1, sampling_ratio, sampling_ratio, 1], 
+                                      [1, sampling_ratio, sampling_ratio, 1], 'VALID')
+        return features
+
+
 def get_next_stage_inputs(inputs, 
                           crop_boxes,
+                          features=None,
+                          roi_sampling_ratio=2,
                           batch_size=None,
                           image_size=256,
                           previous_batch_size=None,
@@ -483,6 +1066,8 @@ def get_next_stage_inputs(inputs,
                           image_folder=None,
                           image_format=None,
                           grid_offsets=None,
+                          with_groups=False,
+                          grouping_method='intersect',
                           intersection_ratio_threshold=0.25,
                           epsilon=1e-8,
                           use_queue=False,
@@ -495,11 +1080,17 @@ def get_next_stage_inputs(inputs,
     Args:
         inputs, a dictionnary of inputs
         crop_boxes, a (batch_size, num_crops, 4) tensor of crops
+        features: If given, a (batch_size, height, width, num_channels) Tensor of features of the current stage.
+            The new `image` inputs are then the RoI-aligned features of each crop, of size `image_size`, instead
+            of the image pixels. No gradient flows back to the features
+        roi_sampling_ratio: Number of samples per RoI-aligned bin along each axis
         image_folder: Image directory, used for reloading the full resolution images if needed
         batch_size: Batch size for the output of this pipeline
         image_size: Size of the images patches in the new dataset
         full_image_size: Size of the images to load before applying the croppings
         grid_offsets: A (num_cells, num_cells) array
+        with_groups: whether to compute the grouped instances targets of the crops (intermediate stages)
+        grouping_method: Criterion to determine whether an object "belongs" to a cell
         use_queue: Whether to use a queue or directly output the new inputs dictionary
         shuffle_buffer: shuffle buffer of the output queue
         num_threads: number of readers in the output queue
@@ -515,6 +1106,11 @@ def get_next_stage_inputs(inputs,
         with tf.name_scope('im_ids'):
             new_inputs['im_id'] = tile_and_reshape(inputs['im_id'], num_crops)        
         
+    # importance sampling weights: (batch_size * num_crops,)
+    if 'importance_weights' in inputs:
+        with tf.name_scope('importance_weights'):
+            new_inputs['importance_weights'] = tile_and_reshape(inputs['importance_weights'], num_crops)
+        
     # classes: (batch_size * num_crops, num_classes)
     if 'class_labels' in inputs:
         with tf.name_scope('class_labels'):
@@ -529,9 +1125,13 @@ def get_next_stage_inputs(inputs,
         crop_boxes_indices = tf.cumsum(crop_boxes_indices, axis=0, exclusive=True)
         crop_boxes_indices = tf.reshape(crop_boxes_indices, (-1,))
         crop_boxes_flat = tf.gather(tf.reshape(crop_boxes, (-1, 4)), [1, 0, 3, 2], axis=-1)
-        new_inputs['image'] = tf.image.crop_and_resize(
-            inputs['image'], crop_boxes_flat, crop_boxes_indices, 
-            (image_size, image_size), name='extract_groups')
+        if features is None:
+            new_inputs['image'] = tf.image.crop_and_resize(
+                inputs['image'], crop_boxes_flat, crop_boxes_indices, 
+                (image_size, image_size), name='extract_groups')
+        else:
+            new_inputs['image'] = roi_align(tf.stop_gradient(features), crop_boxes_flat, crop_boxes_indices, 
+                                            image_size, sampling_ratio=roi_sampling_ratio)
         
     # new_bounding_boxes: (num_patches, max_num_bbs, 4)
     # rescale bounding boxes coordinates to the cropped image
@@ -579,6 +1179,23 @@ def get_next_stage_inputs(inputs,
                 obj_i_mask = tf.expand_dims(tf.to_float(inters > 0.) , axis=-2)
                 new_inputs['obj_i_mask_bbs'] = obj_i_mask
         
+    # Grouped instances targets of each crop: (num_patches, num_cells, num_cells, 1, ...)
+    if with_groups and 'num_boxes' in inputs:
+        assert grid_offsets is not None
+        with tf.name_scope('group_targets'):
+            elems = [new_inputs['bounding_boxes'], new_inputs['num_boxes']]
+            dtype = {'obj_i_mask_bbs': tf.float32, 'group_bounding_boxes_per_cell': tf.float32, 
+                     'num_group_boxes': tf.int32, 'group_flags': tf.float32}
+            if 'class_labels' in new_inputs:
+                elems.append(new_inputs['class_labels'])
+                dtype['group_class_labels'] = tf.int32
+            group_targets = tf.map_fn(
+                lambda x: get_grid_targets(x[0], x[1], grid_offsets, grouping_method=grouping_method, 
+                                           class_labels=x[2] if len(x) > 2 else None),
+                elems, dtype=dtype, back_prop=False)
+            del group_targets['obj_i_mask_bbs']
+            new_inputs.update(group_targets)
+        
     # During training: enqueue the inputs
     if use_queue:
         assert batch_size is not None
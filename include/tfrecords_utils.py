@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 
 
@@ -11,6 +12,11 @@ def _float_feature(value):
     return tf.train.Feature(float_list=tf.train.FloatList(value=value))
 
 
+def _bytes_feature(value):
+    """TFRecords bytes feature"""
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=value))
+
+
 def get_feature_write(key, value):
     """Choose the right feature function for the given key to write to TFRecords
     
@@ -20,10 +26,12 @@ def get_feature_write(key, value):
     """
     if key in ['im_id', 'num_boxes']:
         return _int64_feature([value])
-    elif key in['bounding_boxes']:
+    elif key in['bounding_boxes', 'obj_i_mask_bbs']:
         return _float_feature(value.flatten())
     elif key in ['classes']:
         return _int64_feature(value.flatten())
+    elif key in ['image']:
+        return _bytes_feature([value])
     else:
         raise SystemExit("Unknown feature %s" % key)    
     
@@ -37,13 +45,14 @@ def write_tfrecords(features_list):
     return {key: get_feature_write(key, value) for key, value in features_list if value is not None}
 
     
-def get_feature_read(key, max_num_bbs=None):
+def get_feature_read(key, max_num_bbs=None, num_cells=None):
     """Choose the right feature function for the given key to parse TFRecords
     
     Args:
         key: the feature name
         max_num_bbs: Max number of bounding boxes (used for `bounding_boxes` and `classes`)
         max_num_groups: Number of pre-defined groups (used for `clustered_bounding_boxes`)
+        num_cells: Size of the output grid (used for `obj_i_mask_bbs`)
     """
     if key in ['im_id', 'num_boxes']:
         return tf.FixedLenFeature((), tf.int64)
@@ -53,14 +62,38 @@ def get_feature_read(key, max_num_bbs=None):
     elif key in ['classes']:
         assert max_num_bbs is not None
         return tf.FixedLenFeature((max_num_bbs,), tf.int64) 
+    elif key in ['obj_i_mask_bbs']:
+        assert max_num_bbs is not None and num_cells is not None
+        return tf.FixedLenFeature((num_cells[0], num_cells[1], 1, max_num_bbs), tf.float32)
+    elif key in ['image']:
+        return tf.FixedLenFeature((), tf.string)
     else:
         raise SystemExit("Unknown feature", key)    
     
     
-def read_tfrecords(keys_list, max_num_bbs=None):
+def read_tfrecords(keys_list, max_num_bbs=None, num_cells=None):
     """Create a TFRecords feature from a list of pair (key, value). Same Kwargs as get_feature_read
     
     Args:
         feature_list: A list of key strings corresponding to entries in the records
     """
-    return {key: get_feature_read(key, max_num_bbs=max_num_bbs) for key in keys_list}
\ No newline at end of file
+    return {key: get_feature_read(key, max_num_bbs=max_num_bbs, num_cells=num_cells) for key in keys_list}
+
+
+def read_records_index(tfrecords_path, keys_list=('im_id', 'num_boxes')):
+    """Index the examples of a TFRecords file (in record order) without loading the images
+    
+    Args:
+        tfrecords_path: Path to the TFRecords file, or list of paths of the TFRecords shards
+        keys_list: Integer scalar features to collect
+        
+    Returns:
+        A dictionnary mapping each key to a (num_examples,) numpy array
+    """
+    index = {key: [] for key in keys_list}
+    for path in (tfrecords_path if isinstance(tfrecords_path, (list, tuple)) else [tfrecords_path]):
+        for record in tf.python_io.tf_record_iterator(path):
+            example = tf.train.Example.FromString(record)
+            for key in keys_list:
+                index[key].append(example.features.feature[key].int64_list.value[0])
+    return {key: np.array(values, dtype=np.int32) for key, values in index.items()}
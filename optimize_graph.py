@@ -0,0 +1,70 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import argparse
+
+import tensorflow as tf
+print("Tensorflow version", tf.__version__)
+
+from include import graph_manager
+from include import inference_utils
+
+
+if __name__ == '__main__':
+    ########################################################################## Configuration
+    parser = argparse.ArgumentParser(description='Build the optimized inference graph of a trained model.')
+    parser.add_argument('log_dir', type=str, help='Log directory of a trained ODGI or standard model.')
+    parser.add_argument('--split', type=str, default='val', choices=['val', 'test'],
+                        help='Split to collect the parity check images from.')
+    parser.add_argument('--num_images', type=int, default=64, help='Number of images for the parity check.')
+    parser.add_argument('--batch_size', type=int, default=1, help='Maximum batch size of the inference graph.')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='Maximum absolute difference between the original and optimized outputs.')
+    parser.add_argument('--output', type=str, help='Output graph. Defaults to `log_dir/optimized_graph.pb`.')
+    args = parser.parse_args()
+    if args.output is None:
+        args.output = os.path.join(args.log_dir, 'optimized_graph.pb')
+    is_odgi = os.path.exists(os.path.join(args.log_dir, 'stage1_config.pkl'))
+
+    ########################################################################## Original graph
+    graph = tf.Graph()
+    with graph.as_default():
+        if is_odgi:
+            model = inference_utils.build_odgi_model(args.log_dir, args.batch_size)
+        else:
+            model = inference_utils.build_standard_model(args.log_dir)
+        with tf.name_scope('inputs'):
+            inputs, initializer = graph_manager.get_inputs(mode=args.split, verbose=False, **model['config'])
+            inputs = inputs[0]
+        saver = tf.train.Saver()
+
+    print('\nOptimizing \033[36m%s\033[0m' % model['name'])
+    with tf.Session(graph=graph, config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+        checkpoint_path = tf.train.latest_checkpoint(args.log_dir)
+        assert checkpoint_path is not None, 'No checkpoint found in %s' % args.log_dir
+        saver.restore(sess, checkpoint_path)
+        pool = inference_utils.collect_images(sess, inputs['image'], initializer, args.num_images)[:args.num_images]
+        original_outputs, original_latency = inference_utils.run_outputs(
+            sess, model['images'], model['outputs'], pool, args.batch_size)
+        graph_def, input_name, output_names = inference_utils.freeze_model(sess, model)
+
+    ########################################################################## Optimized graph
+    optimized_graph_def = inference_utils.optimize_inference_graph(graph_def, [input_name], output_names)
+    optimized_graph = tf.Graph()
+    with optimized_graph.as_default():
+        images, outputs = inference_utils.import_inference_graph(optimized_graph_def, input_name=input_name)
+    with tf.Session(graph=optimized_graph) as sess:
+        optimized_outputs, optimized_latency = inference_utils.run_outputs(sess, images, outputs, pool, args.batch_size)
+
+    ########################################################################## Parity check
+    print('\n    %-20s %10s %10s' % ('', 'original', 'optimized'))
+    before, after = inference_utils.count_ops(graph_def), inference_utils.count_ops(optimized_graph_def)
+    for op in sorted(before):
+        print('    %-20s %10d %10d' % (op, before[op], after[op]))
+    print('    %-20s %9.2fms %9.2fms' % ('latency per image', original_latency, optimized_latency))
+
+    report = inference_utils.check_parity(original_outputs, optimized_outputs, args.tolerance, names=output_names)
+    assert all(x[1] for x in report), 'The optimized graph outputs differ from the original ones'
+
+    with tf.gfile.GFile(args.output, 'wb') as f:
+        f.write(optimized_graph_def.SerializeToString())
+    print('\nOptimized graph saved in \033[36m%s\033[0m' % args.output)
@@ -0,0 +1,194 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import argparse
+import json
+import time
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+print("Tensorflow version", tf.__version__)
+
+from include import eval_utils
+from include import graph_manager
+from include import inference_utils
+
+
+def get_split_config(config, split, **kwargs):
+    """Configuration reading the given split in inference mode"""
+    image_folder = config['image_folder']
+    try:
+        image_folder = image_folder % split
+    except TypeError:
+        pass
+    return dict(config, image_folder=image_folder, test_tfrecords=config['%s_tfrecords' % split],
+                test_max_num_bbs=config['%s_max_num_bbs' % split], **kwargs)
+
+
+def evaluate(sess, inputs, initializer, run_fn, results_path, config):
+    """Evaluate the mAP and per-image latency of the given inference function on a split.
+
+    Args:
+        sess: Current session
+        inputs: Inputs of the split
+        initializer: Initializer of the split inputs
+        run_fn: Function mapping a batch of images to the model outputs
+        results_path: Path to the detection outputs file
+        config: Configuration dictionnary
+
+    Returns:
+        The mAP at each threshold and the median per-image latency in milliseconds
+    """
+    with open(results_path, 'w') as f:
+        f.write('results for quantization\n')
+    latencies = []
+    sess.run(initializer)
+    try:
+        while 1:
+            inputs_ = sess.run(inputs)
+            start_time = time.time()
+            out_ = run_fn(inputs_['image'])
+            latencies.append(1000. * (time.time() - start_time) / inputs_['image'].shape[0])
+            eval_utils.append_detection_outputs(
+                results_path, inputs_['im_id'], inputs_['num_boxes'], inputs_['bounding_boxes'], *out_, **config)
+    except tf.errors.OutOfRangeError:
+        pass
+    eval_aps, eval_aps_thresholds, _ = eval_utils.detect_eval(results_path, **config)
+    mean_aps = np.sum([x for x in eval_aps.values()], axis=0) / len(eval_aps)
+    return {'%.2f' % thresh: float(mean_aps[t]) for t, thresh in enumerate(eval_aps_thresholds)}, float(
+        np.median(latencies))
+
+
+if __name__ == '__main__':
+    ########################################################################## Configuration
+    parser = argparse.ArgumentParser(description='Post-training int8 quantization of the backbones of a trained '
+                                     'model for CPU inference.')
+    parser.add_argument('log_dir', type=str, help='Log directory of a trained ODGI or standard model.')
+    parser.add_argument('--num_calibration_images', type=int, default=100,
+                        help='Number of training images to calibrate the activations ranges on.')
+    parser.add_argument('--max_calibration_inputs', type=int, default=500,
+                        help='Maximum number of calibration inputs for each backbone (e.g., stage 2 crops).')
+    parser.add_argument('--split', type=str, default='val', choices=['val', 'test'], help='Split to evaluate on.')
+    parser.add_argument('--batch_size', type=int, default=1, help='Evaluation batch size.')
+    parser.add_argument('--num_runs', type=int, default=50, help='Number of timed runs for each backbone.')
+    parser.add_argument('--output_dir', type=str, help='Output directory. Defaults to `log_dir/int8`.')
+    args = parser.parse_args()
+    if args.output_dir is None:
+        args.output_dir = os.path.join(args.log_dir, 'int8')
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    is_odgi = os.path.exists(os.path.join(args.log_dir, 'stage1_config.pkl'))
+
+    ########################################################################## Build the graph
+    graph = tf.Graph()
+    with graph.as_default():
+        if is_odgi:
+            # Stage 2 only runs on the non-empty crops, which are also the calibration inputs
+            model = inference_utils.build_odgi_model(args.log_dir, args.batch_size,
+                                                     inference_options={'test_compact_crops': True})
+            assert not any(x[3].get('with_roi_features') for x in model['stages']), (
+                'The `roi_head` network runs on the stage 1 features, which are not exported by the quantized backbone')
+            backbones_names = [x[0] for x in model['stages']]
+        else:
+            model = inference_utils.build_standard_model(args.log_dir)
+            backbones_names = [model['config']['network']]
+        config = dict(model['config'], batch_size=args.batch_size)
+        backbones = inference_utils.get_inference_backbones()
+        assert len(backbones) == len(backbones_names)
+        with tf.name_scope('inputs'):
+            # Calibration images are a random sample of the training set
+            calibration_inputs, calibration_initializer = graph_manager.get_inputs(
+                mode='test', shuffle_test=True, verbose=False, **get_split_config(config, 'train'))
+            calibration_inputs = calibration_inputs[0]
+            inputs, initializer = graph_manager.get_inputs(mode=args.split, verbose=False, **config)
+            inputs = inputs[0]
+        saver = tf.train.Saver()
+
+    print('\nQuantizing \033[36m%s\033[0m' % model['name'])
+    results = {'date': datetime.now().strftime("%Y-%m-%d %H:%M"),
+               'tensorflow_version': tf.__version__,
+               'model': model['name'],
+               'log_dir': os.path.abspath(args.log_dir),
+               'split': args.split,
+               'backbones': {}}
+    with tf.Session(graph=graph, config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+        checkpoint_path = tf.train.latest_checkpoint(args.log_dir)
+        assert checkpoint_path is not None, 'No checkpoint found in %s' % args.log_dir
+        saver.restore(sess, checkpoint_path)
+        results['checkpoint'] = checkpoint_path
+
+        ### Calibration inputs of each backbone, as produced by the float model (e.g., stage 2 crops)
+        calibration_images = inference_utils.collect_images(
+            sess, calibration_inputs['image'], calibration_initializer, args.num_calibration_images)
+        backbones_inputs = [[] for _ in backbones]
+        for i in range(0, calibration_images.shape[0], args.batch_size):
+            out_ = sess.run([x[0] for x in backbones],
+                            feed_dict={model['images']: calibration_images[i:i + args.batch_size]})
+            for s, x in enumerate(out_):
+                backbones_inputs[s].append(x)
+        backbones_inputs = [np.concatenate(x, axis=0) for x in backbones_inputs]
+        backbones_inputs = [x[np.random.permutation(x.shape[0])[:args.max_calibration_inputs]]
+                            for x in backbones_inputs]
+
+        ### Quantize each backbone separately
+        interpreters = []
+        for name, (backbone_input, backbone_output), calibration in zip(backbones_names, backbones, backbones_inputs):
+            print('   \033[34m%s:\033[0m calibrating on %d inputs' % (name, calibration.shape[0]))
+            assert calibration.shape[0] > 0, 'No calibration inputs for %s' % name
+            graph_def, input_name, output_name = inference_utils.freeze_backbone(sess, backbone_input, backbone_output)
+            float_path = os.path.join(args.output_dir, '%s_backbone.pb' % name)
+            with tf.gfile.GFile(float_path, 'wb') as f:
+                f.write(graph_def.SerializeToString())
+            quantized_path = os.path.join(args.output_dir, '%s_backbone_int8.tflite' % name)
+            with open(quantized_path, 'wb') as f:
+                f.write(inference_utils.quantize_backbone(
+                    float_path, input_name, output_name, calibration.shape[1:], calibration))
+            interpreter = tf.lite.Interpreter(model_path=quantized_path)
+            interpreter.allocate_tensors()
+            interpreters.append(interpreter)
+
+            # Backbone latency on one input
+            float_latencies, quantized_latencies = [], []
+            for i in range(args.num_runs + 1):
+                x = calibration[i % calibration.shape[0]][None]
+                start_time = time.time()
+                sess.run(backbone_output, feed_dict={backbone_input: x})
+                float_latencies.append(1000. * (time.time() - start_time))
+                start_time = time.time()
+                inference_utils.run_tflite(interpreter, x)
+                quantized_latencies.append(1000. * (time.time() - start_time))
+            # The first run is a warmup
+            float_latency, quantized_latency = np.median(float_latencies[1:]), np.median(quantized_latencies[1:])
+            results['backbones'][name] = {'tflite_model': os.path.abspath(quantized_path),
+                                          'size_mb': os.path.getsize(quantized_path) / 2.**20,
+                                          'float_size_mb': os.path.getsize(float_path) / 2.**20,
+                                          'float_latency_ms': float(float_latency),
+                                          'int8_latency_ms': float(quantized_latency),
+                                          'speedup': float(float_latency / quantized_latency)}
+            print('   \033[34m%s:\033[0m %.2fms (float) -> %.2fms (int8), x%.2f speedup, %.1fMB -> %.1fMB' % (
+                name, float_latency, quantized_latency, results['backbones'][name]['speedup'],
+                results['backbones'][name]['float_size_mb'], results['backbones'][name]['size_mb']))
+
+        ### mAP drift and end-to-end speedup
+        float_map, float_latency = evaluate(
+            sess, inputs, initializer, lambda images: sess.run(model['outputs'], feed_dict={model['images']: images}),
+            os.path.join(args.output_dir, 'float_%s_output.txt' % args.split), config)
+        quantized_map, quantized_latency = evaluate(
+            sess, inputs, initializer,
+            lambda images: inference_utils.run_with_backbones(sess, model, backbones, interpreters, images),
+            os.path.join(args.output_dir, 'int8_%s_output.txt' % args.split), config)
+    results['float'] = {'map': float_map, 'latency_ms': float_latency}
+    results['int8'] = {'map': quantized_map, 'latency_ms': quantized_latency}
+    results['map_drift'] = {k: quantized_map[k] - float_map[k] for k in float_map}
+    results['speedup'] = float_latency / quantized_latency
+    print('\n   float: %.2fms per image - %s' % (
+        float_latency, ' - '.join('map@%s = %.5f' % x for x in sorted(float_map.items()))))
+    print('   int8:  %.2fms per image - %s' % (
+        quantized_latency, ' - '.join('map@%s = %.5f' % x for x in sorted(quantized_map.items()))))
+    print('   x%.2f speedup - %s' % (results['speedup'], ' - '.join(
+        'map@%s drift = %+.5f' % x for x in sorted(results['map_drift'].items()))))
+
+    output_path = os.path.join(args.output_dir, 'quantization.json')
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('\nResults saved in \033[36m%s\033[0m' % output_path)
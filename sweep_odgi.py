@@ -0,0 +1,177 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import argparse
+import itertools
+import time
+
+import numpy as np
+import tensorflow as tf
+print("Tensorflow version", tf.__version__)
+
+from include import eval_utils
+from include import graph_manager
+from include import viz
+
+
+def parse_list(values, dtype=float):
+    """Parse a comma-separated list of values from the command line"""
+    return [dtype(x) for x in values.split(',')]
+
+
+if __name__ == '__main__':
+    ########################################################################## Configuration
+    parser = argparse.ArgumentParser(description='Sweep the ODGI patch extraction parameters at inference.')
+    parser.add_argument('log_dir', type=str, help='Log directory of a trained ODGI model.')
+    parser.add_argument('--split', type=str, default='val', choices=['val', 'test'], help='Split to evaluate on.')
+    parser.add_argument('--num_crops', type=str, default='1,2,3,4,5,6',
+                        help='Comma-separated values for `test_num_crops`.')
+    parser.add_argument('--nms_thresholds', type=str, default='0.25,0.5',
+                        help='Comma-separated values for `test_patch_nms_threshold`.')
+    parser.add_argument('--confidence_thresholds', type=str, default='0.1,0.25',
+                        help='Comma-separated values for `test_patch_confidence_threshold`.')
+    parser.add_argument('--strong_confidence_thresholds', type=str, default='0.6,0.8,1.0',
+                        help='Comma-separated values for `test_patch_strong_confidence_threshold`.')
+    parser.add_argument('--batch_size', type=int, help='Evaluation batch size. Defaults to the training one.')
+    parser.add_argument('--verbose', type=int, default=1, help='Extra verbosity')
+    args = parser.parse_args()
+
+    stages_configs = graph_manager.load_stages_configs(args.log_dir)
+    for config in stages_configs:
+        config['num_gpus'] = 1
+    if args.batch_size is not None:
+        graph_manager.set_inference_batch_size(stages_configs, args.batch_size)
+
+    sweep_grid = list(itertools.product(parse_list(args.num_crops, dtype=int),
+                                        parse_list(args.nms_thresholds),
+                                        parse_list(args.confidence_thresholds),
+                                        parse_list(args.strong_confidence_thresholds)))
+    print('Sweeping %d settings on the %s split' % (len(sweep_grid), args.split))
+
+    tee = viz.Tee(filename='sweep_%s_log.txt' % args.split)
+
+    ########################################################################## Build the graph
+    # The swept parameters are fed to the first stage transition
+    with tf.name_scope('sweep_parameters'):
+        sweep_placeholders = {
+            'test_num_crops': tf.placeholder(tf.int32, (), name='num_crops'),
+            'test_patch_nms_threshold': tf.placeholder(tf.float32, (), name='nms_threshold'),
+            'test_patch_confidence_threshold': tf.placeholder(tf.float32, (), name='confidence_threshold'),
+            'test_patch_strong_confidence_threshold': tf.placeholder(
+                tf.float32, (), name='strong_confidence_threshold')}
+    # Static batch sizes of the next stages, for the largest number of crops
+    stages_configs[1]['test_num_crops'] = max(x[0] for x in sweep_grid)
+    graph_manager.set_previous_batch_sizes(stages_configs)
+    stages_configs[1].update(sweep_placeholders)
+    stages = graph_manager.get_odgi_stages(stages_configs, verbose=args.verbose)
+
+    with tf.name_scope('eval'):
+        with tf.name_scope('inputs'):
+            inputs, eval_initializer = graph_manager.get_inputs(mode=args.split, verbose=False, **stages_configs[0])
+            inputs = inputs[0]
+        stages_outputs = graph_manager.get_odgi_inference_outputs(inputs, stages, verbose=args.verbose)
+
+        # Stage 1 outputs that are cached and fed back to the graph during the sweep
+        stage1_outputs = {key: stages_outputs[0][key] for key in [
+            'bounding_boxes', 'confidence_scores', 'detection_scores', 'group_classification_logits', 'offsets',
+            'roi_features']
+                          if key in stages_outputs[0]}
+
+        eval_outputs = [inputs['im_id'], inputs['num_boxes'], inputs['bounding_boxes'],
+                        stages_outputs[-1]['bounding_boxes'], stages_outputs[-1]['detection_scores']]
+        eval_outputs.extend(graph_manager.get_kept_out_outputs(stages_outputs))
+
+        # Number of non-empty crops passed to the second stage
+        crop_boxes = stages_outputs[0]['crop_boxes']
+        num_valid_crops = tf.reduce_sum(tf.to_int32(tf.logical_and(crop_boxes[..., 2] > crop_boxes[..., 0],
+                                                                   crop_boxes[..., 3] > crop_boxes[..., 1])))
+
+    ########################################################################## Start Session
+    results_path = os.path.join(args.log_dir, 'sweep_%s_output.txt' % args.split)
+    saver = tf.train.Saver()
+    with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess:
+        checkpoint_path = tf.train.latest_checkpoint(args.log_dir)
+        assert checkpoint_path is not None, 'No checkpoint found in %s' % args.log_dir
+        print('\nRestoring weights from \033[36m%s\033[0m' % checkpoint_path)
+        saver.restore(sess, checkpoint_path)
+
+        ### Run stage 1 once on the whole split
+        # The inputs are cached too, so that neither stage is timed with the input pipeline
+        print('Caching stage 1 inputs and outputs')
+        stage1_cache = []
+        stage1_time = 0.
+        sess.run(eval_initializer)
+        try:
+            while 1:
+                inputs_ = sess.run(inputs)
+                start_time = time.time()
+                stage1_outputs_ = sess.run(stage1_outputs, feed_dict={inputs['image']: inputs_['image']})
+                stage1_time += time.time() - start_time
+                stage1_cache.append(dict([(inputs[key], value) for key, value in inputs_.items()] + 
+                                         [(stage1_outputs[key], value) for key, value in stage1_outputs_.items()]))
+        except tf.errors.OutOfRangeError:
+            pass
+        num_images = sum(batch[inputs['image']].shape[0] for batch in stage1_cache)
+        print('   %d images, stage 1 latency: %.2fms per image' % (num_images, 1000. * stage1_time / num_images))
+
+        ### Run the remaining stages for each setting
+        results = []
+        for num_crops, nms_threshold, confidence_threshold, strong_confidence_threshold in sweep_grid:
+            feed_dict = {sweep_placeholders['test_num_crops']: num_crops,
+                         sweep_placeholders['test_patch_nms_threshold']: nms_threshold,
+                         sweep_placeholders['test_patch_confidence_threshold']: confidence_threshold,
+                         sweep_placeholders['test_patch_strong_confidence_threshold']: strong_confidence_threshold}
+            with open(results_path, 'w') as f:
+                f.write('%s results for num_crops=%d, nms=%.2f, conf=%.2f, strong_conf=%.2f\n' % (
+                    args.split, num_crops, nms_threshold, confidence_threshold, strong_confidence_threshold))
+
+            stage2_time = 0.
+            total_crops = 0
+            for batch in stage1_cache:
+                feed_dict.update(batch)
+                start_time = time.time()
+                out_, num_valid_crops_ = sess.run([eval_outputs, num_valid_crops], feed_dict=feed_dict)
+                stage2_time += time.time() - start_time
+                total_crops += num_valid_crops_
+                eval_utils.append_detection_outputs(results_path, *out_, **stages_configs[0])
+
+            eval_aps, eval_aps_thresholds, _ = eval_utils.detect_eval(results_path, **stages_configs[0])
+            mean_aps = np.sum([x for x in eval_aps.values()], axis=0) / len(eval_aps)
+            results.append({'num_crops': num_crops,
+                            'nms_threshold': nms_threshold,
+                            'confidence_threshold': confidence_threshold,
+                            'strong_confidence_threshold': strong_confidence_threshold,
+                            'mean_aps': mean_aps,
+                            'crops_per_image': total_crops / num_images,
+                            'latency_ms': 1000. * (stage1_time + stage2_time) / num_images})
+            print('   num_crops=%d, nms=%.2f, conf=%.2f, strong_conf=%.2f: %s - %.2f crops/image - %.2fms' % (
+                num_crops, nms_threshold, confidence_threshold, strong_confidence_threshold,
+                ' - '.join('map@%.2f = %.5f' % (thresh, mean_aps[t]) for t, thresh in enumerate(eval_aps_thresholds)),
+                results[-1]['crops_per_image'], results[-1]['latency_ms']))
+
+    ########################################################################## Pareto fronts
+    # mAP at the first retrieval IoU threshold versus number of crops, resp. latency
+    scores = [x['mean_aps'][0] for x in results]
+    crops_front = eval_utils.pareto_front(scores, [x['crops_per_image'] for x in results])
+    latency_front = eval_utils.pareto_front(scores, [x['latency_ms'] for x in results])
+
+    sweep_path = os.path.join(args.log_dir, 'sweep_%s.txt' % args.split)
+    with open(sweep_path, 'w') as f:
+        f.write('\t'.join(['num_crops', 'nms_threshold', 'confidence_threshold', 'strong_confidence_threshold'] +
+                          ['map@%.2f' % thresh for thresh in eval_aps_thresholds] +
+                          ['crops_per_image', 'latency_ms', 'crops_pareto', 'latency_pareto']) + '\n')
+        for i, x in enumerate(results):
+            f.write('\t'.join(['%d' % x['num_crops'], '%.2f' % x['nms_threshold'],
+                               '%.2f' % x['confidence_threshold'], '%.2f' % x['strong_confidence_threshold']] +
+                              ['%.5f' % ap for ap in x['mean_aps']] +
+                              ['%.3f' % x['crops_per_image'], '%.3f' % x['latency_ms'],
+                               '%d' % (i in crops_front), '%d' % (i in latency_front)]) + '\n')
+
+    for name, front in [('crops per image', crops_front), ('latency', latency_front)]:
+        print('\nPareto front (map@%.2f vs %s):' % (eval_aps_thresholds[0], name))
+        for i in sorted(front, key=lambda i: scores[i]):
+            print('   num_crops=%d, nms=%.2f, conf=%.2f, strong_conf=%.2f: map = %.5f - %.2f crops/image - %.2fms' % (
+                results[i]['num_crops'], results[i]['nms_threshold'], results[i]['confidence_threshold'],
+                results[i]['strong_confidence_threshold'], scores[i], results[i]['crops_per_image'],
+                results[i]['latency_ms']))
+    print('\nSweep results saved in \033[36m%s\033[0m' % sweep_path)
+    viz.save_tee(args.log_dir, tee)
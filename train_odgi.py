@@ -1,6 +1,7 @@
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 import argparse
+import itertools
 import pickle
 import time
 from functools import partial
@@ -9,81 +10,14 @@ import tensorflow as tf
 print("Tensorflow version", tf.__version__)
 
 from include import configuration
+from include import distributed_utils
 from include import graph_manager
-from include import nets
-from include import loss_utils
 from include import eval_utils
 from include import tf_inputs
+from include import tfrecords_utils
 from include import viz
 
 
-########################################################################## Convenience functions     
-def stage_transition(stage_inputs, stage_outputs, mode, config, verbose=False): 
-    """Create inputs for the next stage based on the output of the current stage"""
-    assert mode in ['train', 'test']
-    with tf.name_scope('extract_patches'):
-        stage_outputs['crop_boxes'], _, stage_outputs['kept_out_filter'] = tf_inputs.extract_groups(
-            stage_outputs['bounding_boxes'], 
-            stage_outputs['confidence_scores'],
-            predicted_group_flags=stage_outputs['group_classification_logits'],
-            predicted_offsets=stage_outputs['offsets'] if 'offsets' in stage_outputs else None,
-            mode=mode, verbose=verbose, **config)  
-        
-    if mode == 'train':
-        del stage_outputs['kept_out_filter']
-        
-    return graph_manager.get_stage2_inputs(stage_inputs, 
-                                           stage_outputs['crop_boxes'], 
-                                           mode=mode, 
-                                           verbose=verbose, 
-                                           **config)
-
-
-def format_final_boxes(final_stage_outputs, crop_boxes):
-    """Rescale outputs relatively to the original input image for evaluating the final 
-       detection results
-    
-    Args:
-        final_stage_outputs: Output dictionnary of the last stage (stage 2)
-        crop_boxes: Crops extracted from stage 1
-    """
-    num_crops = tf.shape(crop_boxes)[1]
-    num_boxes = final_stage_outputs['bounding_boxes'].get_shape()[3].value
-    num_cells = final_stage_outputs['bounding_boxes'].get_shape()[1].value
-    
-    # reshape
-    with tf.name_scope('reshape_outputs'):
-        # outputs: (stage1_batch * num_crops, num_cell, num_cell, num_boxes, ...)
-        # to: (stage1_batch, num_cell, num_cell, num_boxes * num_crops, ...)
-        for key, value in final_stage_outputs.items():   
-            # reshape to (batch_size, num_crops, ...)
-            original_shape = tf.shape(value)       
-            num_dims = len(value.get_shape().as_list())
-            new_shape = tf.concat([tf.stack([-1, num_crops]), original_shape[1:]], axis=0)
-            batches = tf.reshape(value, new_shape)
-            # transpose to (batch_size, num_cells, num_cells, num_crops, num_boxes, ...)
-            transpose_axis = [0, 2, 3, 1] + list(range(4, num_dims + 1))
-            batches = tf.transpose(batches, transpose_axis)
-            # reshape to (batch_size, num_cells, num_cells, num_crops * num_boxes, ...)
-            new_shape = tf.concat([tf.stack([-1, num_cells, num_cells, num_crops * num_boxes]), new_shape[5:]], axis=0)
-            final_stage_outputs[key] = tf.reshape(batches, new_shape)  
-    
-    # rescale
-    with tf.name_scope('rescale_bounding_boxes'):
-        # tile crop_boxes to (stage1_batch, 1, 1, num_crops * num_boxes, 4)
-        crop_boxes = tf.expand_dims(crop_boxes, axis=-2)
-        crop_boxes = tf.tile(crop_boxes, (1, 1, num_boxes, 1))
-        crop_boxes = tf.reshape(crop_boxes, (-1, 1, 1, num_crops * num_boxes, 4))
-        crop_boxes = tf.split(crop_boxes, 2, axis=-1)
-        # bounding_boxes: (stage1_batch, num_cells, num_cells, num_crops * num_boxes, 4)
-        final_stage_outputs['bounding_boxes'] *= tf.maximum(1e-8, tf.tile(crop_boxes[1] - crop_boxes[0], (1, 1, 1, 1, 2)))
-        final_stage_outputs['bounding_boxes'] += tf.tile(crop_boxes[0], (1, 1, 1, 1, 2))
-        final_stage_outputs['bounding_boxes'] = tf.clip_by_value(final_stage_outputs['bounding_boxes'], 0., 1.)        
-    return final_stage_outputs
-
-
-
-
 if __name__ == '__main__':
     ########################################################################## Configuration
     parser = argparse.ArgumentParser(description='Grouped Object Detection (ODGI).')
@@ -92,19 +26,63 @@ if __name__ == '__main__':
         'Otherwise, use the stage 1 batch_size * num_crops'))
     parser.add_argument('--stage2_image_size', type=int, help='Image size for the second stage.')
     parser.add_argument('--stage2_network', type=str, default="tiny_yolo_v2",
-                        help='Architecture for the second stage.', choices=[
-                            'tiny_yolo_v2', 'yolo_v2', 'mobilenet_100', 'mobilenet_50', 'mobilenet_35'])
+                        help='Architecture for the second stage. `roi_head` refines the RoI-aligned stage 1 features '
+                        'of each crop instead of running a backbone on its pixels.', 
+                        choices=configuration.NETWORKS + ['roi_head'])
     parser.add_argument('--stage2_starting_epoch', default=0, type=int,
-                        help='Start training stage 2 after the given number of epochs.')
+                        help='Start training stage 2 (and the intermediate stages) after the given number of epochs.')
+    parser.add_argument('--stage2_crops_dir', type=str,
+                        help='If given, only train stage 2 from the crops dataset generated by `extract_crops.py`.')
+    parser.add_argument('--async_stages', action='store_true',
+                        help='Train stage 1 in background threads, feeding its crops to stage 2 via a bounded buffer.')
+    parser.add_argument('--autotune_num_crops', type=str, default='4,6,8,10',
+                        help='Comma-separated numbers of training crops per image tried by the autotuner')
+    parser.add_argument('--autotune_stage2_batch_sizes', type=str, 
+                        help='Comma-separated stage 2 batch sizes tried by the autotuner. Defaults to all the crops')
+    parser.add_argument('--async_max_staleness', default=2, type=int,
+                        help='Asynchronous mode: Maximum number of stage 1 steps worth of crops waiting in the buffer.')
+    parser.add_argument('--intermediate_stages', type=str,
+                        help='Comma-separated intermediate stages inserted between stage 1 and the final stage (which '
+                        'is configured by the `stage2_*` options), as `network:image_size:num_crops`, where `num_crops` '
+                        'is the number of crops extracted from each input of the previous stage.')
     args = parser.parse_args()
+    assert not (args.async_stages and args.stage2_crops_dir is not None)
+    assert not (args.async_stages and args.stage2_starting_epoch > 0), (
+        'In asynchronous mode, stage 2 trains from the start on the crops produced by stage 1')
     if args.stage2_image_size is None:
         args.stage2_image_size = args.image_size // 2
-
-    print('ODGI %s - %s, Input size %d - %d\n' % (args.network, args.stage2_network, 
-                                                  args.image_size, args.stage2_image_size)) 
+    intermediate_stages = []
+    if args.intermediate_stages is not None:
+        intermediate_stages = [(x.split(':')[0], int(x.split(':')[1]), int(x.split(':')[2])) 
+                               for x in args.intermediate_stages.split(',')]
+        assert not (args.async_stages or args.stage2_crops_dir is not None or args.resolution_schedule is not None or 
+                    args.autotune_memory_budget is not None or args.stage2_batch_size is not None), (
+            'Intermediate stages only support end-to-end training with variable batch sizes')
+    if args.stage2_network == 'roi_head':
+        assert args.stage2_crops_dir is None and not intermediate_stages, (
+            'The RoI head only refines the features of stage 1, in end-to-end training')
+    image_sizes = [args.image_size] + [x[1] for x in intermediate_stages] + [args.stage2_image_size]
+
+    print('ODGI %s, Input size %s\n' % (' - '.join([args.network] + [x[0] for x in intermediate_stages] + [
+        args.stage2_network]), ' - '.join(map(str, image_sizes)))) 
     base_config = configuration.build_base_config_from_args(args, verbose=args.verbose)
-    base_config['exp_name'] += '/%s_odgi_%d_%d' % (
-        args.network, args.image_size, args.stage2_image_size)
+
+    # Multi-process training: the chief builds and runs the graph, the other workers only serve their devices
+    master = ''
+    if base_config['worker_hosts']:
+        server = distributed_utils.start_server(**base_config)
+        master = server.target
+    base_config['exp_name'] += '/%s_odgi_%s' % (args.network, '_'.join(map(str, image_sizes)))
+
+    # Train stage 2 only, from the crops of a frozen stage 1
+    crops_config = None
+    if args.stage2_crops_dir is not None:
+        with open(os.path.join(args.stage2_crops_dir, 'crops_config.pkl'), 'rb') as f:
+            crops_config = pickle.load(f)
+        if (crops_config['stage1_network'] != args.network or crops_config['stage1_image_size'] != args.image_size):
+            raise ValueError('The crops were extracted with stage 1 %s-%d, got --network %s and --image_size %d' % (
+                crops_config['stage1_network'], crops_config['stage1_image_size'], args.network, args.image_size))
+        base_config['exp_name'] += '_from_crops'
 
     with_summaries = base_config['save_summaries_steps'] is not None  
     graph_manager.generate_log_dir(base_config)
@@ -127,35 +105,96 @@ if __name__ == '__main__':
     # Enable groups predictions for early stages
     stage1_config['with_groups'] = True
     stage1_config['with_offsets'] = True
+    # The RoI head refines the stage 1 features
+    stage1_config['with_roi_features'] = args.stage2_network == 'roi_head'
     configuration.finalize_grid_offsets(stage1_config)
 
+    # Intermediate stages: group-aware decode, and their own input size and number of crops
+    intermediate_configs = []
+    for network, image_size, num_crops in intermediate_stages:
+        config = dict(base_config, network=network, image_size=image_size, train_num_crops=num_crops,
+                      test_num_crops=num_crops, with_groups=True, with_offsets=True, batch_size=None)
+        configuration.finalize_grid_offsets(config)
+        intermediate_configs.append(config)
+
     # stage 2 architecture
     stage2_config['network'] = args.stage2_network
     stage2_config['previous_batch_size'] = stage1_config['batch_size'] 
     stage2_config['batch_size'] = args.stage2_batch_size
     configuration.finalize_grid_offsets(stage2_config)
-
+    # the losses of the stage following stage 1 drive the training crops sampler
+    (intermediate_configs + [stage2_config])[0]['track_crop_difficulty'] = stage2_config['train_crop_sampler']
+
+    # stage 2 trained alone from a crops dataset, or asynchronously: fixed stage 2 batch size
+    if (crops_config is not None or args.async_stages) and stage2_config['batch_size'] is None:
+        stage2_config['batch_size'] = stage1_config['batch_size'] * stage1_config['train_num_crops']
+    first_stage = 0
+    if crops_config is not None:
+        first_stage = 1
+        for config in [base_config, stage2_config]:
+            config['train_num_samples'] = crops_config['num_samples']
+            config['train_num_samples_per_iter'] = stage2_config['batch_size'] * base_config['num_gpus']
+            config['train_num_iters_per_epoch'] = crops_config['num_samples'] // config['train_num_samples_per_iter']
+        print('%d training crops (%d iters per epoch)' % (
+            crops_config['num_samples'], base_config['train_num_iters_per_epoch']))
+
+
+    # Pre-flight: fastest batch size, number of crops and stage 2 batch size fitting the memory budget of one device
+    if args.autotune_memory_budget is not None:
+        assert crops_config is None and not args.async_stages, 'The autotuner only supports end-to-end training'
+        def build_autotune_graph(setting):
+            autotune_stages_configs = [
+                dict(stage1_config, num_gpus=1, worker_hosts=None, batch_size=setting['batch_size'], 
+                     train_num_crops=setting['train_num_crops']),
+                dict(stage2_config, num_gpus=1, worker_hosts=None, previous_batch_size=setting['batch_size'], 
+                     batch_size=setting['stage2_batch_size'], train_num_crops=setting['train_num_crops'])]
+            autotune_stages = graph_manager.get_odgi_stages(autotune_stages_configs, verbose=False)
+            with tf.name_scope('train'):
+                stage_inputs = graph_manager.get_inputs(mode='train', verbose=False, **autotune_stages_configs[0])[0][0]
+                with tf.device(graph_manager.get_tower_device(0, **base_config)), tf.name_scope('dev0'):
+                    for s, (name, _, forward_pass, stage_config, loss_fn) in enumerate(autotune_stages):
+                        if s > 0:
+                            with tf.name_scope('stage_transition'):
+                                stage_inputs = graph_manager.stage_transition(
+                                    stage_inputs, stage_outputs, 'train', stage_config)
+                        with tf.name_scope(name):
+                            stage_outputs = forward_pass(stage_inputs['image'], stage_config, is_training=True)
+                            graph_manager.add_losses_to_graph(loss_fn, stage_inputs, stage_outputs, stage_config)
+                losses = graph_manager.get_total_loss(splits=[x[0] for x in autotune_stages], with_summaries=False)
+                global_step_op, train_ops = graph_manager.get_train_op(losses, verbose=False, **base_config)
+            return train_ops + [global_step_op], setting['batch_size']
+        
+        print('\nAutotuning the batch sizes and number of crops for a %.2fGB memory budget' % (
+            args.autotune_memory_budget))
+        candidates = itertools.product(
+            sorted(map(int, args.autotune_batch_sizes.split(','))),
+            sorted(map(int, args.autotune_num_crops.split(','))),
+            [None] if args.autotune_stage2_batch_sizes is None else sorted(
+                map(int, args.autotune_stage2_batch_sizes.split(','))))
+        best_setting, base_config['autotune_results'] = graph_manager.autotune_training_settings(
+            build_autotune_graph, 
+            [{'batch_size': x, 'train_num_crops': y, 'stage2_batch_size': z} for x, y, z in candidates],
+            args.autotune_memory_budget * 1e9, 
+            session_config=tf.ConfigProto(allow_soft_placement=True))
+        assert best_setting is not None, 'No setting fits the memory budget'
+        print('   Selected %s' % ', '.join('%s=%s' % x for x in sorted(best_setting.items())))
+        
+        configuration.set_batch_size(base_config, best_setting['batch_size'])
+        configuration.set_batch_size(stage1_config, best_setting['batch_size'], verbose=False)
+        for key in [x for x in base_config if x.endswith('_num_samples_per_iter') or x.endswith('_num_iters_per_epoch')]:
+            stage2_config[key] = base_config[key]
+        for config in [base_config, stage1_config, stage2_config]:
+            config['train_num_crops'] = best_setting['train_num_crops']
+            config['autotune_results'] = base_config['autotune_results']
+        stage2_config['previous_batch_size'] = best_setting['batch_size']
+        stage2_config['batch_size'] = best_setting['stage2_batch_size']
 
     ### templates for each stage
-    stages = []
-    stages_configs = [stage1_config, stage2_config]
-    for i, config in enumerate(stages_configs):
-        base_name = 'stage%d' % (i + 1)
-        network_name = configuration.get_defaults(config, ['network'], verbose=True)[0]
-        forward_fn = tf.make_template('%s/%s' % (base_name, network_name), getattr(nets, network_name)) 
-
-        # intermediate stages
-        if i < len(stages_configs) - 1:
-            decode_fn = tf.make_template('%s/decode' % base_name, nets.get_detection_outputs_with_groups)
-            loss_fn = partial(loss_utils.get_odgi_loss, loss_base_name=base_name)
-        # final stage
-        else:
-            decode_fn = tf.make_template('%s/decode' % base_name, nets.get_detection_outputs)
-            loss_fn = partial(loss_utils.get_standard_loss, loss_base_name=base_name)
-
-        forward_pass = partial(nets.forward, forward_fn=forward_fn, decode_fn=decode_fn)
-        stages.append((base_name, network_name, forward_pass, config, loss_fn))
-
+    stages_configs = [stage1_config] + intermediate_configs + [stage2_config]
+    stages_configs[1]['previous_batch_size'] = stage1_config['batch_size']
+    graph_manager.set_previous_batch_sizes(stages_configs)
+    stages = graph_manager.get_odgi_stages(stages_configs)
+    for base_name, _, _, config, _ in stages:
         with open(os.path.join(base_config["log_dir"], '%s_config.pkl' % base_name), 'wb') as f:
             pickle.dump(config, f)
         if with_summaries:
@@ -164,118 +203,246 @@ if __name__ == '__main__':
         
 
     ########################################################################## Build the graph
-    print('\nTrain Graph:')
-    with tf.name_scope('train'):
-        with tf.name_scope('inputs'):
-            inputs, _ = graph_manager.get_inputs(mode='train', verbose=args.verbose, **stages[0][3])    
-
+    def get_stage_device(s, i):
+        """Device of the `i`-th tower of stage `s`. In asynchronous mode, each stage has its own GPUs if possible"""
+        num_gpus = base_config['num_gpus']
+        if not args.async_stages or num_gpus == 1:
+            return graph_manager.get_tower_device(i, **base_config)
+        num_stage1_gpus = (num_gpus + 1) // 2
+        gpus = list(range(num_stage1_gpus)) if s == 0 else list(range(num_stage1_gpus, num_gpus))
+        return graph_manager.get_tower_device(gpus[i % len(gpus)], **base_config)
+
+    crops_buffer_capacity = (args.async_max_staleness * base_config['num_gpus'] * 
+                             stage1_config['batch_size'] * stage1_config['train_num_crops'])
+
+    def build_train_towers(inputs, with_summaries, verbose=0, train_stages=None):
+        """Build the forward pass and losses of one training step on each device, for the given stages 
+        (defaults to the target stages). In asynchronous mode, returns the crops buffer between the stages 
+        and its enqueue operations"""
+        train_stages = stages if train_stages is None else train_stages
+        crops_buffer = None
+        enqueue_ops = []
         for i in range(base_config['num_gpus']): 
-            with tf.device('/gpu:%d' % i):
+            with tf.device(graph_manager.get_tower_device(i, **base_config)):
                 with tf.name_scope('dev%d' % i):
-                    verbose = args.verbose * (i == 0)
+                    tower_verbose = verbose * (i == 0)
                     stage_inputs = inputs[i]
 
                     ### Main graph #######
-                    for s, (name, network_name, forward_pass, stage_config, loss_fn) in enumerate(stages):
+                    for s, (name, network_name, forward_pass, stage_config, loss_fn) in enumerate(
+                            train_stages[first_stage:], first_stage):
                         ### Transition from next stage
-                        if s > 0:
+                        if s > first_stage and not args.async_stages:
                             with tf.name_scope('stage_transition'):
-                                print((' > %s' if verbose == 1 else ' \033[33m> %s\033[0m') % 'Stage transition')
-                                stage_inputs = stage_transition(
-                                    stage_inputs, stage_outputs, 'train', stage_config, verbose=verbose)
+                                print((' > %s' if tower_verbose == 1 else ' \033[33m> %s\033[0m') % 'Stage transition')
+                                stage_inputs = graph_manager.stage_transition(
+                                    stage_inputs, stage_outputs, 'train', stage_config, verbose=tower_verbose)
+                        elif s > first_stage:
+                            with tf.device(get_stage_device(s - 1, i)), tf.name_scope('stage_transition'):
+                                print((' > %s' if tower_verbose == 1 else ' \033[33m> %s\033[0m') % (
+                                    'Async stage transition'))
+                                stage_inputs = graph_manager.stage_transition(
+                                    stage_inputs, stage_outputs, 'train', dict(stage_config, batch_size=None), 
+                                    verbose=tower_verbose)
+                                stage_inputs, enqueue_op, crops_buffer = graph_manager.async_stage_transition(
+                                    stage_inputs, stage_outputs['crop_boxes'], stage_config['batch_size'], 
+                                    crops_buffer_capacity, crops_buffer=crops_buffer)
+                                enqueue_ops.append(enqueue_op)
 
                         ### Feed forward
-                        with tf.name_scope(name):
-                            if verbose > 0:
-                                print((' > %s/%s' if verbose == 1 else ' \033[33m> %s/%s\033[0m') % (
+                        with tf.device(get_stage_device(s, i)), tf.name_scope(name):
+                            if tower_verbose > 0:
+                                print((' > %s/%s' if tower_verbose == 1 else ' \033[33m> %s/%s\033[0m') % (
                                     name, network_name))
 
                             with tf.name_scope('feed_forward'):
                                 stage_outputs = forward_pass(
-                                    stage_inputs['image'], stage_config, is_training=True, verbose=verbose) 
+                                    stage_inputs['image'], stage_config, is_training=True, verbose=tower_verbose) 
 
-                            if verbose > 0:
-                                print((' > %s' if verbose == 1 else ' \033[33m> %s\033[0m') % 'Collecting losses')
+                            if tower_verbose > 0:
+                                print((' > %s' if tower_verbose == 1 else ' \033[33m> %s\033[0m') % 'Collecting losses')
                             with tf.name_scope('losses'):
-                                graph_manager.add_losses_to_graph(
-                                    loss_fn, stage_inputs, stage_outputs, stage_config, is_chief=i == 0, verbose=verbose)
+                                graph_manager.add_losses_to_graph(loss_fn, stage_inputs, stage_outputs, stage_config, 
+                                                                  is_chief=i == 0, verbose=tower_verbose)
 
                         ### Summaries
                         if (i == 0) and with_summaries:
-                            print((' > %s' if verbose == 1 else ' \033[33m> %s\033[0m') % 'Adding summaries')
+                            print((' > %s' if tower_verbose == 1 else ' \033[33m> %s\033[0m') % 'Adding summaries')
                             graph_manager.add_summaries(
                                 stage_inputs, stage_outputs, mode='train', family="train_%s" % name, **stage_config)
                     #######################
+        return crops_buffer, enqueue_ops
+
+    # Loss-aware importance sampling of the training images, driven by the stage 1 losses
+    sampler = None
+    if base_config['importance_sampling_ratio'] is not None:
+        assert crops_config is None and not args.async_stages, 'Importance sampling requires end-to-end training'
+        sampler = tf_inputs.ImportanceSampler(
+            base_config['train_tfrecords'], uniform_ratio=base_config['importance_sampling_ratio'], 
+            momentum=configuration.get_defaults(base_config, ['importance_sampling_momentum'])[0])
+        print('\nImportance sampling over %d training images' % sampler.num_samples)
+
+    # Progressive resolution: phases trained at smaller input sizes before the target ones (scaled for stage 2)
+    resolution_phases_stages, target_num_epochs = [], base_config['num_epochs']
+    if base_config['resolution_schedule'] is not None:
+        assert crops_config is None and not args.async_stages, 'The resolution schedule requires end-to-end training'
+        stage1_phases_configs, target_num_epochs = configuration.get_resolution_phases_configs(stage1_config)
+        stage2_phases_configs, _ = configuration.get_resolution_phases_configs(
+            stage2_config, schedule_image_size=stage1_config['image_size'])
+        resolution_phases_stages = [
+            [(name, network_name, forward_pass, phase_config, loss_fn) for (
+                name, network_name, forward_pass, _, loss_fn), phase_config in zip(stages, phase_configs)]
+            for phase_configs in zip(stage1_phases_configs, stage2_phases_configs)]
+
+    print('\nTrain Graph:')
+    with tf.name_scope('train'):
+        with tf.name_scope('inputs'):
+            if crops_config is None:
+                get_train_inputs, _ = graph_manager.get_inputs(
+                    mode='train', as_function=True, sampler=sampler, verbose=args.verbose, 
+                    **dict(stages[0][3], num_epochs=target_num_epochs))    
+            else:
+                get_train_inputs = graph_manager.get_crops_inputs(
+                    crops_config, as_function=True, verbose=args.verbose, **stages[1][3])
+            inputs = get_train_inputs()
+
+        crops_buffer, enqueue_ops = build_train_towers(inputs, with_summaries, verbose=args.verbose)
 
         # Training Objective
         print('\nLosses:')
         with tf.name_scope('losses'):
             losses = graph_manager.get_total_loss(
-                splits=[x[0] for x in stages], with_summaries=with_summaries, verbose=args.verbose)
-            assert len(losses) == 2
+                splits=[x[0] for x in stages[first_stage:]], with_summaries=with_summaries, verbose=args.verbose)
+            assert len(losses) == len(stages) - first_stage
             full_loss = [x[0] for x in losses]
 
         # Train op    
         with tf.name_scope('train_op'):   
-            global_step, train_ops = graph_manager.get_train_op(losses, verbose=args.verbose, **base_config)
-            assert len(train_ops) == 2
-            train_stage1_op = train_ops[0]
-            train_stage2_op = train_ops[1]
+            tower_losses = None
+            if base_config['gradient_reduction'] != 'colocated':
+                tower_losses = graph_manager.get_tower_losses(
+                    base_config['num_gpus'], splits=[x[0] for x in stages[first_stage:]], scope='train/')
+            global_step, train_ops, optimizers = graph_manager.get_train_op(
+                losses, tower_losses=tower_losses, return_optimizers=True, verbose=args.verbose, **base_config)
+            assert len(train_ops) == len(stages) - first_stage
+            train_stage1_op = train_ops[0] if first_stage == 0 else None
+            # the stages following stage 1
+            train_stage2_op = train_ops[1 - first_stage:]
+
+        # Running per-image losses fed back to the sampler at each step (except in the in-graph loop)
+        if sampler is not None:
+            sampling_outputs = graph_manager.get_importance_sampling_outputs(scope=r'train/dev\d+/%s/' % stages[0][0])
+
+        # Asynchronous mode: stage 1 trains and fills the crops buffer in a background thread
+        async_producer = None
+        if args.async_stages:
+            with tf.name_scope('async_stage1'):
+                async_stage1_loss = tf.Variable(0., trainable=False, name='stage1_loss')
+                async_stage1_steps = tf.Variable(0, trainable=False, name='stage1_steps')
+                producer_op = tf.group(train_stage1_op, tf.assign(async_stage1_loss, full_loss[0]),
+                                       tf.assign_add(async_stage1_steps, 1), *enqueue_ops)
+                async_producer = graph_manager.AsyncProducerHook(producer_op, crops_buffer)
+                crops_buffer_size = crops_buffer.size()
+                print('    Asynchronous stage 1, buffer of %d crops' % crops_buffer_capacity)
+
+    ### progressive resolution: one training graph per phase, sharing the weights and optimizers of the target one
+    resolution_phases = []
+    for phase_stages in resolution_phases_stages:
+        print('\nTraining phase: input sizes %d - %d until epoch %d' % (
+            phase_stages[0][3]['image_size'], phase_stages[1][3]['image_size'], 
+            base_config['resolution_schedule'][len(resolution_phases)][1]))
+        with tf.name_scope('train_%d' % phase_stages[0][3]['image_size']) as scope:
+            with tf.name_scope('inputs'):
+                phase_inputs = graph_manager.get_inputs(
+                    mode='train', sampler=sampler, verbose=False, **phase_stages[0][3])[0]
+            build_train_towers(phase_inputs, False, train_stages=phase_stages)
+            phase_losses = graph_manager.get_total_loss(
+                splits=[x[0] for x in stages], with_summaries=False, scope=scope)
+            phase_tower_losses = None
+            if base_config['gradient_reduction'] != 'colocated':
+                phase_tower_losses = graph_manager.get_tower_losses(
+                    base_config['num_gpus'], splits=[x[0] for x in stages], scope=scope)
+            _, phase_train_ops = graph_manager.get_train_op(
+                phase_losses, optimizers=optimizers, tower_losses=phase_tower_losses, update_ops_scope=scope, 
+                verbose=False, **base_config)
+            # Fetches when training stage 1 only, and both stages
+            phase_fetches = [[[phase_losses[0][0]], phase_train_ops[0]], 
+                             [[x[0] for x in phase_losses], phase_train_ops]]
+            if sampler is not None:
+                sampling_fetches = graph_manager.get_importance_sampling_outputs(
+                    scope=r'%sdev\d+/%s/' % (scope, stages[0][0]))
+                phase_fetches = [x + [sampling_fetches] for x in phase_fetches]
+            resolution_phases.append(phase_fetches)
+
+    ### in-graph training loop: runs several steps (of all stages) per `sess.run` call
+    steps_per_run = base_config['steps_per_run']
+    if steps_per_run > 1:
+        assert not args.async_stages, 'The in-graph training loop is not compatible with asynchronous training'
+        assert crops_config is not None or stage2_config['batch_size'] is None, (
+            'The in-graph training loop is not compatible with the stage 2 crops queue (--stage2_batch_size)')
+        print('\nTraining loop: %d steps per run' % steps_per_run)
+        num_loop_steps = tf.placeholder(tf.int32, (), name='num_loop_steps')
+        loop_events = [(args.display_loss_every_n_steps, 1), (base_config['save_summaries_steps'], 1),
+                       (base_config['save_evaluation_steps'], 0), 
+                       (configuration.get_defaults(base_config, ['save_checkpoint_steps'])[0], 0)]
+        def train_step(scope):
+            build_train_towers(get_train_inputs(), False)
+            step_losses = graph_manager.get_total_loss(
+                splits=[x[0] for x in stages[first_stage:]], with_summaries=False, scope=scope)
+            step_tower_losses = None
+            if base_config['gradient_reduction'] != 'colocated':
+                step_tower_losses = graph_manager.get_tower_losses(
+                    base_config['num_gpus'], splits=[x[0] for x in stages[first_stage:]], scope=scope)
+            global_step_op, train_ops = graph_manager.get_train_op(
+                step_losses, optimizers=optimizers, tower_losses=step_tower_losses, update_ops_scope=scope, 
+                verbose=False, **base_config)
+            return train_ops + [global_step_op], [x[0] for x in step_losses]
+        loop_losses = graph_manager.get_multi_step_train_op(train_step, num_loop_steps, len(losses))
 
 
     ############################### Eval
     with tf.name_scope('eval'):  
         eval_split_placehoder = tf.placeholder_with_default(True, (), 'choose_eval_split')
-        ### TODO (multi-GPU evaluation)
-        # tf.reshape operations in `stage_transition` do not handle case of 0-dims Tensors 
-        # that may happen when splitting the inputs tensors across devices.
-        # To avoid these cases, we run evaluation on one device
-        # Note: Thsi is not a problem during training as drop_remainder is turned on
-        base_config['num_gpus'] = 1
-        stage1_config['num_gpus'] = 1
-        ### TODO
-
+        eval_subset_placeholder = tf.placeholder_with_default(
+            tf.zeros((0,), dtype=tf.int32), (None,), 'eval_subset_ids')
         eval_inputs, eval_initializer = tf.cond(
             eval_split_placehoder,
-            true_fn=lambda: graph_manager.get_inputs(mode='test', verbose=False, **stages[0][3]),
-            false_fn=lambda: graph_manager.get_inputs(mode='val', verbose=False, **stages[0][3]),
+            true_fn=lambda: graph_manager.get_inputs(
+                mode='test', subset_ids=eval_subset_placeholder, verbose=False, **stages[0][3]),
+            false_fn=lambda: graph_manager.get_inputs(
+                mode='val', subset_ids=eval_subset_placeholder, verbose=False, **stages[0][3]),
             name='eval_inputs')
 
         for i in range(base_config['num_gpus']):     
-            with tf.device('/gpu:%d' % i):
+            with tf.device(graph_manager.get_tower_device(i, **base_config)):
                 with tf.name_scope('dev%d' % i):
                     stage_inputs = eval_inputs[i]
                     tf.add_to_collection('inference_image_ids', eval_inputs[i]['im_id'])
                     tf.add_to_collection('inference_num_boxes', eval_inputs[i]['num_boxes'])
                     tf.add_to_collection('inference_gt_bbs', eval_inputs[i]['bounding_boxes'])
+                    if 'is_valid' in eval_inputs[i]:
+                        tf.add_to_collection('inference_is_valid', eval_inputs[i]['is_valid'])
 
-                    for s, (name, _, forward_pass, stage_config, _) in enumerate(stages):                    
-                        if s > 0:
-                            stage_inputs = stage_transition(
-                                stage_inputs, stage_outputs, 'test', stage_config, verbose=verbose)
+                    stages_outputs = graph_manager.get_odgi_inference_outputs(
+                        eval_inputs[i], stages, verbose=args.verbose * (i == 0))
 
-                        # stage 1
-                        if s == 1:
-                            tf.add_to_collection('stage1_pred_bbs', stage_outputs['bounding_boxes'])
-                            tf.add_to_collection('stage1_pred_confidences', stage_outputs['detection_scores'])
-                            tf.add_to_collection('stage1_kept_out_boxes', stage_outputs['kept_out_filter'])
-                            crop_boxes = stage_outputs['crop_boxes']
+                    # intermediate stages: boxes kept out of the refinement
+                    kept_out_bbs, kept_out_confidences, kept_out_filter = graph_manager.get_kept_out_outputs(
+                        stages_outputs)
+                    tf.add_to_collection('stage1_pred_bbs', kept_out_bbs)
+                    tf.add_to_collection('stage1_pred_confidences', kept_out_confidences)
+                    tf.add_to_collection('stage1_kept_out_boxes', kept_out_filter)
 
-                        stage_outputs = forward_pass(
-                            stage_inputs['image'], stage_config, is_training=False, verbose=verbose)
-
-                        # stage 2 (final)
-                        if s == 1:                    
-                            stage_outputs = format_final_boxes(stage_outputs, crop_boxes)
-                            tf.add_to_collection('stage2_pred_bbs', stage_outputs['bounding_boxes'])
-                            tf.add_to_collection('stage2_pred_confidences', stage_outputs['detection_scores'])
+                    # final stage
+                    tf.add_to_collection('stage2_pred_bbs', stages_outputs[-1]['bounding_boxes'])
+                    tf.add_to_collection('stage2_pred_confidences', stages_outputs[-1]['detection_scores'])
 
         # gather predictions across gpus
         with tf.name_scope('gather'):
-            eval_outputs = [tf.concat(tf.get_collection(key), axis=0) for key in [
+            eval_outputs = graph_manager.gather_eval_outputs([
                 'inference_image_ids', 'inference_num_boxes', 'inference_gt_bbs', 
                 'stage2_pred_bbs', 'stage2_pred_confidences',
-                'stage1_pred_bbs', 'stage1_pred_confidences', 'stage1_kept_out_boxes']]        
+                'stage1_pred_bbs', 'stage1_pred_confidences', 'stage1_kept_out_boxes'])
 
         # eval functions
         validation_results_path = os.path.join(base_config["log_dir"], 'val_output.txt')
@@ -286,21 +453,45 @@ if __name__ == '__main__':
         eval_validation = partial(run_eval, mode='val', results_path=validation_results_path)
         eval_test = partial(run_eval, mode='test', results_path=test_results_path)
 
+        # fast mid-training validation on a subset of the validation split
+        eval_validation_fast = None
+        if base_config['fast_validation_ratio'] is not None:
+            eval_validation_fast = partial(
+                graph_manager.run_fast_eval, run_eval_fn=eval_validation, subset_placeholder=eval_subset_placeholder,
+                records_index=tfrecords_utils.read_records_index(base_config['val_tfrecords']), configuration=base_config)
+
+    # Asynchronous mode: stage 1 is paused during the evaluations
+    if async_producer is not None:
+        eval_validation, eval_test = async_producer.paused(eval_validation), async_producer.paused(eval_test)
+        if eval_validation_fast is not None:
+            eval_validation_fast = async_producer.paused(eval_validation_fast)
+
+    # Frozen stage 1 weights, when training from a crops dataset
+    stage1_saver = None
+    if crops_config is not None:
+        stage1_saver = tf.train.Saver(var_list=tf.global_variables(scope=stages[0][0]))
+
     
     ########################################################################## Start Session
     print('\ntotal graph size: %.2f MB' % (tf.get_default_graph().as_graph_def().ByteSize() / 10e6))
     log_run()            
     
     try:        
-        with graph_manager.get_monitored_training_session(**base_config) as sess:
+        with graph_manager.get_monitored_training_session(
+                master=master, extra_hooks=None if async_producer is None else [async_producer], 
+                **base_config) as sess:
             # Initialize from pretrained weights for MobileNet architectures
             configuration.start_from_pretrained(sess)
+            if stage1_saver is not None:
+                print('Restoring frozen stage 1 from \033[36m%s\033[0m' % crops_config['stage1_checkpoint'])
+                stage1_saver.restore(sess, crops_config['stage1_checkpoint'])
             
             # Start training
             print('\nStart training:')
             start_time = time.time()
             global_step_ = 0
-            train_stage2 = False
+            best_val_map = None
+            train_stage2 = crops_config is not None or args.async_stages
             
             try:
                 while 1:
@@ -308,28 +499,65 @@ if __name__ == '__main__':
                     if not train_stage2:
                         num_epochs = global_step_ // base_config["train_num_iters_per_epoch"]
                         if num_epochs >= args.stage2_starting_epoch:
-                            print(('   Epoch %d: %s' if verbose == 1 else '\033[33m   Epoch %d: %s\033[0m') % (
+                            print(('   Epoch %d: %s' if args.verbose == 1 else '\033[33m   Epoch %d: %s\033[0m') % (
                                 num_epochs, 'start training stage 2'))
                             train_stage2 = True
                             
-                    # Train       
-                    if train_stage2:
-                        global_step_, full_loss_, _, _ = sess.run([
-                            global_step, full_loss, train_stage1_op, train_stage2_op])
+                    # Progressive resolution: train at the input sizes of the current phase
+                    phase = graph_manager.get_resolution_phase(
+                        global_step_, base_config['resolution_schedule'], base_config['train_num_iters_per_epoch'])
+                    if phase is not None:
+                        global_step_, phase_outputs_ = sess.run([global_step, resolution_phases[phase][train_stage2]])
+                        full_loss_ = phase_outputs_[0]
+                        if sampler is not None:
+                            sampler.update(*phase_outputs_[2])
                     else:
-                        global_step_, full_loss_, _ = sess.run([
-                            global_step, full_loss[:-1], train_stage1_op])
+                        # Train: once all stages are trained, the steps triggering an event (display, 
+                        # evaluation...) are run on their own, and the others in the in-graph loop
+                        if steps_per_run > 1 and train_stage2:
+                            num_steps = graph_manager.get_num_loop_steps(global_step_, steps_per_run - 1, loop_events)
+                            if num_steps > 0:
+                                sess.run(loop_losses, feed_dict={num_loop_steps: num_steps})
+                        if train_stage1_op is None:
+                            global_step_, full_loss_, _ = sess.run([global_step, full_loss, train_stage2_op])
+                        elif args.async_stages:
+                            global_step_, full_loss_, _ = sess.run([
+                                global_step, [async_stage1_loss, full_loss[-1]], train_stage2_op])
+                        elif sampler is not None:
+                            global_step_, full_loss_, _, sampling_outputs_ = sess.run([
+                                global_step, full_loss if train_stage2 else full_loss[:1], 
+                                [train_stage1_op, train_stage2_op] if train_stage2 else train_stage1_op, 
+                                sampling_outputs])
+                            sampler.update(*sampling_outputs_)
+                        elif train_stage2:
+                            global_step_, full_loss_, _, _ = sess.run([
+                                global_step, full_loss, train_stage1_op, train_stage2_op])
+                        else:
+                            global_step_, full_loss_, _ = sess.run([
+                                global_step, full_loss[:1], train_stage1_op])
 
                     # Display
                     if (global_step_ - 1) % args.display_loss_every_n_steps == 0:
                         viz.display_loss(global_step_, full_loss_, start_time,
                                          base_config["train_num_samples_per_iter"], 
                                          base_config["train_num_samples"])
+                        if args.async_stages:
+                            async_stage1_steps_, buffer_size_ = sess.run([async_stage1_steps, crops_buffer_size])
+                            print('   (async) stage 1: %d steps, stage 2: %d steps, %.2f steps/s overall, '
+                                  '%d crops buffered' % (async_stage1_steps_, global_step_, (
+                                      async_stage1_steps_ + global_step_) / (time.time() - start_time), buffer_size_))
+                        if sampler is not None:
+                            print('   (importance sampling) %s' % sampler.summary())
 
                     # Evaluate on validation set
                     if (base_config["save_evaluation_steps"] is not None and (global_step_ > 1)
                         and global_step_  % base_config["save_evaluation_steps"] == 0):
-                        eval_validation(sess, global_step_)
+                        if eval_validation_fast is None:
+                            eval_validation(sess, global_step_)
+                        else:
+                            mean_aps_, is_full_pass = eval_validation_fast(sess, global_step_, best_map=best_val_map)
+                            if is_full_pass:
+                                best_val_map = max(mean_aps_[0], best_val_map or 0.)
                         log_run()
             except tf.errors.OutOfRangeError: # End of training
                 pass              
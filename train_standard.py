@@ -9,10 +9,13 @@ import tensorflow as tf
 print("Tensorflow version", tf.__version__)
 
 from include import configuration
+from include import distributed_utils
 from include import graph_manager
 from include import nets
 from include import loss_utils
 from include import eval_utils
+from include import tf_inputs
+from include import tfrecords_utils
 from include import viz
 
  
@@ -26,11 +29,43 @@ if __name__ == '__main__':
     print('Standard detection - %s, Input size %d\n' % (args.data, args.image_size)) 
     base_config = configuration.build_base_config_from_args(args, verbose=args.verbose)
 
+    # Multi-process training: the chief builds and runs the graph, the other workers only serve their devices
+    master = ''
+    if base_config['worker_hosts']:
+        server = distributed_utils.start_server(**base_config)
+        master = server.target
+
     config = base_config.copy()
     config['image_size'] = args.image_size
     config['exp_name'] += '/%s_standard_%d' % (config['network'],config['image_size'])
     configuration.finalize_grid_offsets(config)
 
+    # Pre-flight: fastest batch size fitting the memory budget of one device
+    if args.autotune_memory_budget is not None:
+        def build_autotune_graph(setting):
+            autotune_config = dict(config, num_gpus=1, worker_hosts=None, **setting)
+            network = autotune_config['network']
+            forward_fn = tf.make_template(network, getattr(nets, network))
+            decode_fn = tf.make_template('decode', nets.get_detection_outputs)
+            with tf.name_scope('train'):
+                inputs = graph_manager.get_inputs(mode='train', verbose=False, **autotune_config)[0][0]
+                with tf.device(graph_manager.get_tower_device(0, **autotune_config)), tf.name_scope('dev0'):
+                    outputs = nets.forward(inputs['image'], autotune_config, forward_fn, decode_fn, is_training=True)
+                    graph_manager.add_losses_to_graph(loss_utils.get_standard_loss, inputs, outputs, autotune_config)
+                losses = graph_manager.get_total_loss(with_summaries=False)
+                global_step_op, train_ops = graph_manager.get_train_op(losses, verbose=False, **autotune_config)
+            return train_ops + [global_step_op], setting['batch_size']
+        
+        print('\nAutotuning the batch size for a %.2fGB memory budget' % args.autotune_memory_budget)
+        best_setting, config['autotune_results'] = graph_manager.autotune_training_settings(
+            build_autotune_graph, 
+            [{'batch_size': x} for x in sorted(map(int, args.autotune_batch_sizes.split(',')))],
+            args.autotune_memory_budget * 1e9, 
+            session_config=tf.ConfigProto(allow_soft_placement=True))
+        assert best_setting is not None, 'No batch size fits the memory budget'
+        print('   Selected batch size %d' % best_setting['batch_size'])
+        configuration.set_batch_size(config, best_setting['batch_size'])
+
     graph_manager.generate_log_dir(config)
     print('    Log directory', os.path.abspath(config["log_dir"]))
     with open(os.path.join(config["log_dir"], 'config.pkl'), 'wb') as f:
@@ -54,34 +89,56 @@ if __name__ == '__main__':
             viz.add_text_summaries(config) 
 
     ### train
-    print('\nTrain Graph:')
-    with tf.name_scope('train'):
-        with tf.name_scope('inputs'):
-            inputs, _ = graph_manager.get_inputs(mode='train', verbose=args.verbose, **config) 
-
+    def build_train_towers(inputs, with_summaries, verbose=0, train_config=None):
+        """Build the forward pass and losses of one training step on each device, at the input size of
+        `train_config` (defaults to the target configuration)"""
+        train_config = config if train_config is None else train_config
         for i in range(config['num_gpus']):        
-            with tf.device('/gpu:%d' % i):  
+            with tf.device(graph_manager.get_tower_device(i, **config)):  
                 with tf.name_scope('dev%d' % i):
-                    verbose = args.verbose * (i == 0)
-                    if verbose > 0:
-                        print((' > %s' if verbose == 1 else ' \033[31m> %s\033[0m') % network)
+                    tower_verbose = verbose * (i == 0)
+                    if tower_verbose > 0:
+                        print((' > %s' if tower_verbose == 1 else ' \033[31m> %s\033[0m') % network)
 
                     ### Main graph
                     with tf.name_scope('feed_forward'):
                         outputs = forward_pass(
-                            inputs[i]['image'], config, is_training=True, verbose=verbose) 
+                            inputs[i]['image'], train_config, is_training=True, verbose=tower_verbose) 
                     #######################
 
-                    if verbose > 0:
-                        print((' > %s' if verbose == 1 else ' \033[31m> %s\033[0m') % 'Collecting losses')
+                    if tower_verbose > 0:
+                        print((' > %s' if tower_verbose == 1 else ' \033[31m> %s\033[0m') % 'Collecting losses')
                     with tf.name_scope('losses'):
-                        graph_manager.add_losses_to_graph(
-                            loss_utils.get_standard_loss, inputs[i], outputs, config, is_chief=i == 0, verbose=verbose)
+                        graph_manager.add_losses_to_graph(loss_utils.get_standard_loss, inputs[i], outputs, 
+                                                          train_config, is_chief=i == 0, verbose=tower_verbose)
                     with tf.name_scope('summaries'):
                         if i == 0 and with_summaries:
                             print(' > summaries:')
                             graph_manager.add_summaries(
-                                inputs[i], outputs, mode='train', verbose=verbose, **config)
+                                inputs[i], outputs, mode='train', verbose=tower_verbose, **config)
+
+    # Loss-aware importance sampling of the training images
+    sampler = None
+    if config['importance_sampling_ratio'] is not None:
+        sampler = tf_inputs.ImportanceSampler(
+            config['train_tfrecords'], uniform_ratio=config['importance_sampling_ratio'], 
+            momentum=configuration.get_defaults(config, ['importance_sampling_momentum'])[0])
+        print('\nImportance sampling over %d training images' % sampler.num_samples)
+
+    # Progressive resolution: phases trained at smaller input sizes before the target one
+    resolution_phases_configs, target_num_epochs = [], config['num_epochs']
+    if config['resolution_schedule'] is not None:
+        resolution_phases_configs, target_num_epochs = configuration.get_resolution_phases_configs(config)
+
+    print('\nTrain Graph:')
+    with tf.name_scope('train'):
+        with tf.name_scope('inputs'):
+            get_train_inputs, _ = graph_manager.get_inputs(
+                mode='train', as_function=True, sampler=sampler, verbose=args.verbose, 
+                **dict(config, num_epochs=target_num_epochs)) 
+            inputs = get_train_inputs()
+
+        build_train_towers(inputs, with_summaries, verbose=args.verbose)
 
         with tf.name_scope('losses'):
             losses = graph_manager.get_total_loss(verbose=args.verbose, with_summaries=with_summaries)
@@ -90,35 +147,91 @@ if __name__ == '__main__':
 
         print('\nTrain op:')
         with tf.name_scope('train_op'):   
-            global_step, train_op = graph_manager.get_train_op(losses, verbose=args.verbose, **config)
+            tower_losses = None
+            if config['gradient_reduction'] != 'colocated':
+                tower_losses = graph_manager.get_tower_losses(config['num_gpus'], scope='train/')
+            global_step, train_op, optimizers = graph_manager.get_train_op(
+                losses, tower_losses=tower_losses, return_optimizers=True, verbose=args.verbose, **config)
             assert len(train_op) == 1
             train_op = train_op[0]
 
+        # Running per-image losses fed back to the sampler at each step (except in the in-graph loop)
+        if sampler is not None:
+            sampling_outputs = graph_manager.get_importance_sampling_outputs(scope='train/dev')
+
+    ### progressive resolution: one training graph per phase, sharing the weights and optimizers of the target one
+    resolution_phases = []
+    for phase_config in resolution_phases_configs:
+        print('\nTraining phase: input size %d until epoch %d' % (
+            phase_config['image_size'], phase_config['resolution_schedule'][len(resolution_phases)][1]))
+        with tf.name_scope('train_%d' % phase_config['image_size']) as scope:
+            with tf.name_scope('inputs'):
+                phase_inputs = graph_manager.get_inputs(
+                    mode='train', sampler=sampler, verbose=False, **phase_config)[0]
+            build_train_towers(phase_inputs, False, train_config=phase_config)
+            phase_losses = graph_manager.get_total_loss(with_summaries=False, scope=scope)
+            phase_tower_losses = None
+            if config['gradient_reduction'] != 'colocated':
+                phase_tower_losses = graph_manager.get_tower_losses(config['num_gpus'], scope=scope)
+            _, phase_train_ops = graph_manager.get_train_op(
+                phase_losses, optimizers=optimizers, tower_losses=phase_tower_losses, update_ops_scope=scope, 
+                verbose=False, **config)
+            phase_fetches = [phase_losses[0][0], phase_train_ops[0]]
+            if sampler is not None:
+                phase_fetches.append(graph_manager.get_importance_sampling_outputs(scope=scope + 'dev'))
+            resolution_phases.append(phase_fetches)
+
+    ### in-graph training loop: runs several steps per `sess.run` call
+    steps_per_run = config['steps_per_run']
+    if steps_per_run > 1:
+        print('\nTraining loop: %d steps per run' % steps_per_run)
+        num_loop_steps = tf.placeholder(tf.int32, (), name='num_loop_steps')
+        loop_events = [(args.display_loss_every_n_steps, 1), (config['save_summaries_steps'], 1),
+                       (config['save_evaluation_steps'], 0), 
+                       (configuration.get_defaults(config, ['save_checkpoint_steps'])[0], 0)]
+        def train_step(scope):
+            build_train_towers(get_train_inputs(), False)
+            step_losses = graph_manager.get_total_loss(with_summaries=False, scope=scope)
+            step_tower_losses = None
+            if config['gradient_reduction'] != 'colocated':
+                step_tower_losses = graph_manager.get_tower_losses(config['num_gpus'], scope=scope)
+            global_step_op, train_ops = graph_manager.get_train_op(
+                step_losses, optimizers=optimizers, tower_losses=step_tower_losses, update_ops_scope=scope, 
+                verbose=False, **config)
+            return train_ops + [global_step_op], [x[0] for x in step_losses]
+        loop_losses = graph_manager.get_multi_step_train_op(train_step, num_loop_steps, len(losses))
+
     ### inference
     with tf.name_scope('eval'):     
         eval_split_placehoder = tf.placeholder_with_default(True, (), 'choose_eval_split')
+        eval_subset_placeholder = tf.placeholder_with_default(
+            tf.zeros((0,), dtype=tf.int32), (None,), 'eval_subset_ids')
         eval_inputs, eval_initializer = tf.cond(
             eval_split_placehoder,
-            true_fn=lambda: graph_manager.get_inputs(mode='test', verbose=False, **config),
-            false_fn=lambda: graph_manager.get_inputs(mode='val', verbose=False, **config),
+            true_fn=lambda: graph_manager.get_inputs(
+                mode='test', subset_ids=eval_subset_placeholder, verbose=False, **config),
+            false_fn=lambda: graph_manager.get_inputs(
+                mode='val', subset_ids=eval_subset_placeholder, verbose=False, **config),
             name='eval_inputs')
 
         for i in range(config['num_gpus']):
-            with tf.device('/gpu:%d' % i):
+            with tf.device(graph_manager.get_tower_device(i, **config)):
                 with tf.name_scope('dev%d' % i):
                     eval_outputs = forward_pass(
-                        eval_inputs[i]['image'], config, is_training=False, verbose=verbose)
+                        eval_inputs[i]['image'], config, is_training=False, verbose=args.verbose * (i == 0))
                     tf.add_to_collection('inference_image_ids', eval_inputs[i]['im_id'])
                     tf.add_to_collection('inference_num_boxes', eval_inputs[i]['num_boxes'])
                     tf.add_to_collection('inference_gt_bbs', eval_inputs[i]['bounding_boxes'])
                     tf.add_to_collection('inference_pred_bbs', eval_outputs['bounding_boxes'])
                     tf.add_to_collection('inference_pred_confidences', eval_outputs['detection_scores'])
+                    if 'is_valid' in eval_inputs[i]:
+                        tf.add_to_collection('inference_is_valid', eval_inputs[i]['is_valid'])
 
         # gather predictions across gpus
         with tf.name_scope('gather'):
-            eval_outputs = [tf.concat(tf.get_collection(key), axis=0) for key in [
+            eval_outputs = graph_manager.gather_eval_outputs([
                 'inference_image_ids', 'inference_num_boxes', 'inference_gt_bbs', 
-                'inference_pred_bbs', 'inference_pred_confidences']]        
+                'inference_pred_bbs', 'inference_pred_confidences'])
 
         # eval functions
         validation_results_path = os.path.join(config["log_dir"], 'val_output.txt')
@@ -128,6 +241,13 @@ if __name__ == '__main__':
                            eval_initializer=eval_initializer, eval_outputs=eval_outputs, configuration=config)
         eval_validation = partial(run_eval, mode='val', results_path=validation_results_path)
         eval_test = partial(run_eval, mode='test', results_path=test_results_path)
+
+        # fast mid-training validation on a subset of the validation split
+        eval_validation_fast = None
+        if config['fast_validation_ratio'] is not None:
+            eval_validation_fast = partial(
+                graph_manager.run_fast_eval, run_eval_fn=eval_validation, subset_placeholder=eval_subset_placeholder,
+                records_index=tfrecords_utils.read_records_index(config['val_tfrecords']), configuration=config)
             
 
     ########################################################################## Start Session            
@@ -143,7 +263,7 @@ if __name__ == '__main__':
     log_run()            
     
     try:        
-        with graph_manager.get_monitored_training_session(**config) as sess:
+        with graph_manager.get_monitored_training_session(master=master, **config) as sess:
             # Initialize from pretrained weights for MobileNet architectures
             configuration.start_from_pretrained(sess)
             
@@ -151,22 +271,48 @@ if __name__ == '__main__':
             print('\nStart training:')
             start_time = time.time()
             global_step_ = 0
+            best_val_map = None
             
             try:
                 while 1:                       
-                    # Train
-                    global_step_, full_loss_, _ = sess.run([global_step, full_loss, train_op])
+                    # Progressive resolution: train at the input size of the current phase
+                    phase = graph_manager.get_resolution_phase(
+                        global_step_, config['resolution_schedule'], config['train_num_iters_per_epoch'])
+                    if phase is not None:
+                        global_step_, phase_outputs_ = sess.run([global_step, resolution_phases[phase]])
+                        full_loss_ = phase_outputs_[0]
+                        if sampler is not None:
+                            sampler.update(*phase_outputs_[2])
+                    else:
+                        # Train: the steps triggering an event (display, evaluation...) are run on their own
+                        if steps_per_run > 1:
+                            num_steps = graph_manager.get_num_loop_steps(global_step_, steps_per_run - 1, loop_events)
+                            if num_steps > 0:
+                                sess.run(loop_losses, feed_dict={num_loop_steps: num_steps})
+                        if sampler is None:
+                            global_step_, full_loss_, _ = sess.run([global_step, full_loss, train_op])
+                        else:
+                            global_step_, full_loss_, _, sampling_outputs_ = sess.run([
+                                global_step, full_loss, train_op, sampling_outputs])
+                            sampler.update(*sampling_outputs_)
 
                     # Display
                     if (global_step_ - 1) % args.display_loss_every_n_steps == 0:
                         viz.display_loss(global_step_, full_loss_, start_time,
                                          config["train_num_samples_per_iter"], 
                                          config["train_num_samples"])
+                        if sampler is not None:
+                            print('   (importance sampling) %s' % sampler.summary())
 
                     # Evaluate on validation set
                     if (config["save_evaluation_steps"] is not None and (global_step_ > 1)
                         and global_step_  % config["save_evaluation_steps"] == 0):
-                        eval_validation(sess, global_step_)
+                        if eval_validation_fast is None:
+                            eval_validation(sess, global_step_)
+                        else:
+                            mean_aps_, is_full_pass = eval_validation_fast(sess, global_step_, best_map=best_val_map)
+                            if is_full_pass:
+                                best_val_map = max(mean_aps_[0], best_val_map or 0.)
                         log_run()
             except tf.errors.OutOfRangeError: # End of training
                 pass              